@@ -5,11 +5,16 @@ import numpy as np
 import pandas as pd
 import mne
 import json
+import time
+import atexit
 import logging
 from setup_logger import setup_logger
 from datetime import datetime
 from collections import defaultdict
 from utils import BasicOperationsHelper, MetadataHelper, DatasetHelper, ExtractionHelper, GLMHelper, VisualizationHelper
+from pipeline import StageCache, PipelineRunner, SweepPlanner, BudgetPlanner
+from work_queue import WorkQueue
+from stage_metrics import StageMetrics
 
 # Add parent folder of src to path and change cwd
 __location__ = Path(__file__).parent.parent
@@ -25,8 +30,25 @@ crop_size = 112  # 224 112
 ann_model = "Alexnet"  # "Resnet50"
 module_name =  "features.12" # "fc" # features.12 has 9216 dimensions
 batch_size = 32
+extraction_num_workers = 4  # DataLoader workers that read and convert crop batches during feature extraction
+prediction_num_workers = None  # Worker processes that evaluate the cross-session prediction matrix on shared-memory inputs (1: serial). None: the cpus of pipeline_max_cpus not used by local work queue workers
+prediction_blas_threads = None  # BLAS threads per prediction worker, None: those cpus / prediction_num_workers
+split_data_cache_gb = 4  # Size of the in-process LRU cache of loaded train/test splits, shared by all helpers (0 disables it)
+split_storage_backend = "files"  # "files" (one .npy per content/norm/session/split), "hdf5" (one chunked store per subject: data_files/{lock_event}/split_store/subject_{id}.h5)
+split_store_compression = None  # None, "gzip", "lzf" (compressed splits are read completely instead of memory-mapped)
+repack_split_stores = True  # Rewrite the hdf5 split store of each subject at the end of the run, replaced splits otherwise keep occupying disk space
 
 pca_components = 30
+feature_reducer = "pca"  # "pca", "random_projection" (sparse, no fitting), "spatial_pooling" (pooling of conv maps before flattening)
+random_projection_components = 512
+feature_map_shape = (256, 6, 6)  # (channels, height, width) of the module output, required for spatial_pooling. Alexnet features.12: (256, 6, 6)
+pooled_size = 2  # Output height/width per channel after spatial pooling
+spatial_pooling_type = "average"  # "average", "max"
+pca_solver = "full"  # "full", "randomized" (randomized SVD for small k), "incremental" (IncrementalPCA over chunks, no concatenation of sessions)
+pca_batch_size = 2048  # Number of epochs per chunk for streaming z-scoring, incremental fitting and transformation
+pca_basis = "per_session"  # "per_session", "reference_session" or "pooled_train": the latter two project all sessions into one shared, stored pca basis
+pca_reference_session = "1"  # Session the basis is fit on for pca_basis "reference_session"
+pca_sweep_components = [5, 10, 20, 30, 50, 75, 100, 150, 200]  # Component counts evaluated from a single pca fit with max(pca_sweep_components)
 
 best_timepoints_by_subject = {"fixation":  {"01": {"timepoint_min": 999, "timepoint_max": 999}, 
                                             "02": {"timepoint_min": 310, "timepoint_max": 315},  # "02": {"timepoint_min": 290, "timepoint_max": 330},
@@ -56,20 +78,73 @@ omit_sessions_by_subject = {"01": ["1"],
 
 logger_level = 25
 debugging = True if logger_level <= 23 else False  # TODO: Use this as class attribute rather than passing it to every function
+record_stage_metrics = True  # Wall time, cpu time, peak memory, bytes read/written and item counts of each stage method; summary at the end of the log, records in data_files/{lock_event}/stage_metrics
 
 # Choose Calculations to be performed
+import_split_files_into_store = False  # Move existing .npy splits of the subject into the hdf5 split store (requires split_storage_backend "hdf5")
 create_metadata = False
-create_train_test_split = False  # Careful! Everytime this is set to true, all following steps will be misalligned
+create_train_test_split = False  # Careful! Everytime this is set to true with a different split_random_seed, all following steps will be misalligned (unless use_stage_cache recomputes them)
 create_crop_datset_numpy = False
 create_meg_dataset = False
 extract_features = False
 perform_pca = False
+perform_pca_sweep = False  # Fit pca once with max(pca_sweep_components) and evaluate all component counts by slicing
+compute_temporal_generalization = False  # Apply every timepoint model to every timepoint (train t x test t') within and across sessions
+perform_permutation_test = False  # P-values of self-prediction (n_permutations label permutations) and of the drift slope (permuted session dates), with the alphas of the trained GLM models
 train_GLM = False
+incremental_GLM = False  # Only train new or changed sessions and compute their row/column of the cross-session results, keeping stored models and results
+cross_validate_GLM = False  # K-fold encoding grouped by sceneID instead of the single train/test split; stores fold-averaged fit measures in the prediction result layout, in cv_{n_cv_folds} subject subfolders
 generate_predictions_with_GLM = False
 visualization = True
 
+use_stage_cache = True  # The flags above request stages: outdated or missing upstream stages are recomputed, stages whose configuration and upstream artifacts match their record are skipped
+force_stages = []  # Stages that are recomputed even if up to date, e.g. ["features"]
+resume_sessions = True  # Meg dataset, feature extraction and GLM training skip sessions whose completion marker matches their inputs and settings (not for stages in force_stages)
+adopt_existing_artifacts = True  # Upstream stages without record (artifacts created before the stage cache) are recorded as up to date instead of recomputed
+run_stages_in_parallel = False  # Run independent stages and subjects concurrently (each stage in its own process) within the budgets below
+pipeline_max_cpus = os.cpu_count()
+pipeline_max_memory_gb = 15
+stage_resources = {"features": {"cpus": 4, "memory_gb": 6},  # Estimated cpus and peak memory per stage, stages not listed use 1 cpu and 2 GB
+                   "meg_dataset": {"cpus": 1, "memory_gb": 4},
+                   "feature_reduction": {"cpus": 2, "memory_gb": 4},
+                   "GLM_training": {"cpus": 4, "memory_gb": 4},
+                   "GLM_predictions": {"cpus": 4, "memory_gb": 4},
+                   "permutation_test": {"cpus": 4, "memory_gb": 4},
+                   }
+use_work_queue = False  # Run meg dataset, feature extraction, GLM training and predictions as tasks per subject, session (and normalization) on workers that share a queue folder, other stages run here
+work_queue_folder = f"data_files/{lock_event}/work_queue"  # Must be on a file system shared with the workers. Workers on other nodes: python src/work_queue.py --queue-folder <work_queue_folder>
+work_queue_local_workers = 4  # Workers started on this machine (0: only workers started elsewhere). They run until the end of the pipeline, crashed ones are restarted
+work_queue_timeout_h = None  # Maximum wait for the tasks of one stage, e.g. if no worker is running on other nodes. None: no limit
+time_budget_h = None  # Wall-clock budget of the allocation, e.g. 3.75 for the 4 hour sessions of interactive_job.sh. Stages that do not fit (estimated from past runs) are deferred to the next run. None: no budget
+memory_budget_gb = 15  # Stages whose recorded peak memory exceeds this are deferred
+default_stage_duration_min = 30  # Estimated duration of stages that never ran
+
+# Prediction workers and their BLAS threads are capped at the cpus left over by the local work queue workers, which run concurrently
+prediction_cpus = max(1, pipeline_max_cpus - (work_queue_local_workers if use_work_queue else 0))
+prediction_num_workers = prediction_cpus if prediction_num_workers is None else max(1, min(prediction_num_workers, prediction_cpus))
+prediction_blas_threads = max(1, prediction_cpus // prediction_num_workers) if prediction_blas_threads is None else prediction_blas_threads
+
+# Sweep over configurations: parameters of this file and their values, e.g. {"pca_components": [10, 30, 100], "fractional_ridge": [True, False]}. Empty: single run.
+# The requested stages run for every configuration, stages whose settings did not change since the previous configuration are skipped by the stage cache.
+# All normalizations are processed in every configuration (list them in normalizations instead of sweeping them).
+sweep_grid = {}
+# Stages that use a sweep parameter directly (their downstream stages are affected as well)
+sweep_parameter_stages = {"split_random_seed": ["train_test_split"],
+                          "timepoint_min": ["meg_dataset"], 
+                          "timepoint_max": ["meg_dataset"], 
+                          "mag_channels": ["meg_dataset"],
+                          "ann_model": ["features"], 
+                          "module_name": ["features"],
+                          "feature_reducer": ["feature_reduction"],
+                          "pca_components": ["feature_reduction"],
+                          "alphas": ["GLM_training", "GLM_cross_validation", "pca_sweep", "permutation_test"],
+                          "fractional_ridge": ["GLM_training", "pca_sweep", "permutation_test"],
+                          "ridge_solver": ["GLM_training"],
+                          }
+
+use_feature_cache = True  # Reuse features of identical crops (by content hash) across sessions, crop sizes and lock events
 z_score_features_before_pca = True
-use_pca_features = True
+use_pca_features = True  # Use features reduced by feature_reducer instead of raw ann_features
 
 use_all_mag_sensors = False
 use_ica_cleaned_data = True
@@ -77,14 +152,37 @@ clip_outliers = True
 interpolate_outliers = False  # Currently only implemented for mean_centered_ch_then_global_z! Cuts off everything over +-3 std
 use_best_timepoints_for_subject = True
 
+split_random_seed = 0  # Seed of the scene shuffling in create_train_test_split (combined with the session id)
+n_cv_folds = 5
+visualize_cross_validated_results = False  # Visualization shows the fold-averaged fit measures of cross_validate_GLM instead of the single split predictions
+cv_random_seed = 0  # Seed of the scene to fold assignment in cross_validate_GLM
+
 fractional_ridge = False
+batched_fractional_ridge = True  # Fractional ridge over all sensors and timepoints at once with a best fraction per target (instead of one FracRidgeRegressorCV per timepoint)
+n_permutations = 1000
+permutation_batch_size = 8  # Permutations that are refit and evaluated together as one batched matrix product
+ridge_form = "auto"  # "auto" (dual/sample-space ridge if n_features > n_samples, e.g. raw ann_features), "primal", "dual"
+ridge_solver = "per_timepoint"  # "per_timepoint" (RidgeCV/FracRidgeRegressorCV per timepoint), "sufficient_statistics" (all_sessions_combined and leave-one-session-out models from per-session XᵀX, XᵀY)
 
 fit_measure_storage_distinction = "session_level"
+prediction_storage_distinctions = [fit_measure_storage_distinction, "timepoint_sensor_level", "timepoint_level"]  # Fit measures stored by the GLM_predictions stage
 
 subtract_self_pred = False
 time_window_n_indices = 10
 all_windows_one_plot = True
 omit_non_generalizing_sessions = True
+compute_drift_bootstrap = False  # Bootstrap confidence intervals of drift slopes/correlations from the stored GLM models (no refitting)
+n_bootstrap = 2000
+drift_bootstrap_resample = "epochs"  # "epochs" (test epochs of predicted sessions), "session_pairs"
+drift_include_0_distance = True  # Self-predictions at distance 0 in the drift plots and in the drift bootstrap regression
+
+BasicOperationsHelper.split_data_cache_max_bytes = int(split_data_cache_gb * 1024**3)
+BasicOperationsHelper.split_storage_backend = split_storage_backend
+BasicOperationsHelper.split_store_compression = split_store_compression
+BasicOperationsHelper.use_ica_cleaned_data = use_ica_cleaned_data
+if split_storage_backend == "hdf5" and use_work_queue:
+    # Writers are serialized with a lock file (flock), which does not reach workers on other nodes
+    raise ValueError("split_storage_backend 'hdf5' cannot be used with use_work_queue, workers on other nodes cannot share the split store of a subject. Use 'files'.")
 
 if use_all_mag_sensors:
     # Load all available mag_channels from evoked file
@@ -112,25 +210,144 @@ investigate_missing_metadata = False
 shuffle_train_labels = False
 shuffle_test_labels = False  # shuffles the data that is to be predicted! (In control, this can be the train split aswell)
 
+pipeline_start = time.time()
 logging_setup = setup_logger(logger_level)
+StageMetrics.enabled = record_stage_metrics
 logger = logging.getLogger(__name__)
 
 logger.custom_info(f"Num meg_channels: {n_grad + n_mag}")
 
-for run in range(run_pipeline_n_times):
-    for subject_id in subject_ids:
-        if use_best_timepoints_for_subject:
-            timepoint_min = best_timepoints_by_subject[lock_event][subject_id]["timepoint_min"]
-            timepoint_max = best_timepoints_by_subject[lock_event][subject_id]["timepoint_max"]
-        if omit_non_generalizing_sessions:
-            sessions_to_omit = omit_sessions_by_subject[subject_id]
-        else:
-            sessions_to_omit = []
-
-        logger.custom_info(f"Processing subject {subject_id}.\n \n \n")
-
+def get_subject_settings(subject_id:str) -> dict:
+    """
+    Timepoint window and omitted sessions of a subject.
+    """
+    subject_settings = {"timepoint_min": timepoint_min, "timepoint_max": timepoint_max, "sessions_to_omit": []}
+    if use_best_timepoints_for_subject:
+        subject_settings["timepoint_min"] = best_timepoints_by_subject[lock_event][subject_id]["timepoint_min"]
+        subject_settings["timepoint_max"] = best_timepoints_by_subject[lock_event][subject_id]["timepoint_max"]
+    if omit_non_generalizing_sessions:
+        subject_settings["sessions_to_omit"] = omit_sessions_by_subject[subject_id]
+
+    return subject_settings
+
+
+def create_stage_cache(subject_id:str) -> StageCache:
+    """
+    Stage cache of a subject with the settings that define the artifacts of each stage (upstream artifacts are tracked by the stage cache).
+    """
+    subject_settings = get_subject_settings(subject_id)
+    # Newly discovered sessions invalidate the metadata and meg dataset and thereby all downstream stages
+    session_ids_char = BasicOperationsHelper(subject_id=subject_id, lock_event=lock_event).session_ids_char
+    stage_configs = {"metadata": {"crop_size": crop_size, "session_ids_char": session_ids_char},
+                     "train_test_split": {"split_random_seed": split_random_seed},
+                     "crop_dataset": {"crop_size": crop_size},
+                     "meg_dataset": {"normalizations": normalizations, "chosen_channels": meg_channels, "timepoint_min": subject_settings["timepoint_min"], "timepoint_max": subject_settings["timepoint_max"], 
+                                     "use_ica_cleaned_data": use_ica_cleaned_data, "interpolate_outliers": interpolate_outliers, "clip_outliers": clip_outliers, "session_ids_char": session_ids_char},
+                     "features": {"ann_model": ann_model, "module_name": module_name},
+                     "feature_reduction": {"feature_reducer": feature_reducer, "pca_components": pca_components, "pca_basis": pca_basis, "pca_reference_session": pca_reference_session, "pca_solver": pca_solver, 
+                                           "z_score_features_before_pca": z_score_features_before_pca, "all_sessions_combined": all_sessions_combined, "random_projection_components": random_projection_components, 
+                                           "feature_map_shape": feature_map_shape, "pooled_size": pooled_size, "spatial_pooling_type": spatial_pooling_type},
+                     "pca_sweep_features": {"max_components": max(pca_sweep_components), "pca_solver": pca_solver, "z_score_features_before_pca": z_score_features_before_pca},
+                     "GLM_training": {"alphas": alphas, "fractional_ridge": fractional_ridge, "fractional_grid": fractional_grid, "batched_fractional_ridge": batched_fractional_ridge, "ridge_form": ridge_form, 
+                                      "ridge_solver": ridge_solver, "use_pca_features": use_pca_features, "all_sessions_combined": all_sessions_combined, "shuffle_train_labels": shuffle_train_labels, "downscale_features": downscale_features},
+                     "GLM_cross_validation": {"n_cv_folds": n_cv_folds, "cv_random_seed": cv_random_seed, "alphas": alphas, "use_pca_features": use_pca_features, "downscale_features": downscale_features},
+                     "pca_sweep": {"pca_sweep_components": pca_sweep_components, "alphas": alphas, "fractional_ridge": fractional_ridge, "fractional_grid": fractional_grid, "shuffle_train_labels": shuffle_train_labels},
+                     "permutation_test": {"n_permutations": n_permutations, "alphas": alphas, "fractional_ridge": fractional_ridge, "use_pca_features": use_pca_features},
+                     "temporal_generalization": {"downscale_features": downscale_features},
+                     "GLM_predictions": {"fit_measure_storage_distinction": fit_measure_storage_distinction, "all_sessions_combined": all_sessions_combined, "shuffle_test_labels": shuffle_test_labels, "downscale_features": downscale_features},
+                     "drift_bootstrap": {"n_bootstrap": n_bootstrap, "drift_bootstrap_resample": drift_bootstrap_resample, "omitted_sessions": subject_settings["sessions_to_omit"], "subtract_self_pred": subtract_self_pred, "include_0_distance": drift_include_0_distance},
+                     }
+    requested_stages_by_flags = {"metadata": create_metadata, "train_test_split": create_train_test_split, "crop_dataset": create_crop_datset_numpy, "meg_dataset": create_meg_dataset, 
+                                 "features": extract_features, "feature_reduction": perform_pca, "pca_sweep_features": perform_pca_sweep, "pca_sweep": perform_pca_sweep, "GLM_training": train_GLM, "GLM_cross_validation": cross_validate_GLM, 
+                                 "temporal_generalization": compute_temporal_generalization, "permutation_test": perform_permutation_test, "GLM_predictions": generate_predictions_with_GLM, "drift_bootstrap": compute_drift_bootstrap}
+    # GLMs on raw ann_features do not depend on the feature reduction
+    stage_dependencies = {stage_name: [("features" if upstream_stage == "feature_reduction" and not use_pca_features else upstream_stage) for upstream_stage in upstream_stages] 
+                            for stage_name, upstream_stages in StageCache.stage_dependencies.items()}
+
+    return StageCache(subject_id=subject_id, lock_event=lock_event, stage_configs=stage_configs, requested_stages=[stage_name for stage_name, requested in requested_stages_by_flags.items() if requested], 
+                      use_stage_cache=use_stage_cache, force_stages=force_stages, adopt_existing_artifacts=adopt_existing_artifacts, stage_dependencies=stage_dependencies, 
+                      artifacts_exist=lambda stage_name: stage_artifacts_exist(stage_name=stage_name, subject_id=subject_id))
+
+
+def stage_artifacts_exist(stage_name:str, subject_id:str) -> bool:
+    """
+    True if the outputs of a stage exist for all sessions of a subject (stages without record are only adopted if they do). 
+    Analysis stages downstream of the GLMs are never adopted.
+    """
+    glm_helper = GLMHelper(**get_helper_kwargs("GLMHelper", subject_id))
+    split_contents = []
+    file_paths = []
+    match stage_name:
+        case "metadata":
+            file_paths = [f"data_files/{lock_event}/metadata/{type_of_content}/subject_{subject_id}/{type_of_content}_dict.json" for type_of_content in ["crop_metadata", "meg_metadata", "combined_metadata"]]
+        case "train_test_split":
+            split_contents = [("trial_splits", None)]
+        case "crop_dataset":
+            split_contents = [("crop_data", None)]
+        case "meg_dataset":
+            split_contents = [("meg_data", normalization) for normalization in normalizations]
+        case "features":
+            split_contents = [("ann_features", None)]
+        case "feature_reduction":
+            if feature_reducer == "random_projection":
+                split_contents = [("ann_features_random_projection", None)]
+            elif feature_reducer == "spatial_pooling":
+                split_contents = [("ann_features_pooled", None)]
+            elif pca_basis != "per_session":
+                split_contents = [("ann_features_pca_shared", None)]
+            else:
+                split_contents = [("ann_features_pca_all_sessions_combined" if all_sessions_combined else "ann_features_pca", None)]
+        case "pca_sweep_features":
+            split_contents = [("ann_features_pca_sweep", None)]
+        case "GLM_training":
+            model_folders = [glm_helper.get_GLM_model_folder(normalization=normalization, all_sessions_combined=True) for normalization in normalizations] if all_sessions_combined else \
+                            [glm_helper.get_GLM_model_folder(normalization=normalization, session_id_num=session_id) for normalization in normalizations for session_id in glm_helper.session_ids_num]
+            return all(os.path.exists(os.path.join(model_folder, "GLM_models.h5")) or os.path.exists(os.path.join(model_folder, "GLM_models.pkl")) for model_folder in model_folders)
+        case _:
+            return False
+
+    split_paths = [glm_helper.get_split_data_path(session_id_num=session_id, type_of_content=type_of_content, split=split, type_of_norm=normalization, ann_model=ann_model, module=module_name)
+                   for type_of_content, normalization in split_contents for session_id in glm_helper.session_ids_num for split in ["train", "test"]]
+
+    return all(os.path.exists(file_path) for file_path in file_paths) and all(glm_helper.split_data_exists(split_path=split_path) for split_path in split_paths)
+
+
+def get_helper_kwargs(helper_name:str, subject_id:str) -> dict:
+    """
+    Arguments of the helpers used by the pipeline stages of a subject.
+    """
+    subject_settings = get_subject_settings(subject_id)
+    match helper_name:
+        case "DatasetHelper":
+            return {"subject_id": subject_id, "normalizations": normalizations, "chosen_channels": meg_channels, "lock_event": lock_event, "timepoint_min": subject_settings["timepoint_min"], "timepoint_max": subject_settings["timepoint_max"], "crop_size": crop_size}
+        case "ExtractionHelper":
+            return {"subject_id": subject_id, "pca_components": pca_components, "ann_model": ann_model, "module_name": module_name, "batch_size": batch_size, "lock_event": lock_event}
+        case "GLMHelper":
+            return {"fractional_ridge": fractional_ridge, "fractional_grid": fractional_grid, "normalizations": normalizations, "subject_id": subject_id, "chosen_channels": meg_channels, "alphas": alphas, "timepoint_min": subject_settings["timepoint_min"], 
+                    "timepoint_max": subject_settings["timepoint_max"], "pca_features": use_pca_features, "pca_basis": pca_basis, "feature_reducer": feature_reducer, "ridge_solver": ridge_solver, "batched_fractional_ridge": batched_fractional_ridge, 
+                    "ridge_form": ridge_form, "pca_components": pca_components, "lock_event": lock_event, "ann_model": ann_model, "module_name": module_name, "batch_size": batch_size, "crop_size": crop_size}
+        case _:
+            raise ValueError(f"get_helper_kwargs called with unknown helper {helper_name}")
+
+
+@StageMetrics.measure
+def run_stage(stage_name:str, subject_id:str, n_cpus:int = None) -> None:
+    """
+    Runs a single pipeline stage of a subject. n_cpus: cpus reserved for the stage by the PipelineRunner, the worker pools of the stage are capped at it.
+    """
+    subject_settings = get_subject_settings(subject_id)
+    subject_timepoint_min, subject_timepoint_max = subject_settings["timepoint_min"], subject_settings["timepoint_max"]
+    resume = resume_sessions and stage_name not in force_stages
+    stage_extraction_workers, stage_prediction_workers, stage_prediction_blas_threads = extraction_num_workers, prediction_num_workers, prediction_blas_threads
+    if n_cpus is not None:
+        stage_extraction_workers = min(extraction_num_workers, n_cpus)
+        stage_prediction_workers = max(1, min(prediction_num_workers, n_cpus))
+        max_blas_threads = max(1, n_cpus // stage_prediction_workers)
+        stage_prediction_blas_threads = max_blas_threads if prediction_blas_threads is None else min(prediction_blas_threads, max_blas_threads)
+
+    match stage_name:
         ##### Process metadata for subject #####
-        if create_metadata:
+        case "metadata":
             metadata_helper = MetadataHelper(crop_size=crop_size, subject_id=subject_id, lock_event=lock_event)
 
             # Read metadata of all available crops/images
@@ -143,96 +360,369 @@ for run in range(run_pipeline_n_times):
             logger.custom_info("Metadata created.\n \n")
 
         ##### Create crop and meg dataset based on metadata #####
-        if create_train_test_split or create_crop_datset_numpy or create_meg_dataset:
-            dataset_helper = DatasetHelper(subject_id=subject_id, normalizations=normalizations, chosen_channels=meg_channels, lock_event=lock_event, timepoint_min=timepoint_min, timepoint_max=timepoint_max, crop_size=crop_size)
+        case "train_test_split" | "crop_dataset" | "meg_dataset":
+            dataset_helper = DatasetHelper(**get_helper_kwargs("DatasetHelper", subject_id))
 
-            if create_train_test_split:
+            if stage_name == "train_test_split":
                 # Create train/test split based on sceneIDs (based on trial_ids)
-                dataset_helper.create_train_test_split(debugging=debugging)
+                dataset_helper.create_train_test_split(debugging=debugging, random_seed=split_random_seed)
 
                 logger.custom_info("Train/Test split created. \n \n")
 
-            if create_crop_datset_numpy:
+            elif stage_name == "crop_dataset":
                 # Create crop dataset with images as numpy arrays
                 dataset_helper.create_crop_dataset(debugging=debugging)
 
                 logger.custom_info("Numpy crop datasets created. \n \n")
 
-            if create_meg_dataset:
+            else:
                 # Create meg dataset based on split
-                dataset_helper.create_meg_dataset(use_ica_cleaned_data=use_ica_cleaned_data, interpolate_outliers=interpolate_outliers, clip_outliers=clip_outliers)
+                dataset_helper.create_meg_dataset(use_ica_cleaned_data=use_ica_cleaned_data, interpolate_outliers=interpolate_outliers, clip_outliers=clip_outliers, resume=resume)
 
                 logger.custom_info("MEG datasets created. \n \n")
 
-
         ##### Extract features from crops and perform pca #####
-        if extract_features or perform_pca:
-            extraction_helper = ExtractionHelper(subject_id=subject_id, pca_components=pca_components, ann_model=ann_model, module_name=module_name, batch_size=batch_size, lock_event=lock_event)
+        case "features" | "feature_reduction" | "pca_sweep_features":
+            extraction_helper = ExtractionHelper(**get_helper_kwargs("ExtractionHelper", subject_id))
 
-            if extract_features:
-                extraction_helper.extract_features()
+            if stage_name == "features":
+                extraction_helper.extract_features(num_workers=stage_extraction_workers, use_feature_cache=use_feature_cache, resume=resume)
                 logger.custom_info("Features extracted. \n \n")
 
-            if perform_pca:
-                extraction_helper.reduce_feature_dimensionality(z_score_features_before_pca=z_score_features_before_pca, all_sessions_combined=all_sessions_combined)
-                logger.custom_info("PCA applied to features. \n \n")
-            
+            elif stage_name == "feature_reduction":
+                if feature_reducer == "random_projection":
+                    extraction_helper.reduce_feature_dimensionality_random_projection(n_components=random_projection_components, chunk_size=pca_batch_size)
+                elif feature_reducer == "spatial_pooling":
+                    extraction_helper.reduce_feature_dimensionality_spatial_pooling(feature_map_shape=feature_map_shape, pooled_size=pooled_size, pooling_type=spatial_pooling_type, chunk_size=pca_batch_size)
+                elif pca_basis == "per_session":
+                    extraction_helper.reduce_feature_dimensionality(z_score_features_before_pca=z_score_features_before_pca, all_sessions_combined=all_sessions_combined, pca_solver=pca_solver, pca_batch_size=pca_batch_size)
+                else:
+                    extraction_helper.create_shared_basis_pca_features(pca_basis=pca_basis, reference_session_id=pca_reference_session, z_score_features_before_pca=z_score_features_before_pca, pca_solver=pca_solver, pca_batch_size=pca_batch_size)
+                logger.custom_info(f"Feature dimensionality reduced ({feature_reducer}). \n \n")
+
+            else:
+                extraction_helper.create_pca_sweep_features(max_components=max(pca_sweep_components), z_score_features_before_pca=z_score_features_before_pca, pca_solver=pca_solver, pca_batch_size=pca_batch_size)
+                logger.custom_info("PCA sweep features created. \n \n")
 
         ##### Train GLM from features to meg #####
-        if train_GLM or generate_predictions_with_GLM:
-            glm_helper = GLMHelper(fractional_ridge=fractional_ridge, fractional_grid=fractional_grid, normalizations=normalizations, subject_id=subject_id, chosen_channels=meg_channels, alphas=alphas, timepoint_min=timepoint_min, timepoint_max=timepoint_max, pca_features=use_pca_features, pca_components=pca_components, lock_event=lock_event, ann_model=ann_model, module_name=module_name, batch_size=batch_size, crop_size=crop_size)
+        case "GLM_training" | "GLM_cross_validation" | "pca_sweep" | "temporal_generalization" | "permutation_test" | "GLM_predictions":
+            glm_helper = GLMHelper(**get_helper_kwargs("GLMHelper", subject_id))
 
-            if train_GLM:
-                glm_helper.train_mapping(all_sessions_combined=all_sessions_combined, shuffle_train_labels=shuffle_train_labels, downscale_features=downscale_features)
+            if stage_name == "GLM_training":
+                glm_helper.train_mapping(all_sessions_combined=all_sessions_combined, shuffle_train_labels=shuffle_train_labels, downscale_features=downscale_features, incremental=incremental_GLM, resume=resume)
 
                 logger.custom_info("GLMs trained. \n \n")
 
-            # Generate meg predictions 
-            if generate_predictions_with_GLM:
-                glm_helper.predict_from_mapping(fit_measure_storage_distinction=fit_measure_storage_distinction, predict_train_data=False, all_sessions_combined=all_sessions_combined, shuffle_test_labels=shuffle_test_labels, downscale_features=downscale_features)
-                #glm_helper.predict_from_mapping(fit_measure_storage_distinction=fit_measure_storage_distinction, predict_train_data=True, all_sessions_combined=all_sessions_combined, shuffle_test_labels=shuffle_test_labels, downscale_features=downscale_features)
-                glm_helper.predict_from_mapping(fit_measure_storage_distinction="timepoint_sensor_level", predict_train_data=False, all_sessions_combined=all_sessions_combined, shuffle_test_labels=shuffle_test_labels, downscale_features=downscale_features)
-                glm_helper.predict_from_mapping(fit_measure_storage_distinction="timepoint_level", predict_train_data=False, all_sessions_combined=all_sessions_combined, shuffle_test_labels=shuffle_test_labels, downscale_features=downscale_features)
-                #glm_helper.predict_from_mapping(fit_measure_storage_distinction="timepoint_sensor_level", predict_train_data=False, all_sessions_combined=all_sessions_combined, shuffle_test_labels=shuffle_test_labels, downscale_features=downscale_features)
+            elif stage_name == "GLM_cross_validation":
+                glm_helper.evaluate_cross_validated(n_folds=n_cv_folds, random_seed=cv_random_seed, downscale_features=downscale_features)
 
+                logger.custom_info("Cross-validated GLMs evaluated. \n \n")
 
-                logger.custom_info("Predictions generated. \n \n")
+            elif stage_name == "pca_sweep":
+                glm_helper.evaluate_pca_component_sweep(component_counts=pca_sweep_components, shuffle_train_labels=shuffle_train_labels)
 
-        ##### Visualization #####
-        if visualization:
-            visualization_helper = VisualizationHelper(normalizations=normalizations, subject_id=subject_id, chosen_channels=meg_channels, lock_event=lock_event, alphas=alphas, timepoint_min=timepoint_min, timepoint_max=timepoint_max, pca_features=use_pca_features, pca_components=pca_components, ann_model=ann_model, module_name=module_name, batch_size=batch_size, n_grad=n_grad, n_mag=n_mag, crop_size=crop_size, fractional_ridge=fractional_ridge, fractional_grid=fractional_grid, time_window_n_indices=time_window_n_indices)
+                logger.custom_info("PCA component sweep evaluated. \n \n")
 
-            # Visualize meg data with mne
-            #visualization_helper.visualize_meg_epochs_mne()
+            elif stage_name == "temporal_generalization":
+                glm_helper.calculate_temporal_generalization(downscale_features=downscale_features)
 
-            # Visualize meg data ERP style
-            #visualization_helper.visualize_meg_ERP_style(plot_norms=["no_norm", "mean_centered_ch_t"])  # ,"robust_scaling_ch_t", "z_score_ch_t", "robust_scaling", "z_score"
+                logger.custom_info("Temporal generalization calculated. \n \n")
 
-            # Visualize encoding model performance
-            ###visualization_helper.visualize_self_prediction(var_explained=True, pred_splits=["train","test"], all_sessions_combined=all_sessions_combined)
-            ##visualization_helper.visualize_self_prediction(var_explained=True, pred_splits=["test"], all_sessions_combined=all_sessions_combined)
+            elif stage_name == "permutation_test":
+                glm_helper.run_permutation_test(n_permutations=n_permutations, permutation_batch_size=permutation_batch_size)
 
-            # Visualize prediction results
-            #visualization_helper.visualize_GLM_results(by_timepoints=False, only_distance=False, omit_sessions=[], separate_plots=True)
-            #visualization_helper.visualize_GLM_results(only_distance=True, omit_sessions=sessions_to_omit)
-            ###visualization_helper.visualize_GLM_results(only_distance=True, omit_sessions=[], var_explained=True)
-            ####visualization_helper.visualize_GLM_results(fit_measure_type="var_explained_sensors_timepoint", by_timepoints=True, separate_plots=True)
-            ####visualization_helper.visualize_GLM_results(fit_measure_type="var_explained_timepoint", by_timepoints=True, separate_plots=True)
-            #visualization_helper.visualize_GLM_results(only_distance=True, omit_sessions=["4","10"], var_explained=False)
+                logger.custom_info("Permutation test completed. \n \n")
+
+            # Generate meg predictions 
+            else:
+                for storage_distinction in prediction_storage_distinctions:
+                    glm_helper.predict_from_mapping(fit_measure_storage_distinction=storage_distinction, predict_train_data=False, all_sessions_combined=all_sessions_combined, shuffle_test_labels=shuffle_test_labels, downscale_features=downscale_features, incremental=incremental_GLM, n_workers=stage_prediction_workers, blas_threads_per_worker=stage_prediction_blas_threads)
+                #glm_helper.predict_from_mapping(fit_measure_storage_distinction=fit_measure_storage_distinction, predict_train_data=True, all_sessions_combined=all_sessions_combined, shuffle_test_labels=shuffle_test_labels, downscale_features=downscale_features)
+                #glm_helper.predict_from_mapping(fit_measure_storage_distinction="timepoint_sensor_level", predict_train_data=False, all_sessions_combined=all_sessions_combined, shuffle_test_labels=shuffle_test_labels, downscale_features=downscale_features)
+                if all_sessions_combined and ridge_solver == "sufficient_statistics":
+                    glm_helper.predict_from_leave_one_session_out_mapping(predict_train_data=False, downscale_features=downscale_features)
 
-            # Visuzalize distance based predictions at timepoint scale
-            ##visualization_helper.three_dim_timepoint_predictions(subtract_self_pred=subtract_self_pred) 
-            ####visualization_helper.timepoint_window_drift(subtract_self_pred=subtract_self_pred, omitted_sessions=sessions_to_omit, all_windows_one_plot=all_windows_one_plot, sensor_level=False, include_0_distance=True)  
-            ####visualization_helper.timepoint_window_drift(subtract_self_pred=subtract_self_pred, omitted_sessions=sessions_to_omit, all_windows_one_plot=all_windows_one_plot, sensor_level=True, include_0_distance=True)  
-            
-            # Visualize drift topographically with mne based on sensor level data 
-            visualization_helper.mne_topo_plot_per_sensor(data_type="drift", omitted_sessions=sessions_to_omit, all_timepoints_combined=False)  # data_type="self-pred" or "drift"
 
-            # Visualize model perspective (values by timepoint)
-            ##visualization_helper.new_visualize_model_perspective(plot_norms=["mean_centered_ch_then_global_robust_scaling"], seperate_plots=False)  # , "no_norm"
+                logger.custom_info("Predictions generated. \n \n")
 
-            logger.custom_info("Visualization completed. \n \n")
-            
+        # Bootstrap drift slopes and correlations, bands are drawn in timepoint_window_drift with bootstrap_resample
+        case "drift_bootstrap":
+            visualization_helper = VisualizationHelper(normalizations=normalizations, subject_id=subject_id, chosen_channels=meg_channels, lock_event=lock_event, alphas=alphas, timepoint_min=subject_timepoint_min, timepoint_max=subject_timepoint_max, pca_features=use_pca_features, pca_components=pca_components, ann_model=ann_model, module_name=module_name, batch_size=batch_size, n_grad=n_grad, n_mag=n_mag, crop_size=crop_size, fractional_ridge=fractional_ridge, fractional_grid=fractional_grid, time_window_n_indices=time_window_n_indices)
+            visualization_helper.bootstrap_drift_confidence_intervals(n_bootstrap=n_bootstrap, resample=drift_bootstrap_resample, omitted_sessions=subject_settings["sessions_to_omit"], subtract_self_pred=subtract_self_pred, include_0_distance=drift_include_0_distance)
+
+            logger.custom_info("Drift bootstrap completed. \n \n")
+
+        case _:
+            raise ValueError(f"run_stage called with unknown stage {stage_name}")
+
+
+def run_stage_with_work_queue(stage_name:str, stage_subject_ids:list, work_queue:WorkQueue, local_workers:list = []) -> dict:
+    """
+    Runs a stage for several subjects as work queue tasks, one per session (and normalization), waits for the workers and merges their results into the usual artifacts.
+    Returns the usage of every subject: the summed duration of its tasks and its merge, and the largest peak rss increase of them ({subject_id: {"duration_s": ..., "peak_rss_gb": ...}}).
+    """
+    resume = resume_sessions and stage_name not in force_stages
+    stage_task_ids = {subject_id: {} for subject_id in stage_subject_ids}
+    for subject_id in stage_subject_ids:
+        session_ids = BasicOperationsHelper(subject_id=subject_id, lock_event=lock_event).session_ids_num
+        for session_id in session_ids:
+            match stage_name:
+                case "meg_dataset":
+                    # The normalization across sessions is done once all sessions are created
+                    for normalization in normalizations:
+                        task_id = work_queue.submit(stage=stage_name, subject_id=subject_id, session_id=session_id, normalization=normalization, helper="DatasetHelper", helper_kwargs=get_helper_kwargs("DatasetHelper", subject_id), method="create_meg_dataset", 
+                                                    method_kwargs={"use_ica_cleaned_data": use_ica_cleaned_data, "interpolate_outliers": interpolate_outliers, "clip_outliers": clip_outliers, "resume": resume, "normalize_across_sessions": False})
+                        stage_task_ids[subject_id][task_id] = session_id
+                case "features":
+                    task_id = work_queue.submit(stage=stage_name, subject_id=subject_id, session_id=session_id, helper="ExtractionHelper", helper_kwargs=get_helper_kwargs("ExtractionHelper", subject_id), method="extract_features", 
+                                                method_kwargs={"num_workers": extraction_num_workers, "use_feature_cache": use_feature_cache, "resume": resume})
+                    stage_task_ids[subject_id][task_id] = session_id
+                case "GLM_training":
+                    for normalization in normalizations:
+                        task_id = work_queue.submit(stage=stage_name, subject_id=subject_id, session_id=session_id, normalization=normalization, helper="GLMHelper", helper_kwargs=get_helper_kwargs("GLMHelper", subject_id), method="train_mapping", 
+                                                    method_kwargs={"all_sessions_combined": False, "shuffle_train_labels": shuffle_train_labels, "downscale_features": downscale_features, "incremental": incremental_GLM, "resume": resume})
+                        stage_task_ids[subject_id][task_id] = session_id
+                case "GLM_predictions":
+                    # Models of one session evaluated on all sessions
+                    for normalization in normalizations:
+                        task_id = work_queue.submit(stage=stage_name, subject_id=subject_id, session_id=session_id, normalization=normalization, restrict_to_session=False, helper="GLMHelper", helper_kwargs=get_helper_kwargs("GLMHelper", subject_id), method="evaluate_model_session", 
+                                                    method_kwargs={"session_id_model": session_id, "fit_measure_storage_distinctions": prediction_storage_distinctions, "predict_train_data": False, "shuffle_test_labels": shuffle_test_labels, "downscale_features": downscale_features})
+                        stage_task_ids[subject_id][task_id] = session_id
+                case _:
+                    raise ValueError(f"run_stage_with_work_queue called with stage {stage_name} that has no work queue tasks")
+    logger.custom_info(f"Submitted {sum(len(task_ids) for task_ids in stage_task_ids.values())} tasks of stage {stage_name} to the work queue.")
+
+    task_results = work_queue.wait_for_tasks([task_id for task_ids in stage_task_ids.values() for task_id in task_ids], local_workers=local_workers, 
+                                             timeout=work_queue_timeout_h * 3600 if work_queue_timeout_h is not None else None)
+
+    stage_usage = {}
+    for subject_id in stage_subject_ids:
+        with StageMetrics.track_run() as merge_usage:
+            merge_work_queue_results(stage_name=stage_name, subject_id=subject_id, subject_task_ids=stage_task_ids[subject_id], task_results=task_results)
+        subject_task_metrics = [work_queue.task_metrics[task_id] for task_id in stage_task_ids[subject_id]]
+        stage_usage[subject_id] = {"duration_s": merge_usage["duration_s"] + sum(task_metrics["duration_s"] for task_metrics in subject_task_metrics),
+                                   "peak_rss_gb": max([merge_usage["peak_rss_gb"]] + [task_metrics["peak_rss_gb"] for task_metrics in subject_task_metrics if task_metrics["peak_rss_gb"] is not None])}
+        logger.custom_info(f"[Subject {subject_id}] Stage {stage_name} completed by the work queue.")
+
+    return stage_usage
+
+
+def merge_work_queue_results(stage_name:str, subject_id:str, subject_task_ids:dict, task_results:dict) -> None:
+    """
+    Completes a work queue stage of a subject in the coordinator, e.g. the normalization across sessions or the cross-session prediction results from the rows of all model sessions.
+    """
+    if stage_name == "meg_dataset":
+        DatasetHelper(**get_helper_kwargs("DatasetHelper", subject_id)).normalize_meg_dataset_across_sessions(interpolate_outliers=interpolate_outliers, clip_outliers=clip_outliers)
+    elif stage_name == "GLM_predictions":
+        # Rows of all model sessions -> {storage_distinction: {normalization: {(session_id_model, session_id_pred): fit_measures}}}
+        published_fit_measures = {storage_distinction: defaultdict(dict) for storage_distinction in prediction_storage_distinctions}
+        for task_id, session_id_model in subject_task_ids.items():
+            for normalization, fit_measures_by_distinction in task_results[task_id].items():
+                for storage_distinction, fit_measures_by_pred_session in fit_measures_by_distinction.items():
+                    for session_id_pred, fit_measures in fit_measures_by_pred_session.items():
+                        published_fit_measures[storage_distinction][normalization][(session_id_model, session_id_pred)] = fit_measures
+        glm_helper = GLMHelper(**get_helper_kwargs("GLMHelper", subject_id))
+        for storage_distinction in prediction_storage_distinctions:
+            glm_helper.predict_from_mapping(fit_measure_storage_distinction=storage_distinction, predict_train_data=False, shuffle_test_labels=shuffle_test_labels, downscale_features=downscale_features, incremental=incremental_GLM, 
+                                            published_fit_measures=published_fit_measures[storage_distinction])
+
+
+@StageMetrics.measure
+def run_visualization(subject_id:str) -> None:
+    subject_settings = get_subject_settings(subject_id)
+    sessions_to_omit = subject_settings["sessions_to_omit"]
+
+    ##### Visualization #####
+    visualization_helper = VisualizationHelper(normalizations=normalizations, subject_id=subject_id, chosen_channels=meg_channels, lock_event=lock_event, alphas=alphas, timepoint_min=subject_settings["timepoint_min"], timepoint_max=subject_settings["timepoint_max"], pca_features=use_pca_features, pca_components=pca_components, ann_model=ann_model, module_name=module_name, batch_size=batch_size, n_grad=n_grad, n_mag=n_mag, crop_size=crop_size, fractional_ridge=fractional_ridge, fractional_grid=fractional_grid, time_window_n_indices=time_window_n_indices, 
+                                               fit_measure_variant=f"cv_{n_cv_folds}" if visualize_cross_validated_results else None)
+
+    # Visualize meg data with mne
+    #visualization_helper.visualize_meg_epochs_mne()
+
+    # Visualize meg data ERP style
+    #visualization_helper.visualize_meg_ERP_style(plot_norms=["no_norm", "mean_centered_ch_t"])  # ,"robust_scaling_ch_t", "z_score_ch_t", "robust_scaling", "z_score"
+
+    # Visualize encoding model performance
+    ###visualization_helper.visualize_self_prediction(var_explained=True, pred_splits=["train","test"], all_sessions_combined=all_sessions_combined)
+    ##visualization_helper.visualize_self_prediction(var_explained=True, pred_splits=["test"], all_sessions_combined=all_sessions_combined)
+
+    # Visualize prediction results
+    #visualization_helper.visualize_GLM_results(by_timepoints=False, only_distance=False, omit_sessions=[], separate_plots=True)
+    #visualization_helper.visualize_GLM_results(only_distance=True, omit_sessions=sessions_to_omit)
+    ###visualization_helper.visualize_GLM_results(only_distance=True, omit_sessions=[], var_explained=True)
+    ####visualization_helper.visualize_GLM_results(fit_measure_type="var_explained_sensors_timepoint", by_timepoints=True, separate_plots=True)
+    ####visualization_helper.visualize_GLM_results(fit_measure_type="var_explained_timepoint", by_timepoints=True, separate_plots=True)
+    #visualization_helper.visualize_GLM_results(only_distance=True, omit_sessions=["4","10"], var_explained=False)
+
+    # Visuzalize distance based predictions at timepoint scale
+    ##visualization_helper.three_dim_timepoint_predictions(subtract_self_pred=subtract_self_pred) 
+    ####visualization_helper.timepoint_window_drift(subtract_self_pred=subtract_self_pred, omitted_sessions=sessions_to_omit, all_windows_one_plot=all_windows_one_plot, sensor_level=False, include_0_distance=drift_include_0_distance)  
+    ####visualization_helper.timepoint_window_drift(subtract_self_pred=subtract_self_pred, omitted_sessions=sessions_to_omit, all_windows_one_plot=all_windows_one_plot, sensor_level=True, include_0_distance=drift_include_0_distance)  
+    
+    # Visualize temporal generalization matrices (train timepoint x test timepoint)
+    if compute_temporal_generalization:
+        visualization_helper.visualize_temporal_generalization(fit_measure="var_explained", omitted_sessions=sessions_to_omit)
+
+    # Visualize drift topographically with mne based on sensor level data 
+    visualization_helper.mne_topo_plot_per_sensor(data_type="drift", omitted_sessions=sessions_to_omit, all_timepoints_combined=False)  # data_type="self-pred" or "drift"
+
+    # Visualize model perspective (values by timepoint)
+    ##visualization_helper.new_visualize_model_perspective(plot_norms=["mean_centered_ch_then_global_robust_scaling"], seperate_plots=False)  # , "no_norm"
+
+    logger.custom_info("Visualization completed. \n \n")
+
+
+def apply_sweep_configuration(sweep_configuration:dict) -> None:
+    """
+    Sets the parameters of a sweep configuration as the settings of this file.
+    """
+    globals().update(sweep_configuration)
+    if "mag_channels" in sweep_configuration:
+        globals()["n_mag"] = len(sweep_configuration["mag_channels"])
+        globals()["meg_channels"] = np.array(sweep_configuration["mag_channels"] + grad_channels)
+    if "timepoint_min" in sweep_configuration or "timepoint_max" in sweep_configuration:
+        globals()["use_best_timepoints_for_subject"] = False
+    logger.custom_info(f"Sweep configuration: {sweep_configuration}")
+
+
+def collect_sweep_results(sweep_configuration:dict, stage_caches:dict) -> list:
+    """
+    Reads the session level fit measures of the current configuration as rows (one per subject, normalization and session pair).
+    Subjects whose GLM predictions have no record matching the configuration (not requested, failed or deferred) are skipped, their result files belong to another configuration.
+    """
+    sweep_results = []
+    for subject_id in subject_ids:
+        stage_cache = stage_caches[subject_id]
+        predictions_record = stage_cache.read_stage_record("GLM_predictions")
+        if predictions_record is None or predictions_record["stage_hash"] != stage_cache.get_stage_hash("GLM_predictions"):
+            logger.warning(f"[Subject {subject_id}] GLM predictions did not complete for configuration {sweep_configuration}, no sweep results collected.")
+            continue
+        for normalization in normalizations:
+            fit_measures = {}
+            for fit_measure, fit_measure_path in {"var_explained": f"data_files/{lock_event}/var_explained/{ann_model}/{module_name}/subject_{subject_id}/norm_{normalization}/predict_train_data_False/var_explained_{normalization}_dict.json", 
+                                                  "mse": f"data_files/{lock_event}/mse_losses/{ann_model}/{module_name}/subject_{subject_id}/norm_{normalization}/mse_losses_{normalization}_dict.json"}.items():
+                if not os.path.exists(fit_measure_path):
+                    logger.warning(f"[Subject {subject_id}] No {fit_measure} results for configuration {sweep_configuration} at {fit_measure_path}.")
+                    continue
+                with open(fit_measure_path, 'r') as file:
+                    fit_measures[fit_measure] = json.load(file)["session_mapping"]
+            if "var_explained" not in fit_measures:
+                continue
+            for session_id_train, session_preds in fit_measures["var_explained"].items():
+                for session_id_pred, var_explained in session_preds["session_pred"].items():
+                    mse = fit_measures["mse"][session_id_train]["session_pred"].get(session_id_pred) if "mse" in fit_measures else None
+                    sweep_results.append({**{parameter: str(value) if isinstance(value, (list, np.ndarray)) else value for parameter, value in sweep_configuration.items()}, 
+                                          "subject_id": subject_id, "normalization": normalization, "session_train": session_id_train, "session_pred": session_id_pred, "var_explained": var_explained, "mse": mse})
+
+    return sweep_results
+
+
+if "normalizations" in sweep_grid:
+    raise ValueError("normalizations can not be swept, all normalizations are processed in every configuration.")
+sweep_stage_caches = [create_stage_cache(subject_id) for subject_id in subject_ids]
+sweep_planned_stages = set().union(*[stage_cache.planned_stages for stage_cache in sweep_stage_caches])
+# Recorded durations of the last runs weight the stages when ordering the configurations
+sweep_stage_costs = {stage_name: stage_record["duration_s"] for stage_name in sweep_planned_stages 
+                        if (stage_record := sweep_stage_caches[0].read_stage_record(stage_name)) is not None and stage_record.get("duration_s")}
+sweep_configurations = SweepPlanner(sweep_grid=sweep_grid, parameter_stages=sweep_parameter_stages, stage_dependencies=StageCache.stage_dependencies, planned_stages=sweep_planned_stages, stage_costs=sweep_stage_costs).plan() if sweep_grid else [{}]
+if use_work_queue:
+    # Workers run in their own processes (possibly on other nodes) and apply the class-level settings of this run with each task
+    worker_settings = {"BasicOperationsHelper": {"split_storage_backend": split_storage_backend, "split_store_compression": split_store_compression, 
+                                                 "split_data_cache_max_bytes": BasicOperationsHelper.split_data_cache_max_bytes, "use_ica_cleaned_data": use_ica_cleaned_data},
+                       "StageMetrics": {"enabled": record_stage_metrics}}
+    work_queue = WorkQueue(queue_folder=work_queue_folder, worker_settings=worker_settings)
+    work_queue.clear_stop_request()
+    local_workers = work_queue.start_local_workers(n_workers=work_queue_local_workers, logger_level=logger_level)
+    # Local workers have no idle timeout, they must also be stopped if the pipeline fails
+    atexit.register(work_queue.request_stop)
+
+sweep_results = []
+for sweep_configuration in sweep_configurations:
+    if sweep_grid:
+        apply_sweep_configuration(sweep_configuration)
+
+    for run in range(run_pipeline_n_times):
+        if import_split_files_into_store:
+            for subject_id in subject_ids:
+                basic_operations_helper = BasicOperationsHelper(subject_id=subject_id, lock_event=lock_event)
+                basic_operations_helper.import_split_files_into_store(delete_files=False)
+
+            logger.custom_info("Split files imported into store.\n \n")
+
+        stage_caches = {subject_id: create_stage_cache(subject_id) for subject_id in subject_ids}
+        budget_planner = None
+        if time_budget_h is not None:
+            # Defers the stages that do not fit into the remaining time of the allocation, the next run resumes from the stage records
+            budget_planner = BudgetPlanner(stage_caches=stage_caches, lock_event=lock_event, time_budget_h=time_budget_h, max_memory_gb=memory_budget_gb, stage_resources=stage_resources, 
+                                           default_stage_duration_s=default_stage_duration_min * 60, start_time=pipeline_start)
+            budget_planner.plan()
+        if use_work_queue:
+            # Stage by stage over all subjects, so the session tasks of all subjects are distributed together
+            work_queue_stages = ["meg_dataset", "features"] + (["GLM_training", "GLM_predictions"] if not all_sessions_combined else [])
+            for stage_name in StageCache.stage_dependencies:
+                stage_subject_ids = []
+                for subject_id in subject_ids:
+                    if stage_caches[subject_id].requires_run(stage_name):
+                        if budget_planner is not None and not budget_planner.fits_remaining_budget(subject_id=subject_id, stage_name=stage_name):
+                            stage_caches[subject_id].defer_stage(stage_name)
+                            continue
+                        stage_subject_ids.append(subject_id)
+                if not stage_subject_ids:
+                    continue
+                # Duration and peak rss increase are recorded per subject
+                if stage_name in work_queue_stages:
+                    stage_usage = run_stage_with_work_queue(stage_name=stage_name, stage_subject_ids=stage_subject_ids, work_queue=work_queue, local_workers=local_workers)
+                else:
+                    stage_usage = {}
+                    for subject_id in stage_subject_ids:
+                        with StageMetrics.track_run() as subject_stage_usage:
+                            run_stage(stage_name=stage_name, subject_id=subject_id)
+                        stage_usage[subject_id] = subject_stage_usage
+                for subject_id in stage_subject_ids:
+                    stage_caches[subject_id].mark_complete(stage_name, stage_duration=stage_usage[subject_id]["duration_s"], peak_rss_gb=stage_usage[subject_id]["peak_rss_gb"])
+        elif run_stages_in_parallel:
+            # Independent stages and subjects run concurrently within the cpu and memory budget
+            pipeline_runner = PipelineRunner(stage_caches=stage_caches, stage_function=run_stage, max_cpus=pipeline_max_cpus, max_memory_gb=pipeline_max_memory_gb, stage_resources=stage_resources, report_folder=f"data_files/{lock_event}/pipeline_runs", budget_planner=budget_planner)
+            pipeline_runner.run()
+        else:
+            for subject_id in subject_ids:
+                logger.custom_info(f"Processing subject {subject_id}.\n \n \n")
+                # Stages are defined in dependency order
+                for stage_name in stage_caches[subject_id].stage_dependencies:
+                    if stage_caches[subject_id].requires_run(stage_name):
+                        if budget_planner is not None and not budget_planner.fits_remaining_budget(subject_id=subject_id, stage_name=stage_name):
+                            stage_caches[subject_id].defer_stage(stage_name)
+                            continue
+                        with StageMetrics.track_run() as stage_usage:
+                            run_stage(stage_name=stage_name, subject_id=subject_id)
+                        stage_caches[subject_id].mark_complete(stage_name, stage_duration=stage_usage["duration_s"], peak_rss_gb=stage_usage["peak_rss_gb"])
+
+        if visualization:
+            for subject_id in subject_ids:
+                run_visualization(subject_id=subject_id)
+
+    if sweep_grid:
+        sweep_results += collect_sweep_results(sweep_configuration, stage_caches=stage_caches)
+
+if sweep_grid:
+    # Tidy table of all configurations, subjects, normalizations and session pairs
+    os.makedirs(f"data_files/{lock_event}/sweeps", exist_ok=True)
+    sweep_results_path = f"data_files/{lock_event}/sweeps/sweep_results_{datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}.csv"
+    pd.DataFrame(sweep_results).to_csv(sweep_results_path, index=False)
+    logger.custom_info(f"Stored results of {len(sweep_configurations)} sweep configurations in {sweep_results_path}")
+
+if use_work_queue:
+    # Workers exit once no task is pending
+    work_queue.request_stop()
+    for local_worker in local_workers:
+        local_worker.wait()
+if split_storage_backend == "hdf5" and repack_split_stores:
+    for subject_id in subject_ids:
+        BasicOperationsHelper(subject_id=subject_id, lock_event=lock_event).repack_split_store()
+
+if record_stage_metrics:
+    StageMetrics.log_summary()
+    StageMetrics.write_report(f"data_files/{lock_event}/stage_metrics")
 
 logger.custom_info("Pipeline completed.")
 
@@ -240,4 +730,3 @@ logger.custom_info("Pipeline completed.")
 logger.warning("Using saccade for .fif file regardless of used lock_event for session date differences because files does not exist for fixations.")
 if use_ica_cleaned_data:
     logger.warning("idx to ms timepoints mapping in plots is currently based on ica cleaned metadata. Validation is required before generalizing to other data files.")
-
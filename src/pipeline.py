@@ -0,0 +1,570 @@
+import os
+import json
+import glob
+import time
+import uuid
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import numpy as np
+from typing import Tuple
+from threadpoolctl import threadpool_limits
+
+from stage_metrics import StageMetrics
+
+# Logging related
+logger = logging.getLogger(__name__)
+
+
+class StageCache:
+    """
+    Records completed pipeline stages of a subject together with a hash of their configuration and of the artifacts of their upstream stages.
+    A stage is up to date if its record matches the current hash. Changed settings of a stage or of its upstream stages therefore invalidate all downstream stages.
+    """
+    # Upstream stages of each stage of the pipeline in main.py
+    stage_dependencies = {"metadata": [],
+                          "train_test_split": ["metadata"],
+                          "crop_dataset": ["train_test_split"],
+                          "meg_dataset": ["train_test_split"],
+                          "features": ["crop_dataset"],
+                          "feature_reduction": ["features"],
+                          "pca_sweep_features": ["features"],
+                          "GLM_training": ["feature_reduction", "meg_dataset"],
+                          "GLM_cross_validation": ["feature_reduction", "meg_dataset"],
+                          "pca_sweep": ["pca_sweep_features", "meg_dataset"],
+                          "permutation_test": ["feature_reduction", "meg_dataset", "GLM_training"],
+                          "temporal_generalization": ["GLM_training"],
+                          "GLM_predictions": ["GLM_training"],
+                          "drift_bootstrap": ["GLM_training"],
+                          }
+
+    def __init__(self, subject_id:str, lock_event:str, stage_configs:dict, requested_stages:list, use_stage_cache:bool = True, force_stages:list = [], adopt_existing_artifacts:bool = False, stage_dependencies:dict = None, artifacts_exist = None):
+        self.subject_id = subject_id
+        self.lock_event = lock_event
+        self.stage_configs = stage_configs
+        self.use_stage_cache = use_stage_cache
+        self.force_stages = force_stages
+        self.adopt_existing_artifacts = adopt_existing_artifacts
+        # Callable (stage_name) -> bool, stages without record are only adopted if their artifacts exist
+        self.artifacts_exist = artifacts_exist
+        self.stage_dependencies = stage_dependencies if stage_dependencies is not None else StageCache.stage_dependencies
+        self.requested_stages = list(requested_stages)
+        self.completed_stages = set()
+
+        unknown_stages = [stage_name for stage_name in list(requested_stages) + list(force_stages) if stage_name not in self.stage_dependencies]
+        if unknown_stages:
+            raise ValueError(f"[StageCache] Unknown stages {unknown_stages}, valid stages: {list(self.stage_dependencies)}")
+
+        # Without the cache only the requested stages run, as with the stage flags alone
+        self.planned_stages = self.get_upstream_closure(requested_stages) if use_stage_cache else set(requested_stages)
+
+
+    def get_upstream_closure(self, stage_names:list) -> set:
+        """
+        Returns the given stages together with all their (transitive) upstream stages.
+        """
+        closure = set()
+        pending_stages = list(stage_names)
+        while pending_stages:
+            stage_name = pending_stages.pop()
+            if stage_name not in closure:
+                closure.add(stage_name)
+                pending_stages.extend(self.stage_dependencies[stage_name])
+
+        return closure
+
+
+    def get_stage_record_path(self, stage_name:str) -> str:
+        return f"data_files/{self.lock_event}/stage_records/subject_{self.subject_id}/{stage_name}.json"
+
+
+    def read_stage_record(self, stage_name:str) -> dict:
+        """
+        Returns the record of the last completed run of a stage, None if it never completed.
+        """
+        record_path = self.get_stage_record_path(stage_name)
+        if not os.path.exists(record_path):
+            return None
+        with open(record_path, 'r') as file:
+            return json.load(file)
+
+
+    @staticmethod
+    def serialize_config_value(value):
+        """
+        json default for config values that are not json serializable (numpy arrays and scalars).
+        """
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        return str(value)
+
+
+    def get_upstream_artifact_ids(self, stage_name:str) -> dict:
+        upstream_artifact_ids = {}
+        for upstream_stage in self.stage_dependencies[stage_name]:
+            upstream_record = self.read_stage_record(upstream_stage)
+            upstream_artifact_ids[upstream_stage] = upstream_record["artifact_id"] if upstream_record is not None else None
+
+        return upstream_artifact_ids
+
+
+    def get_stage_hash(self, stage_name:str) -> str:
+        """
+        Hash of the stage configuration and the artifact ids of the upstream stages. It is also the artifact id of the completed stage, so identical
+        configurations get identical artifact ids across runs and recomputing an upstream stage with an unchanged configuration keeps its downstream stages up to date.
+        """
+        hash_input = {"stage": stage_name,
+                      "config": self.stage_configs.get(stage_name, {}),
+                      "upstream_artifacts": self.get_upstream_artifact_ids(stage_name)}
+        hash_input_json = json.dumps(hash_input, sort_keys=True, default=StageCache.serialize_config_value)
+
+        return hashlib.sha256(hash_input_json.encode("utf-8")).hexdigest()
+
+
+    def in_plan(self, stage_name:str) -> bool:
+        """
+        True if the stage was requested or is upstream of a requested stage (it might still be skipped as up to date).
+        """
+        return stage_name in self.planned_stages
+
+
+    def requires_run(self, stage_name:str) -> bool:
+        """
+        True if a planned stage has to be (re)computed: it is forced, never completed or its record does not match the current configuration and upstream artifacts.
+        Has to be called after the upstream stages of the current run are completed.
+        """
+        if stage_name not in self.planned_stages or stage_name in self.completed_stages:
+            return False
+        if not self.use_stage_cache or stage_name in self.force_stages:
+            return True
+        # Forced stages keep their artifact id, their downstream stages are rerun explicitly
+        if self.planned_stages.intersection(self.force_stages).intersection(self.get_upstream_closure(self.stage_dependencies[stage_name])):
+            return True
+
+        stage_record = self.read_stage_record(stage_name)
+        stage_hash = self.get_stage_hash(stage_name)
+        if stage_record is None and self.can_adopt(stage_name):
+            logger.warning(f"[Subject {self.subject_id}] Adopting existing artifacts of stage {stage_name} without record for the current configuration.")
+            self.mark_complete(stage_name)
+            return False
+        if stage_record is not None and stage_record["stage_hash"] == stage_hash:
+            logger.custom_info(f"[Subject {self.subject_id}] Stage {stage_name} is up to date (hash {stage_hash[:12]}), skipping it.")
+            return False
+
+        logger.custom_info(f"[Subject {self.subject_id}] Stage {stage_name} {'has no record' if stage_record is None else 'is outdated'}, running it.")
+        return True
+
+
+    def can_adopt(self, stage_name:str) -> bool:
+        """
+        True if a stage without record may be recorded as up to date: adoption is enabled, the stage was not explicitly requested and its artifacts exist.
+        """
+        if not self.adopt_existing_artifacts or stage_name in self.requested_stages:
+            return False
+        if self.artifacts_exist is None or not self.artifacts_exist(stage_name):
+            logger.custom_debug(f"[Subject {self.subject_id}] Stage {stage_name} has no record and no existing artifacts, it cannot be adopted.")
+            return False
+
+        return True
+
+
+    def get_outdated_stages(self) -> list:
+        """
+        Planned stages that a run would (re)compute, in dependency order. Unlike requires_run nothing is logged or recorded, stages downstream of an outdated stage are outdated as well.
+        """
+        outdated_stages = []
+        for stage_name in self.stage_dependencies:
+            if stage_name not in self.planned_stages or stage_name in self.completed_stages:
+                continue
+            if not self.use_stage_cache or stage_name in self.force_stages or set(self.stage_dependencies[stage_name]).intersection(outdated_stages):
+                outdated_stages.append(stage_name)
+                continue
+            stage_record = self.read_stage_record(stage_name)
+            if stage_record is None:
+                if not self.can_adopt(stage_name):
+                    outdated_stages.append(stage_name)
+            elif stage_record["stage_hash"] != self.get_stage_hash(stage_name):
+                outdated_stages.append(stage_name)
+
+        return outdated_stages
+
+
+    def defer_stage(self, stage_name:str) -> list:
+        """
+        Removes a stage and its planned downstream stages from the plan of this run (e.g. if they do not fit into the time budget) and returns them.
+        Their records are kept, so a later run resumes with them.
+        """
+        deferred_stages = [downstream_stage for downstream_stage in self.stage_dependencies if downstream_stage in self.planned_stages 
+                            and stage_name in self.get_upstream_closure([downstream_stage])]
+        self.planned_stages.difference_update(deferred_stages)
+
+        return deferred_stages
+
+
+    def mark_complete(self, stage_name:str, stage_duration:float = None, peak_rss_gb:float = None) -> None:
+        """
+        Writes the record of a completed stage (atomically, so an interrupted write never leaves a record of an incomplete stage).
+        """
+        stage_hash = self.get_stage_hash(stage_name)
+        stage_record = {"stage": stage_name,
+                        "stage_hash": stage_hash,
+                        "artifact_id": stage_hash,
+                        "config": self.stage_configs.get(stage_name, {}),
+                        "upstream_artifacts": self.get_upstream_artifact_ids(stage_name),
+                        "completed": time.strftime("%Y-%m-%d %H:%M:%S"),
+                        "duration_s": stage_duration,
+                        "peak_rss_gb": peak_rss_gb,
+                        }
+
+        record_path = self.get_stage_record_path(stage_name)
+        os.makedirs(os.path.dirname(record_path), exist_ok=True)
+        temporary_record_path = f"{record_path}.tmp_{uuid.uuid4().hex}"
+        with open(temporary_record_path, 'w') as file:
+            json.dump(stage_record, file, indent=4, default=StageCache.serialize_config_value)
+        os.replace(temporary_record_path, record_path)
+
+        self.completed_stages.add(stage_name)
+        logger.custom_debug(f"[Subject {self.subject_id}] Recorded stage {stage_name} with hash {stage_hash[:12]}")
+
+
+
+class PipelineRunner:
+    """
+    Runs the planned stages of several subjects as a dependency graph. A stage starts as soon as the upstream stages of its subject are completed
+    and enough of the cpu and memory budget is free, so independent stages and subjects run concurrently. Each stage runs in a forked process
+    with its BLAS threads limited to its cpus; stage records are written by the runner once a stage completed.
+    With a budget planner, stages whose estimated duration exceeds the remaining time budget are deferred to the next run together with their downstream stages.
+    """
+    def __init__(self, stage_caches:dict, stage_function, max_cpus:int, max_memory_gb:float, stage_resources:dict = {}, default_stage_resources:dict = {"cpus": 1, "memory_gb": 2}, report_folder:str = None, poll_interval:float = 1.0, budget_planner = None):
+        self.stage_caches = stage_caches
+        self.stage_function = stage_function
+        self.max_cpus = max_cpus
+        self.max_memory_gb = max_memory_gb
+        self.stage_resources = stage_resources
+        self.default_stage_resources = default_stage_resources
+        self.report_folder = report_folder
+        self.poll_interval = poll_interval
+        self.budget_planner = budget_planner
+
+
+    def get_stage_resources(self, stage_name:str) -> Tuple[int, float]:
+        """
+        Cpus and memory reserved for a stage, limited to the budget so that oversized stages still run (alone).
+        """
+        resources = self.stage_resources.get(stage_name, self.default_stage_resources)
+
+        return min(resources["cpus"], self.max_cpus), min(resources["memory_gb"], self.max_memory_gb)
+
+
+    def run_stage_process(self, stage_name:str, subject_id:str, n_cpus:int, connection) -> None:
+        """
+        Target of the stage processes: runs the stage and sends its status, cpu time, peak memory and the stage method metrics recorded in the process to the runner.
+        The peak memory is the increase over the rss at fork time, which includes the memory inherited from the runner (e.g. the split data cache).
+        """
+        threadpool_limits(limits=n_cpus)
+        cpu_time_start = time.process_time()
+        peak_rss_start_gb = StageMetrics.get_peak_rss_gb()
+        # Records inherited from the runner are not sent back
+        n_inherited_records = len(StageMetrics.records)
+        try:
+            # Worker pools and DataLoader workers of the stage are capped at its reserved cpus as well
+            self.stage_function(stage_name=stage_name, subject_id=subject_id, n_cpus=n_cpus)
+            status = "completed"
+        except Exception:
+            logger.exception(f"[Subject {subject_id}] Stage {stage_name} failed.")
+            status = "failed"
+        connection.send({"status": status, "cpu_time_s": time.process_time() - cpu_time_start, "peak_rss_gb": StageMetrics.get_peak_rss_gb() - peak_rss_start_gb,
+                         "method_metrics": StageMetrics.records[n_inherited_records:]})
+        connection.close()
+
+
+    def run(self) -> list:
+        """
+        Runs all planned stages and returns (and stores) their metrics: status, start, duration, cpu time and peak memory.
+        Stages downstream of a failed stage are not run.
+        """
+        # Stages of each subject are defined in dependency order
+        pending_tasks = [(subject_id, stage_name) for subject_id, stage_cache in self.stage_caches.items() for stage_name in stage_cache.stage_dependencies if stage_cache.in_plan(stage_name)]
+        running_tasks = {}
+        tasks_requiring_run = set()
+        task_status = {}
+        stage_metrics = []
+        free_cpus, free_memory_gb = self.max_cpus, self.max_memory_gb
+        run_start = time.time()
+        process_context = multiprocessing.get_context("fork")
+
+        while pending_tasks or running_tasks:
+            for task in list(pending_tasks):
+                subject_id, stage_name = task
+                stage_cache = self.stage_caches[subject_id]
+                # Deferred by the budget (directly or as downstream stage of a deferred stage)
+                if not stage_cache.in_plan(stage_name):
+                    pending_tasks.remove(task)
+                    task_status[task] = "deferred"
+                    stage_metrics.append({"subject_id": subject_id, "stage": stage_name, "status": "deferred"})
+                    continue
+                upstream_status = [task_status.get((subject_id, upstream_stage)) for upstream_stage in stage_cache.stage_dependencies[stage_name] if stage_cache.in_plan(upstream_stage)]
+                if any(status in ["failed", "upstream_failed"] for status in upstream_status):
+                    pending_tasks.remove(task)
+                    task_status[task] = "upstream_failed"
+                    stage_metrics.append({"subject_id": subject_id, "stage": stage_name, "status": "upstream_failed"})
+                    logger.warning(f"[Subject {subject_id}] Not running stage {stage_name} because an upstream stage failed.")
+                    continue
+                if not all(status in ["completed", "up_to_date"] for status in upstream_status):
+                    continue
+                # The decision is kept while the stage waits for free resources
+                if task not in tasks_requiring_run and not stage_cache.requires_run(stage_name):
+                    pending_tasks.remove(task)
+                    task_status[task] = "up_to_date"
+                    stage_metrics.append({"subject_id": subject_id, "stage": stage_name, "status": "up_to_date"})
+                    continue
+                tasks_requiring_run.add(task)
+
+                n_cpus, memory_gb = self.get_stage_resources(stage_name)
+                if n_cpus > free_cpus or memory_gb > free_memory_gb:
+                    continue
+                if self.budget_planner is not None and not self.budget_planner.fits_remaining_budget(subject_id=subject_id, stage_name=stage_name):
+                    stage_cache.defer_stage(stage_name)
+                    pending_tasks.remove(task)
+                    task_status[task] = "deferred"
+                    stage_metrics.append({"subject_id": subject_id, "stage": stage_name, "status": "deferred"})
+                    continue
+                parent_connection, child_connection = process_context.Pipe(duplex=False)
+                stage_process = process_context.Process(target=self.run_stage_process, args=(stage_name, subject_id, n_cpus, child_connection), name=f"{subject_id}_{stage_name}")
+                stage_process.start()
+                child_connection.close()
+                pending_tasks.remove(task)
+                running_tasks[stage_process.sentinel] = {"task": task, "process": stage_process, "connection": parent_connection, "start": time.time(), "cpus": n_cpus, "memory_gb": memory_gb}
+                free_cpus -= n_cpus
+                free_memory_gb -= memory_gb
+                logger.custom_info(f"[Subject {subject_id}] Started stage {stage_name} ({n_cpus} cpus, {memory_gb} GB reserved).")
+
+            if not running_tasks:
+                if pending_tasks:
+                    raise RuntimeError(f"[PipelineRunner] Stages {pending_tasks} can not be scheduled.")
+                break
+
+            for sentinel in multiprocessing.connection.wait(list(running_tasks), timeout=self.poll_interval):
+                running_task = running_tasks.pop(sentinel)
+                running_task["process"].join()
+                subject_id, stage_name = running_task["task"]
+                stage_duration = time.time() - running_task["start"]
+                process_metrics = running_task["connection"].recv() if running_task["connection"].poll() else {"status": "failed"}
+                running_task["connection"].close()
+                StageMetrics.records.extend(process_metrics.pop("method_metrics", []))
+                if running_task["process"].exitcode != 0:
+                    process_metrics["status"] = "failed"
+                free_cpus += running_task["cpus"]
+                free_memory_gb += running_task["memory_gb"]
+
+                task_status[running_task["task"]] = process_metrics["status"]
+                if process_metrics["status"] == "completed":
+                    self.stage_caches[subject_id].mark_complete(stage_name, stage_duration=stage_duration, peak_rss_gb=process_metrics.get("peak_rss_gb"))
+                    logger.custom_info(f"[Subject {subject_id}] Completed stage {stage_name} in {stage_duration:.1f} s.")
+                else:
+                    logger.warning(f"[Subject {subject_id}] Stage {stage_name} failed after {stage_duration:.1f} s (exit code {running_task['process'].exitcode}).")
+                stage_metrics.append({"subject_id": subject_id, "stage": stage_name, "start_s": running_task["start"] - run_start, "duration_s": stage_duration, 
+                                      "cpus": running_task["cpus"], "memory_gb_reserved": running_task["memory_gb"], **process_metrics})
+
+        self.report_stage_metrics(stage_metrics=stage_metrics, run_duration=time.time() - run_start)
+
+        return stage_metrics
+
+
+    def report_stage_metrics(self, stage_metrics:list, run_duration:float) -> None:
+        """
+        Logs a table of the stage metrics and stores them as json in report_folder.
+        """
+        logger.custom_info(f"Pipeline run finished in {run_duration:.1f} s:")
+        logger.custom_info(f"{'subject':<8} {'stage':<24} {'status':<16} {'start [s]':>10} {'duration [s]':>13} {'cpu [s]':>10} {'peak rss [GB]':>14}")
+        for metrics in stage_metrics:
+            logger.custom_info(f"{metrics['subject_id']:<8} {metrics['stage']:<24} {metrics['status']:<16} {metrics.get('start_s', 0):>10.1f} {metrics.get('duration_s', 0):>13.1f} {metrics.get('cpu_time_s', 0):>10.1f} {metrics.get('peak_rss_gb', 0):>14.2f}")
+
+        if self.report_folder is not None:
+            os.makedirs(self.report_folder, exist_ok=True)
+            report_path = os.path.join(self.report_folder, f"pipeline_run_{time.strftime('%Y-%m-%d_%H-%M-%S')}.json")
+            with open(report_path, 'w') as file:
+                json.dump({"run_duration_s": run_duration, "max_cpus": self.max_cpus, "max_memory_gb": self.max_memory_gb, "stages": stage_metrics}, file, indent=4)
+            logger.custom_info(f"Stored stage metrics in {report_path}")
+
+
+
+class SweepPlanner:
+    """
+    Orders the configurations of a parameter grid for a sweep. Stage artifacts are stored at configuration-independent paths, so configurations run one after the other
+    and a stage is skipped (by the stage cache) only if its settings and those of its upstream stages are unchanged since the previous configuration.
+    The grid is therefore enumerated in the parameter order with the fewest (cost weighted) stage runs, e.g. changing the cheap downstream parameters fastest.
+    This only reduces recomputation, shared intermediates are not computed exactly once: for parameters of independent upstream stages (e.g. timepoint_min of
+    meg_dataset and pca_components of feature_reduction), one of these stages is still recomputed for every value of the other parameter.
+    """
+    def __init__(self, sweep_grid:dict, parameter_stages:dict, stage_dependencies:dict, planned_stages:set = None, stage_costs:dict = {}):
+        unknown_parameters = [parameter for parameter in sweep_grid if parameter not in parameter_stages]
+        if unknown_parameters:
+            raise ValueError(f"[SweepPlanner] No stages known for sweep parameters {unknown_parameters}, sweepable parameters: {list(parameter_stages)}")
+
+        self.sweep_grid = sweep_grid
+        self.parameter_stages = parameter_stages
+        self.stage_dependencies = stage_dependencies
+        self.planned_stages = planned_stages if planned_stages is not None else set(stage_dependencies)
+        self.stage_costs = stage_costs
+
+
+    def get_affected_stages(self, parameter:str) -> set:
+        """
+        Stages that use the parameter directly and all their downstream stages.
+        """
+        affected_stages = set(self.parameter_stages[parameter])
+        added_stages = True
+        while added_stages:
+            downstream_stages = {stage_name for stage_name, upstream_stages in self.stage_dependencies.items() if affected_stages.intersection(upstream_stages)}
+            added_stages = not downstream_stages.issubset(affected_stages)
+            affected_stages |= downstream_stages
+
+        return affected_stages.intersection(self.planned_stages)
+
+
+    def enumerate_configurations(self, parameter_order:list) -> list:
+        """
+        All configurations of the grid, the last parameter of parameter_order changing fastest.
+        """
+        return [dict(zip(parameter_order, parameter_values)) for parameter_values in itertools.product(*[self.sweep_grid[parameter] for parameter in parameter_order])]
+
+
+    def calculate_sweep_cost(self, configurations:list) -> float:
+        """
+        Cost of all stage runs of a sweep over the configurations in the given order (starting without records).
+        """
+        affected_stages_by_parameter = {parameter: self.get_affected_stages(parameter) for parameter in self.sweep_grid}
+        last_stage_settings = {}
+        sweep_cost = 0
+        for configuration in configurations:
+            for stage_name in self.planned_stages:
+                stage_settings = [repr(configuration[parameter]) for parameter in sorted(configuration) if stage_name in affected_stages_by_parameter[parameter]]
+                if last_stage_settings.get(stage_name) != stage_settings:
+                    sweep_cost += self.stage_costs.get(stage_name, 1)
+                    last_stage_settings[stage_name] = stage_settings
+
+        return sweep_cost
+
+
+    def plan(self) -> list:
+        """
+        Returns the configurations of the grid in the order with the lowest sweep cost.
+        """
+        best_configurations, best_cost = None, None
+        for parameter_order in itertools.permutations(self.sweep_grid):
+            configurations = self.enumerate_configurations(list(parameter_order))
+            sweep_cost = self.calculate_sweep_cost(configurations)
+            if best_cost is None or sweep_cost < best_cost:
+                best_configurations, best_cost = configurations, sweep_cost
+
+        n_stage_instances = sum(len({tuple(repr(configuration[parameter]) for parameter in sorted(configuration) if stage_name in self.get_affected_stages(parameter)) for configuration in best_configurations}) 
+                                for stage_name in self.planned_stages)
+        logger.custom_info(f"Sweep over {len(best_configurations)} configurations: {n_stage_instances} distinct stage instances, planned order with cost {best_cost}.")
+
+        return best_configurations
+
+
+
+class BudgetPlanner:
+    """
+    Chooses the stages that fit into an allocation with limited wall-clock time and memory (e.g. the 4 hour interactive sessions of interactive_job.sh).
+    Durations and peak memory of each stage are estimated from past runs: the stage records of all subjects and the metrics stored by the PipelineRunner.
+    Stages are selected in subject and dependency order; stages that do not fit are deferred with their downstream stages and resumed from the stage records by the next run.
+    """
+    def __init__(self, stage_caches:dict, lock_event:str, time_budget_h:float, max_memory_gb:float, stage_resources:dict = {}, default_stage_duration_s:float = 1800, 
+                 safety_factor:float = 1.2, start_time:float = None):
+        self.stage_caches = stage_caches
+        self.lock_event = lock_event
+        self.time_budget_s = time_budget_h * 3600
+        self.max_memory_gb = max_memory_gb
+        self.stage_resources = stage_resources
+        self.default_stage_duration_s = default_stage_duration_s
+        self.safety_factor = safety_factor
+        self.start_time = start_time if start_time is not None else time.time()
+        self.stage_history = self.load_stage_history()
+
+
+    def load_stage_history(self) -> dict:
+        """
+        Durations and peak memory of past completed runs, by stage and subject: {stage_name: {subject_id: [{"duration_s": ..., "peak_rss_gb": ...}, ...]}}.
+        """
+        stage_history = {}
+        for report_path in sorted(glob.glob(f"data_files/{self.lock_event}/pipeline_runs/pipeline_run_*.json")):
+            with open(report_path, 'r') as file:
+                pipeline_run = json.load(file)
+            for stage_metrics in pipeline_run["stages"]:
+                if stage_metrics["status"] == "completed":
+                    stage_history.setdefault(stage_metrics["stage"], {}).setdefault(stage_metrics["subject_id"], []).append({"duration_s": stage_metrics["duration_s"], "peak_rss_gb": stage_metrics.get("peak_rss_gb")})
+
+        # Records of sequential runs (the records of parallel runs are already contained in the pipeline run metrics)
+        for record_path in glob.glob(f"data_files/{self.lock_event}/stage_records/subject_*/*.json"):
+            with open(record_path, 'r') as file:
+                stage_record = json.load(file)
+            if stage_record.get("duration_s") is not None and stage_record.get("peak_rss_gb") is None:
+                subject_id = os.path.basename(os.path.dirname(record_path))[len("subject_"):]
+                stage_history.setdefault(stage_record["stage"], {}).setdefault(subject_id, []).append({"duration_s": stage_record["duration_s"], "peak_rss_gb": None})
+
+        return stage_history
+
+
+    def estimate_stage_cost(self, subject_id:str, stage_name:str) -> Tuple[float, float]:
+        """
+        Estimated duration (s) and peak memory (GB) of a stage. The duration is the median of the past runs of the subject (of all subjects if the subject never ran the stage),
+        scaled by the safety factor. The memory is the largest recorded peak, else the memory reserved in stage_resources.
+        """
+        subject_history = self.stage_history.get(stage_name, {})
+        stage_runs = subject_history.get(subject_id) or [stage_run for subject_runs in subject_history.values() for stage_run in subject_runs]
+
+        duration_s = float(np.median([stage_run["duration_s"] for stage_run in stage_runs])) if stage_runs else self.default_stage_duration_s
+        peak_rss_values = [stage_run["peak_rss_gb"] for stage_run in stage_runs if stage_run["peak_rss_gb"] is not None]
+        memory_gb = max(peak_rss_values) if peak_rss_values else self.stage_resources.get(stage_name, {}).get("memory_gb", 0)
+
+        return duration_s * self.safety_factor, memory_gb
+
+
+    def plan(self) -> list:
+        """
+        Selects the outdated stages of all subjects that fit into the budget and defers the others (removing them from the plans of the stage caches).
+        Returns the selected (subject_id, stage_name) tasks in execution order.
+        """
+        remaining_budget_s = self.time_budget_s - (time.time() - self.start_time)
+        selected_tasks, planned_duration_s = [], 0
+        logger.custom_info(f"Planning stages for a budget of {remaining_budget_s / 3600:.2f} h and {self.max_memory_gb} GB:")
+        logger.custom_info(f"{'subject':<8} {'stage':<24} {'estimate [min]':>15} {'memory [GB]':>12} {'cumulative [min]':>17}  decision")
+        for subject_id, stage_cache in self.stage_caches.items():
+            for stage_name in stage_cache.get_outdated_stages():
+                if not stage_cache.in_plan(stage_name):
+                    # Downstream of a deferred stage
+                    continue
+                duration_s, memory_gb = self.estimate_stage_cost(subject_id=subject_id, stage_name=stage_name)
+                if memory_gb > self.max_memory_gb:
+                    decision = f"deferred (memory), with {stage_cache.defer_stage(stage_name)}"
+                elif planned_duration_s + duration_s > remaining_budget_s:
+                    decision = f"deferred (time), with {stage_cache.defer_stage(stage_name)}"
+                else:
+                    planned_duration_s += duration_s
+                    selected_tasks.append((subject_id, stage_name))
+                    decision = "selected"
+                logger.custom_info(f"{subject_id:<8} {stage_name:<24} {duration_s / 60:>15.1f} {memory_gb:>12.2f} {planned_duration_s / 60:>17.1f}  {decision}")
+
+        logger.custom_info(f"Selected {len(selected_tasks)} stages with an estimated duration of {planned_duration_s / 3600:.2f} h.")
+
+        return selected_tasks
+
+
+    def fits_remaining_budget(self, subject_id:str, stage_name:str) -> bool:
+        """
+        True if the estimated duration of the stage fits into the time left of the budget. Checked before each stage starts, as earlier stages may have taken longer than estimated.
+        """
+        duration_s, _ = self.estimate_stage_cost(subject_id=subject_id, stage_name=stage_name)
+        remaining_budget_s = self.time_budget_s - (time.time() - self.start_time)
+        if duration_s > remaining_budget_s:
+            logger.warning(f"[Subject {subject_id}] Deferring stage {stage_name} and its downstream stages: estimated {duration_s / 60:.1f} min, {remaining_budget_s / 60:.1f} min of the budget left.")
+            return False
+
+        return True
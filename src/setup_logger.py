@@ -10,7 +10,7 @@ sys.path.append(str(__location__))
 os.chdir(__location__)
 
 # Add custom loggers for uncluttered debugging without info and debugging from imported packages
-def setup_logger(logger_level):
+def setup_logger(logger_level, log_name="pipeline"):
     CUSTOM_DEBUG_INFO_LEVEL = 23 # between info and warning
     def custom_debug_info(self, message, *args, **kwargs):
         if self.isEnabledFor(CUSTOM_DEBUG_INFO_LEVEL):
@@ -30,7 +30,7 @@ def setup_logger(logger_level):
     logger = logging.getLogger(__name__)
     logging.root.handlers = []
     filename = (
-            "logs/pipeline_" + datetime.now().strftime("%d-%m-%Y_%H-%M-%S") + ".log"
+            f"logs/{log_name}_" + datetime.now().strftime("%d-%m-%Y_%H-%M-%S") + ".log"
         )
     handlers = [logging.StreamHandler(), logging.FileHandler(filename=filename, encoding="utf-8", mode="w"),]  # logging.FileHandler(filename=filename, encoding="utf-8", mode="w"),
     logging.basicConfig(
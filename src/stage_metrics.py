@@ -0,0 +1,201 @@
+import os
+import csv
+import json
+import time
+import resource
+import logging
+import functools
+import contextlib
+from collections import defaultdict
+
+# Logging related
+logger = logging.getLogger(__name__)
+
+
+class StageMetrics:
+    """
+    Process-wide recorder of wall time, cpu time, peak memory, bytes read and written and item counts of the pipeline stages.
+    Stage methods of the helpers are wrapped with @StageMetrics.measure; the load/save helpers report their bytes (add_bytes_read, add_bytes_written)
+    and item counts (count_items). Bytes and counts are added to all active measurements, so a measurement includes those of the stage methods it calls.
+    """
+    enabled = True
+    records = []
+    active_records = []
+
+    @staticmethod
+    def get_peak_rss_gb(who=resource.RUSAGE_SELF) -> float:
+        # ru_maxrss is in kB on linux
+        return resource.getrusage(who).ru_maxrss / 1024**2
+
+
+    @staticmethod
+    def reset_peak_rss() -> bool:
+        """
+        Resets the peak rss of the process to its current rss (linux, /proc/self/clear_refs), so that long-lived processes can measure the peak of every stage run.
+        Not done while records are active, whose peak rss would be lost. Returns whether the peak was reset.
+        """
+        if StageMetrics.active_records:
+            return False
+        try:
+            with open("/proc/self/clear_refs", 'w') as file:
+                file.write("5")
+        except OSError:
+            return False
+
+        return True
+
+
+    @staticmethod
+    @contextlib.contextmanager
+    def track_run():
+        """
+        Context manager for one stage run (or work queue task) in a long-lived process. Yields a dict that holds duration_s and peak_rss_gb once the block finished;
+        peak_rss_gb is the increase of the peak rss over the rss at the start (over the previous peak if reset_peak_rss is not possible). Works while StageMetrics is disabled.
+        """
+        run_metrics = {}
+        StageMetrics.reset_peak_rss()
+        peak_rss_start = StageMetrics.get_peak_rss_gb()
+        wall_time_start = time.perf_counter()
+        try:
+            yield run_metrics
+        finally:
+            run_metrics["duration_s"] = time.perf_counter() - wall_time_start
+            run_metrics["peak_rss_gb"] = StageMetrics.get_peak_rss_gb() - peak_rss_start
+
+
+    @staticmethod
+    @contextlib.contextmanager
+    def record(name:str, **labels):
+        """
+        Context manager that measures a block as record name (labels like subject_id or stage_name are stored with it).
+        The peak rss is the peak of the process so far, peak_rss_increase_gb the part of it reached within the block. Cpu time includes terminated child processes (e.g. DataLoader or prediction workers).
+        """
+        if not StageMetrics.enabled:
+            yield None
+            return
+
+        stage_record = {"name": name, **labels, "start": time.strftime("%Y-%m-%d %H:%M:%S"), "status": "completed", "depth": len(StageMetrics.active_records),
+                        "bytes_read": 0, "bytes_mapped": 0, "bytes_written": 0, "items": defaultdict(int)}
+        wall_time_start = time.perf_counter()
+        cpu_times_start = os.times()
+        peak_rss_start = StageMetrics.get_peak_rss_gb()
+        StageMetrics.active_records.append(stage_record)
+        try:
+            yield stage_record
+        except BaseException:
+            stage_record["status"] = "failed"
+            raise
+        finally:
+            StageMetrics.active_records.remove(stage_record)
+            cpu_times_end = os.times()
+            stage_record["wall_time_s"] = time.perf_counter() - wall_time_start
+            stage_record["cpu_time_s"] = sum(cpu_times_end[:4]) - sum(cpu_times_start[:4])
+            stage_record["peak_rss_gb"] = StageMetrics.get_peak_rss_gb()
+            stage_record["peak_rss_increase_gb"] = stage_record["peak_rss_gb"] - peak_rss_start
+            stage_record["peak_rss_children_gb"] = StageMetrics.get_peak_rss_gb(resource.RUSAGE_CHILDREN)
+            stage_record["items"] = dict(stage_record["items"])
+            StageMetrics.records.append(stage_record)
+
+
+    @staticmethod
+    def measure(function):
+        """
+        Decorator for stage methods (and stage functions): every call is recorded under the qualified name of the function,
+        labeled with the subject of the helper and the stage_name/subject_id arguments.
+        """
+        @functools.wraps(function)
+        def measured_function(*args, **kwargs):
+            labels = {label: kwargs[label] for label in ["stage_name", "subject_id"] if label in kwargs}
+            if args and hasattr(args[0], "subject_id"):
+                labels.setdefault("subject_id", args[0].subject_id)
+            with StageMetrics.record(function.__qualname__, **labels):
+                return function(*args, **kwargs)
+
+        return measured_function
+
+
+    @staticmethod
+    def add_bytes_read(n_bytes:int, memory_mapped:bool = False) -> None:
+        """
+        Memory-mapped arrays are counted as mapped, only the accessed parts of them are actually read.
+        """
+        for stage_record in StageMetrics.active_records:
+            stage_record["bytes_mapped" if memory_mapped else "bytes_read"] += int(n_bytes)
+
+
+    @staticmethod
+    def add_bytes_written(n_bytes:int) -> None:
+        for stage_record in StageMetrics.active_records:
+            stage_record["bytes_written"] += int(n_bytes)
+
+
+    @staticmethod
+    def count_items(item_type:str, n_items:int = 1) -> None:
+        """
+        Counts processed items, e.g. "epochs", "crops", "timepoint_models" or "plots".
+        """
+        for stage_record in StageMetrics.active_records:
+            stage_record["items"][item_type] += int(n_items)
+
+
+    @staticmethod
+    def get_summary() -> list:
+        """
+        Records aggregated by name and stage: calls, total wall and cpu time, largest peak rss, bytes and items.
+        """
+        summary = {}
+        for stage_record in StageMetrics.records:
+            summary_key = (stage_record["name"], stage_record.get("stage_name", ""))
+            if summary_key not in summary:
+                summary[summary_key] = {"name": stage_record["name"], "stage_name": stage_record.get("stage_name", ""), "calls": 0, "failed": 0, "wall_time_s": 0, "cpu_time_s": 0,
+                                        "peak_rss_gb": 0, "bytes_read": 0, "bytes_mapped": 0, "bytes_written": 0, "items": defaultdict(int)}
+            summary_row = summary[summary_key]
+            summary_row["calls"] += 1
+            summary_row["failed"] += stage_record["status"] == "failed"
+            for metric in ["wall_time_s", "cpu_time_s", "bytes_read", "bytes_mapped", "bytes_written"]:
+                summary_row[metric] += stage_record[metric]
+            summary_row["peak_rss_gb"] = max(summary_row["peak_rss_gb"], stage_record["peak_rss_gb"])
+            for item_type, n_items in stage_record["items"].items():
+                summary_row["items"][item_type] += n_items
+
+        return sorted(summary.values(), key=lambda summary_row: summary_row["wall_time_s"], reverse=True)
+
+
+    @staticmethod
+    def log_summary() -> None:
+        """
+        Logs the summary table (slowest first).
+        """
+        if not StageMetrics.records:
+            return
+        logger.custom_info("Stage metrics:")
+        logger.custom_info(f"{'name':<55} {'stage':<24} {'calls':>5} {'wall [s]':>10} {'cpu [s]':>10} {'peak rss [GB]':>14} {'read [GB]':>10} {'mapped [GB]':>12} {'written [GB]':>13}  items")
+        for summary_row in StageMetrics.get_summary():
+            items = ", ".join(f"{item_type}: {n_items}" for item_type, n_items in summary_row["items"].items())
+            logger.custom_info(f"{summary_row['name']:<55} {summary_row['stage_name']:<24} {summary_row['calls']:>5} {summary_row['wall_time_s']:>10.1f} {summary_row['cpu_time_s']:>10.1f} {summary_row['peak_rss_gb']:>14.2f} "
+                               f"{summary_row['bytes_read'] / 1024**3:>10.2f} {summary_row['bytes_mapped'] / 1024**3:>12.2f} {summary_row['bytes_written'] / 1024**3:>13.2f}  {items}")
+
+
+    @staticmethod
+    def write_report(report_folder:str) -> str:
+        """
+        Stores all records of the run as json and as csv (one row per record, one column per item type). Returns the path of the json file.
+        """
+        if not StageMetrics.records:
+            return None
+        os.makedirs(report_folder, exist_ok=True)
+        report_path = os.path.join(report_folder, f"stage_metrics_{time.strftime('%Y-%m-%d_%H-%M-%S')}")
+        with open(f"{report_path}.json", 'w') as file:
+            json.dump({"records": StageMetrics.records, "summary": StageMetrics.get_summary()}, file, indent=4)
+
+        item_types = sorted({item_type for stage_record in StageMetrics.records for item_type in stage_record["items"]})
+        columns = ["name", "stage_name", "subject_id", "worker_id", "start", "status", "depth", "wall_time_s", "cpu_time_s", "peak_rss_gb", "peak_rss_increase_gb", "peak_rss_children_gb",
+                   "bytes_read", "bytes_mapped", "bytes_written"] + [f"items_{item_type}" for item_type in item_types]
+        with open(f"{report_path}.csv", 'w', newline="") as file:
+            csv_writer = csv.DictWriter(file, fieldnames=columns, extrasaction="ignore")
+            csv_writer.writeheader()
+            for stage_record in StageMetrics.records:
+                csv_writer.writerow({**stage_record, **{f"items_{item_type}": n_items for item_type, n_items in stage_record["items"].items()}})
+        logger.custom_info(f"Stored stage metrics in {report_path}.json and .csv")
+
+        return f"{report_path}.json"
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import json
 import h5py
@@ -11,12 +12,22 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 import logging
 import random
+import math
+import itertools
+import hashlib
+import uuid
+import glob
+import socket
+import fcntl
+import contextlib
 from matplotlib.lines import Line2D  
 from mpl_toolkits.mplot3d import Axes3D
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
 from typing import Tuple, Dict
 import time
+import multiprocessing
+from multiprocessing import shared_memory
 from datetime import date
 
 # ML specific imports
@@ -25,13 +36,18 @@ from torch.utils.data import Dataset, TensorDataset, DataLoader
 from torchvision import transforms
 from thingsvision import get_extractor
 
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.random_projection import SparseRandomProjection
 from sklearn.linear_model import RidgeCV, ElasticNetCV
+from sklearn.model_selection import KFold
 import fracridge
 from fracridge import FracRidgeRegressorCV
 from sklearn.metrics import mean_squared_error
 from sklearn.metrics import r2_score
 from scipy.stats import linregress, pearsonr
+from threadpoolctl import threadpool_limits
+
+from stage_metrics import StageMetrics
 
 # Logging related
 logger = logging.getLogger(__name__)
@@ -39,16 +55,58 @@ logger = logging.getLogger(__name__)
 mne.set_log_level(verbose="ERROR")
 
 class BasicOperationsHelper:
-    def __init__(self, subject_id:str, lock_event:str):
+    # Content types that are stored as train/test splits (see export_split_data_as_file and load_split_data_from_file)
+    split_content_types = ["trial_splits", "crop_data", "meg_data", "torch_dataset", "ann_features", "ann_features_pca", "ann_features_pca_all_sessions_combined", "ann_features_pca_sweep", "ann_features_pca_shared", "ann_features_random_projection", "ann_features_pooled"]
+    # Process-wide LRU cache of loaded .npy splits, shared by all helper instances: (absolute path, mmap_mode) -> ((mtime_ns, size), array)
+    split_data_cache = OrderedDict()
+    split_data_cache_bytes = 0
+    split_data_cache_max_bytes = 4 * 1024**3  # Memory-mapped arrays are not counted, 0 disables the cache
+    # "files": one .npy file per content, norm, session and split. "hdf5": .npy splits are stored as datasets of one store per subject (see get_split_store_path)
+    split_storage_backend = "files"
+    split_store_compression = None  # Compression filter of the hdf5 store (e.g. "gzip", "lzf"). Compressed datasets are chunked and read completely instead of memory-mapped
+    # Sessions are discovered in the MEG data folder that create_meg_dataset reads (ica cleaned or not)
+    use_ica_cleaned_data = True
+
+    def __init__(self, subject_id:str, lock_event:str, fit_measure_variant:str = None):
         self.subject_id = subject_id
         self.lock_event = lock_event
-        self.session_ids_char = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j']
-        self.session_ids_num = [str(session_id) for session_id in range(1,11)]
+        # None: fit measures of the single train/test split (predict_from_mapping), "cv_{n_folds}": fold-averaged fit measures of evaluate_cross_validated
+        self.fit_measure_variant = fit_measure_variant
+        self.session_ids_char = self.discover_session_ids_char()
+        self.session_ids_num = [self.map_session_letter_id_to_num(session_id_char) for session_id_char in self.session_ids_char]
 
         with open(f"data_files/session_metadata/session_datetimes/session_datetimes_dict.pkl", 'rb') as file:
             self.session_datetimes = pickle.load(file)
 
 
+    def discover_session_ids_char(self) -> list:
+        """
+        Discovers the sessions of the subject (as letters) from the MEG data files of the lock event in the folder read by create_meg_dataset (see use_ica_cleaned_data).
+        If the MEG data folder is not available, sessions are taken from the processed meg_data folders in data_files; the 10 sessions a-j are the fallback.
+        """
+        session_ids_char = set()
+        subject_folder = f"/share/klab/datasets/avs/population_codes/as{self.subject_id}/sensor"
+        meg_data_folder = f"{subject_folder}/erf/filter_0.2_200/ica" if self.use_ica_cleaned_data else f"{subject_folder}/filter_0.2_200"
+        if os.path.isdir(meg_data_folder):
+            file_prefix = f"as{self.subject_id}"
+            file_suffix = f"_population_codes_{self.lock_event}_500hz_masked_False.h5"
+            for meg_data_file in os.listdir(meg_data_folder):
+                if meg_data_file.startswith(file_prefix) and meg_data_file.endswith(file_suffix):
+                    session_ids_char.add(meg_data_file[len(file_prefix):-len(file_suffix)])
+
+        if not session_ids_char:
+            processed_meg_data_folder = f"data_files/{self.lock_event}/meg_data"
+            if os.path.isdir(processed_meg_data_folder):
+                for root, folders, _ in os.walk(processed_meg_data_folder):
+                    if os.path.basename(root) == f"subject_{self.subject_id}":
+                        session_ids_char.update(chr(ord('a') + int(folder[len("session_"):]) - 1) for folder in folders if folder.startswith("session_"))
+
+        if not session_ids_char:
+            return ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j']
+
+        return sorted(session_ids_char)
+
+
     def omit_selected_sessions_from_fit_measures(self, fit_measures_by_session:dict, omitted_sessions:list, sensors_seperated:bool) -> dict:
         """
         Filters out values for omitted sessions from standard fit measure cross-prediction dict.
@@ -134,10 +192,12 @@ class BasicOperationsHelper:
     
     def get_session_date_differences(self):
         """
-        Calculates the rounded differences in days between all sessions.
+        Calculates the rounded differences in days between all sessions. Sessions without date in session_datetimes_dict.pkl are dated from their evoked .fif file.
         """
-        fif_folder = f'/share/klab/datasets/avs/population_codes/as{self.subject_id}/sensor/erf/filter_0.2_200/'
- 
+        for session_id_num in self.session_ids_num:
+            if session_id_num not in self.session_datetimes:
+                self.session_datetimes[session_id_num] = self.read_session_datetime(session_id_num)
+
         # Get difference in days (as float) between sessions
         session_day_differences = self.recursive_defaultdict()
         for session_id_num in self.session_ids_num:
@@ -157,6 +217,24 @@ class BasicOperationsHelper:
         return session_day_differences
 
 
+    def read_session_datetime(self, session_id_num: str):
+        """
+        Reads the measurement date of a session that is not in session_datetimes_dict.pkl (e.g. a newly discovered session) from its evoked .fif file.
+        """
+        subject_folder = f"/share/klab/datasets/avs/population_codes/as{self.subject_id}/sensor"
+        # Saccade evoked files are used regardless of the lock event, there are none for fixations
+        fif_file = f"saccade_evoked_{self.subject_id}_{int(session_id_num):02d}_.fif"
+        for fif_folder in [f"{subject_folder}/erf/filter_0.2_200", f"{subject_folder}/filter_0.2_200"]:
+            fif_path = os.path.join(fif_folder, fif_file)
+            if os.path.exists(fif_path):
+                session_datetime = mne.read_evokeds(fif_path)[0].info["meas_date"]
+                logger.custom_info(f"[Session {session_id_num}]: Read session date {session_datetime} from {fif_path}")
+                return session_datetime
+
+        raise ValueError(f"No date for session {session_id_num} of subject {self.subject_id}: it is not in data_files/session_metadata/session_datetimes/session_datetimes_dict.pkl "
+                         f"and no {fif_file} exists in {subject_folder}/erf/filter_0.2_200 or {subject_folder}/filter_0.2_200. Add the session date to the pkl file.")
+
+
     def recursive_defaultdict(self) -> dict:
         """
         Helper function to initialize a defaultdict that automatically adds missing intermediate dicts.
@@ -164,22 +242,37 @@ class BasicOperationsHelper:
         return defaultdict(self.recursive_defaultdict)
 
 
+    def convert_to_recursive_defaultdict(self, nested_dict: dict) -> dict:
+        """
+        Helper function to convert a nested dict (e.g. loaded from json) into a recursive defaultdict.
+        """
+        converted_dict = self.recursive_defaultdict()
+        for key, value in nested_dict.items():
+            converted_dict[key] = self.convert_to_recursive_defaultdict(value) if isinstance(value, dict) else value
+
+        return converted_dict
+
+
     def map_session_letter_id_to_num(self, session_id_letter: str) -> str:
         """
         Helper function to map the character id from a session to its number id.
         For example: Input "a" will return "1".
         """
-        # Create mapping
-        session_mapping = {}
-        for num in range(1,11):
-            letter = self.session_ids_char[num-1]
-            session_mapping[letter] = str(num)
-        # Map letter to num
-        session_id_num = session_mapping[session_id_letter]
+        # Sessions are numbered by their position in the alphabet
+        session_id_num = str(ord(session_id_letter) - ord('a') + 1)
 
         return session_id_num
 
 
+    def get_fit_measure_subject_folder(self, main_folder: str) -> str:
+        """
+        Returns the folder of the subject for fit measures of main_folder (e.g. "var_explained"), with a subfolder for the fit_measure_variant if set.
+        """
+        variant_folder = f"/{self.fit_measure_variant}" if self.fit_measure_variant is not None else ""
+
+        return f"data_files/{self.lock_event}/{main_folder}/{self.ann_model}/{self.module_name}/subject_{self.subject_id}{variant_folder}"
+
+
     def read_dict_from_json(self, type_of_content: str, type_of_norm: str = None, predict_train_data:bool = False) -> dict:
         """
         Helper function to read json files of various content types into dicts.
@@ -189,11 +282,11 @@ class BasicOperationsHelper:
             raise ValueError(f"Function read_dict_from_json called with unrecognized type {type_of_content}.")
 
         if type_of_content == "mse_losses":
-            file_path = f"data_files/{self.lock_event}/mse_losses/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{type_of_norm}/mse_losses_{type_of_norm}_dict.json"
+            file_path = f"{self.get_fit_measure_subject_folder('mse_losses')}/norm_{type_of_norm}/mse_losses_{type_of_norm}_dict.json"
         elif type_of_content == "mse_losses_timepoint":
-            file_path = f"data_files/{self.lock_event}/mse_losses/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/timepoints/norm_{type_of_norm}/mse_losses_timepoint_{type_of_norm}_dict.json"
+            file_path = f"{self.get_fit_measure_subject_folder('mse_losses')}/timepoints/norm_{type_of_norm}/mse_losses_timepoint_{type_of_norm}_dict.json"
         elif type_of_content == "var_explained":
-            file_path = f"data_files/{self.lock_event}/var_explained/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{type_of_norm}/predict_train_data_{predict_train_data}/var_explained_{type_of_norm}_dict.json"
+            file_path = f"{self.get_fit_measure_subject_folder('var_explained')}/norm_{type_of_norm}/predict_train_data_{predict_train_data}/var_explained_{type_of_norm}_dict.json"
         else:
             file_path = f"data_files/{self.lock_event}/metadata/{type_of_content}/subject_{self.subject_id}/{type_of_content}_dict.json"
         
@@ -201,6 +294,7 @@ class BasicOperationsHelper:
             with open(file_path, 'r') as data_file:
                 logger.custom_debug(f"Loading dict from {file_path}")
                 data_dict = json.load(data_file)
+            StageMetrics.add_bytes_read(os.path.getsize(file_path))
             return data_dict
         except FileNotFoundError:
             raise FileNotFoundError(f"In Function read_dict_from_json: The file {file_path} does not exist.")
@@ -226,9 +320,9 @@ class BasicOperationsHelper:
                 else:
                     timepoint_folder = ""
                     timepoint_name = ""
-                storage_folder = f"data_files/{self.lock_event}/mse_losses/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/{timepoint_folder}norm_{type_of_norm}"
+                storage_folder = f"{self.get_fit_measure_subject_folder('mse_losses')}/{timepoint_folder}norm_{type_of_norm}"
             elif type_of_content == "var_explained":
-                storage_folder = f"data_files/{self.lock_event}/var_explained/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{type_of_norm}/predict_train_data_{predict_train_data}"
+                storage_folder = f"{self.get_fit_measure_subject_folder('var_explained')}/norm_{type_of_norm}/predict_train_data_{predict_train_data}"
             name_addition = f"_{type_of_norm}"
         # metadata
         elif type_of_content in ["combined_metadata", "meg_metadata", "crop_metadata"]:
@@ -239,10 +333,9 @@ class BasicOperationsHelper:
         json_storage_file = f"{type_of_content}{name_addition}_dict.json"
         json_storage_path = os.path.join(storage_folder, json_storage_file)
 
-        with open(json_storage_path, 'w') as file:
-            logger.custom_debug(f"Storing dict to {json_storage_path}")
-            # Serialize and save the dictionary to the file
-            json.dump(dict_to_store, file, indent=4)
+        logger.custom_debug(f"Storing dict to {json_storage_path}")
+        # Serialize and save the dictionary to the file
+        self.write_file_atomically(save_path=json_storage_path, write_file=lambda file: json.dump(dict_to_store, file, indent=4), mode='w')
 
 
     def export_split_data_as_file(self, session_id: str, type_of_content: str, array_dict: Dict[str, np.ndarray], type_of_norm: str = None, ann_model: str = None, module: str = None) -> None:
@@ -254,7 +347,7 @@ class BasicOperationsHelper:
             type_of_content (str): Type of data in arrays. Allowed values: ["trial_splits", "crop_data", "meg_data", "torch_dataset", "ann_features"]
             np_array (Dict[str, ndarray]): Arrays in format split, array. split is "train" or "test".
         """
-        valid_types = ["trial_splits", "crop_data", "meg_data", "torch_dataset", "ann_features", "ann_features_pca", "ann_features_pca_all_sessions_combined"]
+        valid_types = self.split_content_types
         if type_of_content not in valid_types:
             raise ValueError(f"Function export_split_data_as_file called with unrecognized type {type_of_content}.")
 
@@ -287,14 +380,21 @@ class BasicOperationsHelper:
         for split in array_dict:
             save_folder = f"data_files/{self.lock_event}/{type_of_content}{all_sessions_combined_folder}{additional_model_folders}{additional_norm_folder}{intermediate_norm_folder}subject_{self.subject_id}{session_folder}/{split}"  
             save_file = f"{type_of_content}{file_type}"
-            os.makedirs(save_folder, exist_ok=True)
+            if file_type != ".npy" or self.split_storage_backend != "hdf5":
+                os.makedirs(save_folder, exist_ok=True)
             save_path = os.path.join(save_folder, save_file)
 
-            if file_type == ".npy":
+            if file_type == ".npy" and self.split_storage_backend == "hdf5":
+                self.write_split_array_to_store(split_path=save_path, split_array=array_dict[split])
+            elif file_type == ".npy":
                 #if all_sessions_combined_folder != "":
-                np.save(save_path, array_dict[split])
+                self.save_array_atomically(save_path=save_path, array=array_dict[split])
+                self.invalidate_split_data_cache(split_path=save_path)
             else:
-                torch.save(array_dict[split], save_path)
+                self.write_file_atomically(save_path=save_path, write_file=lambda file: torch.save(array_dict[split], file))
+            # Epochs are counted once, when the final normalization is exported
+            if type_of_content == "meg_data" and intermediate_norm_folder == "":
+                StageMetrics.count_items("epochs", len(array_dict[split]))
             logger.custom_debug(f"Exporting split data {type_of_content} to {save_path}")
             if split == "train" and (type_of_content == "crop_data" or type_of_content.startswith("ann_features")):
                 logger.custom_debug(f"[Session {session_id}]: Train: Storing array of shape {array_dict[split].shape} to {save_path}")
@@ -375,15 +475,69 @@ class BasicOperationsHelper:
         return fit_by_distances
 
     
-    def load_split_data_from_file(self, session_id_num: str, type_of_content: str, type_of_norm:str = None, ann_model: str = None, module: str = None) -> dict:
+    def get_split_data_path(self, session_id_num: str, type_of_content: str, split: str, type_of_norm:str = None, ann_model: str = None, module: str = None) -> str:
+        """
+        Helper function to build the path of a single split file, identical to the one read by load_split_data_from_file.
+        """
+        file_type = ".pt" if type_of_content == "torch_dataset" else ".npy"
+
+        additional_model_folders = f"/{ann_model}/{module}/" if type_of_content.startswith("ann_features") else "/"
+        additional_norm_folder = f"norm_{type_of_norm}/" if type_of_content == "meg_data" else ""
+
+        if type_of_content.endswith("_all_sessions_combined"):
+            all_sessions_combined_folder = "/all_sessions_combined"
+            type_of_content = type_of_content.replace("_all_sessions_combined", "")
+            session_folder = ""
+        else:
+            session_folder = f"/session_{session_id_num}"
+            all_sessions_combined_folder = ""
+
+        split_path = f"data_files/{self.lock_event}/{type_of_content}{all_sessions_combined_folder}{additional_model_folders}{additional_norm_folder}subject_{self.subject_id}{session_folder}/{split}/{type_of_content}{file_type}"
+
+        return split_path
+
+
+    def open_split_memmap_for_writing(self, session_id: str, type_of_content: str, split: str, shape: tuple, dtype=np.float32, ann_model: str = None, module: str = None) -> np.memmap:
+        """
+        Helper function to create a memory-mapped .npy file for a split that is filled incrementally (e.g. batch by batch) instead of being exported at once.
+        The memmap is backed by a temporary file next to the split path, finalize_split_memmap moves it to the split path once it is filled completely.
+        """
+        save_path = self.get_split_data_path(session_id_num=session_id, type_of_content=type_of_content, split=split, ann_model=ann_model, module=module)
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        temporary_path = self.get_temporary_path(save_path)
+        logger.custom_debug(f"[Session {session_id}]: {split}: Opening memmap of shape {shape} at {temporary_path}")
+
+        return np.lib.format.open_memmap(temporary_path, mode="w+", dtype=dtype, shape=shape)
+
+
+    def finalize_split_memmap(self, split_memmap: np.memmap) -> str:
+        """
+        Flushes a split opened with open_split_memmap_for_writing and replaces the split file with it. Returns the split path.
+        """
+        split_memmap.flush()
+        temporary_path = split_memmap.filename
+        split_path = temporary_path.rsplit(".tmp_", 1)[0]
+        if self.split_storage_backend == "hdf5":
+            # The streamed file is read as fallback, an older version in the store would shadow it
+            self.delete_split_array_from_store(split_path=split_path)
+        os.replace(temporary_path, split_path)
+        self.invalidate_split_data_cache(split_path=split_path)
+        StageMetrics.add_bytes_written(os.path.getsize(split_path))
+
+        return split_path
+
+
+    def load_split_data_from_file(self, session_id_num: str, type_of_content: str, type_of_norm:str = None, ann_model: str = None, module: str = None, mmap_mode: str = None, use_cache: bool = True) -> dict:
         """
         Helper function to load the split for a given session.
 
-        Parameters: 
+        Parameters:
             session_id_num (str): id of session that the arrays belong to
             type_of_content (str): Type of data in arrays
+            mmap_mode (str): If set (e.g. "r"), .npy files are memory-mapped instead of read into memory completely
+            use_cache (bool): If True, .npy files are served from the process-wide split data cache (see load_cached_split_array). Cached arrays are read-only.
         """
-        valid_types = ["trial_splits", "crop_data", "meg_data", "torch_dataset", "ann_features", "ann_features_pca", "ann_features_pca_all_sessions_combined"]
+        valid_types = self.split_content_types
         if type_of_content not in valid_types:
             raise ValueError(f"Function load_split_data_from_file called with unrecognized type {type_of_content}.")
 
@@ -416,10 +570,11 @@ class BasicOperationsHelper:
             # Load split trial array
             split_path = f"data_files/{self.lock_event}/{type_of_content}{all_sessions_combined_folder}{additional_model_folders}{additional_norm_folder}subject_{self.subject_id}{session_folder}/{split}/{type_of_content}{file_type}"  
             if file_type == ".npy":
-                split_data = np.load(split_path)
+                split_data = self.load_cached_split_array(split_path=split_path, mmap_mode=mmap_mode) if use_cache else self.read_split_array(split_path=split_path, mmap_mode=mmap_mode)
                 #logger.custom_debug(f"Loaded array of shape {split_data.shape} from {split_path}")
             else:
                 split_data = torch.load(split_path)
+                StageMetrics.add_bytes_read(os.path.getsize(split_path))
             split_dict[split] = split_data
 
             logger.custom_debug(f"Loading split data {type_of_content} from {split_path}")
@@ -433,6 +588,310 @@ class BasicOperationsHelper:
         return split_dict
 
     
+    def load_cached_split_array(self, split_path: str, mmap_mode: str = None) -> np.ndarray:
+        """
+        Loads a .npy split through the process-wide LRU cache. Entries are validated by mtime and size of the file (and of the split store) and evicted least recently used first
+        once split_data_cache_max_bytes is exceeded. Returned arrays are shared between callers and therefore read-only.
+        Copy-on-write or writable memory maps (mmap_mode "c", "r+") are never cached.
+        """
+        if mmap_mode not in [None, "r"] or BasicOperationsHelper.split_data_cache_max_bytes <= 0:
+            return self.read_split_array(split_path=split_path, mmap_mode=mmap_mode)
+
+        cache = BasicOperationsHelper.split_data_cache
+        cache_key = (os.path.abspath(split_path), mmap_mode)
+        source_paths = [self.get_split_store_path(), split_path] if self.split_storage_backend == "hdf5" else [split_path]
+        file_version = tuple((os.stat(source_path).st_mtime_ns, os.stat(source_path).st_size) for source_path in source_paths if os.path.exists(source_path))
+        if cache_key in cache:
+            cached_version, cached_array = cache[cache_key]
+            if cached_version == file_version:
+                cache.move_to_end(cache_key)
+                logger.custom_debug(f"Split data cache hit for {split_path}")
+                return cached_array
+            self.invalidate_split_data_cache(split_path=split_path)
+
+        split_array = self.read_split_array(split_path=split_path, mmap_mode=mmap_mode)
+        split_array.flags.writeable = False
+        array_bytes = 0 if isinstance(split_array, np.memmap) else split_array.nbytes
+        if array_bytes <= BasicOperationsHelper.split_data_cache_max_bytes:
+            cache[cache_key] = (file_version, split_array)
+            BasicOperationsHelper.split_data_cache_bytes += array_bytes
+            while BasicOperationsHelper.split_data_cache_bytes > BasicOperationsHelper.split_data_cache_max_bytes:
+                evicted_key, (_, evicted_array) = cache.popitem(last=False)
+                BasicOperationsHelper.split_data_cache_bytes -= 0 if isinstance(evicted_array, np.memmap) else evicted_array.nbytes
+                logger.custom_debug(f"Evicted {evicted_key[0]} from split data cache")
+
+        return split_array
+
+
+    def invalidate_split_data_cache(self, split_path: str = None) -> None:
+        """
+        Removes all cached versions of split_path (all entries if split_path is None) from the process-wide split data cache.
+        """
+        cache = BasicOperationsHelper.split_data_cache
+        cache_keys = list(cache) if split_path is None else [cache_key for cache_key in cache if cache_key[0] == os.path.abspath(split_path)]
+        for cache_key in cache_keys:
+            _, cached_array = cache.pop(cache_key)
+            BasicOperationsHelper.split_data_cache_bytes -= 0 if isinstance(cached_array, np.memmap) else cached_array.nbytes
+
+
+    def get_split_store_path(self) -> str:
+        """
+        Returns the path of the hdf5 split store of the subject (split_storage_backend "hdf5").
+        """
+        return f"data_files/{self.lock_event}/split_store/subject_{self.subject_id}.h5"
+
+
+    def get_split_store_key(self, split_path: str) -> str:
+        """
+        Maps the path of a .npy split file to its dataset name in the split store, e.g. meg_data/norm_x/subject_02/session_1/train/meg_data.
+        """
+        relative_split_path = os.path.relpath(os.path.normpath(split_path), f"data_files/{self.lock_event}")
+
+        return os.path.splitext(relative_split_path)[0].replace(os.sep, "/")
+
+
+    @contextlib.contextmanager
+    def open_split_store(self, mode: str = "r"):
+        """
+        Opens the hdf5 split store of the subject while holding a lock on {store}.lock: shared for reading, exclusive for writing.
+        This serializes writers of concurrent stage processes of the subject (flock, i.e. processes on one node; the store cannot be shared by work queue workers).
+        """
+        store_path = self.get_split_store_path()
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        with open(f"{store_path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if mode == "r" else fcntl.LOCK_EX)
+            try:
+                with h5py.File(store_path, mode) as f:
+                    yield f
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+    def repack_split_store(self) -> None:
+        """
+        Rewrites the split store of the subject into a new file that replaces it. HDF5 never gives the space of deleted or replaced datasets back,
+        so without repacking every re-export (e.g. each normalize_meg_dataset_across_sessions) grows the store. Memory-mapped splits of the old store stay valid.
+        """
+        store_path = self.get_split_store_path()
+        if not os.path.exists(store_path):
+            return
+        store_size = os.path.getsize(store_path)
+        temporary_path = self.get_temporary_path(store_path)
+        try:
+            with self.open_split_store("a") as f, h5py.File(temporary_path, "w") as repacked_f:
+                for key in f:
+                    f.copy(f[key], repacked_f, name=key)
+                # Temporary datasets of interrupted writes
+                temporary_keys = []
+                repacked_f.visit(lambda key: temporary_keys.append(key) if ".tmp_" in key else None)
+                for key in temporary_keys:
+                    if key in repacked_f:
+                        del repacked_f[key]
+                os.replace(temporary_path, store_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        self.invalidate_split_data_cache()
+        logger.custom_info(f"Repacked split store {store_path} from {store_size / 1024**3:.2f} GB to {os.path.getsize(store_path) / 1024**3:.2f} GB")
+
+
+    def read_split_array(self, split_path: str, mmap_mode: str = None) -> np.ndarray:
+        """
+        Reads a .npy split. With the hdf5 backend, the split is read from the store (memory-mapped if possible, i.e. only the accessed epochs are read)
+        and split_path is used as fallback for splits that are not in the store yet (e.g. streamed features, see open_split_memmap_for_writing).
+        """
+        split_array = None
+        store_path = self.get_split_store_path()
+        if self.split_storage_backend == "hdf5" and os.path.exists(store_path):
+            with self.open_split_store("r") as f:
+                dataset_key = self.get_split_store_key(split_path)
+                if dataset_key in f:
+                    split_array = self.read_hdf5_dataset(f[dataset_key], mmap_mode=mmap_mode)
+        if split_array is None:
+            split_array = np.load(split_path, mmap_mode=mmap_mode)
+        StageMetrics.add_bytes_read(split_array.nbytes, memory_mapped=isinstance(split_array, np.memmap))
+
+        return split_array
+
+
+    def write_split_array_to_store(self, split_path: str, split_array: np.ndarray) -> None:
+        """
+        Writes a split into the hdf5 store under the key of split_path, holding the exclusive store lock. The array is written to a temporary dataset first
+        and only replaces the stored version (by renaming the link) once it is complete, so readers never see partially written splits.
+        This does not protect the store itself: a writer killed while the file is open can corrupt the hdf5 metadata and thereby all splits of the subject.
+        Replaced datasets keep occupying disk space until repack_split_store.
+        """
+        store_path = self.get_split_store_path()
+        dataset_key = self.get_split_store_key(split_path)
+        temporary_key = f"{dataset_key}.tmp_{uuid.uuid4().hex}"
+        compression_kwargs = {"compression": self.split_store_compression, "chunks": True} if self.split_store_compression is not None else {}
+
+        with self.open_split_store("a") as f:
+            dataset = f.create_dataset(temporary_key, data=np.asarray(split_array), **compression_kwargs)
+            StageMetrics.add_bytes_written(dataset.nbytes)
+            dataset.attrs["modification_time"] = time.time()
+            f.flush()
+            if dataset_key in f:
+                del f[dataset_key]
+            f.move(temporary_key, dataset_key)
+        self.invalidate_split_data_cache(split_path=split_path)
+        logger.custom_debug(f"Stored split {dataset_key} in {store_path}")
+
+
+    def delete_split_array_from_store(self, split_path: str) -> None:
+        """
+        Removes the split of split_path from the hdf5 store, if present.
+        """
+        store_path = self.get_split_store_path()
+        if os.path.exists(store_path):
+            with self.open_split_store("a") as f:
+                dataset_key = self.get_split_store_key(split_path)
+                if dataset_key in f:
+                    del f[dataset_key]
+        self.invalidate_split_data_cache(split_path=split_path)
+
+
+    def split_data_exists(self, split_path: str) -> bool:
+        """
+        True if a split exists, in the split store or as file.
+        """
+        store_path = self.get_split_store_path()
+        if self.split_storage_backend == "hdf5" and os.path.exists(store_path):
+            with self.open_split_store("r") as f:
+                if self.get_split_store_key(split_path) in f:
+                    return True
+
+        return os.path.exists(split_path)
+
+
+    def get_split_data_modification_time(self, split_path: str) -> float:
+        """
+        Returns the time a split was last written, from the split store if it contains the split and from the file otherwise.
+        """
+        store_path = self.get_split_store_path()
+        if self.split_storage_backend == "hdf5" and os.path.exists(store_path):
+            with self.open_split_store("r") as f:
+                dataset_key = self.get_split_store_key(split_path)
+                if dataset_key in f:
+                    return float(f[dataset_key].attrs["modification_time"])
+
+        return os.path.getmtime(split_path)
+
+
+    def import_split_files_into_store(self, delete_files: bool = False) -> None:
+        """
+        Moves all existing .npy split files of the subject into the hdf5 split store (torch datasets stay .pt files).
+        If delete_files is True, each file is removed after its split has been stored.
+        """
+        split_file_pattern = re.compile(rf"(^|/)subject_{self.subject_id}/(session_[^/]+/)?(train|test)/[^/]+\.npy$")
+        n_imported = 0
+        for root, _, files in os.walk(f"data_files/{self.lock_event}"):
+            for file in files:
+                split_path = os.path.join(root, file)
+                if not split_file_pattern.search(split_path.replace(os.sep, "/")):
+                    continue
+                self.write_split_array_to_store(split_path=split_path, split_array=np.load(split_path, mmap_mode="r"))
+                if delete_files:
+                    os.remove(split_path)
+                n_imported += 1
+        logger.custom_info(f"Imported {n_imported} split files into {self.get_split_store_path()}")
+
+
+    def get_temporary_path(self, save_path: str, stale_age_h: float = 24) -> str:
+        """
+        Returns a temporary path next to save_path (named by host and process) to write save_path atomically. Temporary files of earlier writes of save_path
+        that were killed are removed first: those of this host whose process is gone, those of other hosts (and unnamed ones) once unmodified for stale_age_h hours.
+        """
+        hostname = socket.gethostname()
+        for temporary_path in glob.glob(f"{glob.escape(save_path)}.tmp_*"):
+            temporary_name_parts = temporary_path[len(f"{save_path}.tmp_"):].rsplit("_", 2)
+            if len(temporary_name_parts) == 3 and temporary_name_parts[0] == hostname and temporary_name_parts[1].isdigit():
+                try:
+                    os.kill(int(temporary_name_parts[1]), 0)
+                    continue
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    continue
+            else:
+                try:
+                    if time.time() - os.path.getmtime(temporary_path) < stale_age_h * 3600:
+                        continue
+                except FileNotFoundError:
+                    continue
+            try:
+                os.remove(temporary_path)
+                logger.custom_debug(f"Removed stale temporary file {temporary_path}")
+            except FileNotFoundError:
+                pass
+
+        return f"{save_path}.tmp_{hostname}_{os.getpid()}_{uuid.uuid4().hex}"
+
+
+    def write_file_atomically(self, save_path: str, write_file, mode: str = 'wb') -> None:
+        """
+        Writes save_path with write_file(file) into a temporary file next to it that replaces save_path once complete, so killed jobs never leave truncated files.
+        """
+        temporary_path = self.get_temporary_path(save_path)
+        try:
+            with open(temporary_path, mode) as file:
+                write_file(file)
+            os.replace(temporary_path, save_path)
+            StageMetrics.add_bytes_written(os.path.getsize(save_path))
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+
+    def save_array_atomically(self, save_path: str, array: np.ndarray) -> None:
+        """
+        Saves an array as .npy file atomically (see write_file_atomically).
+        """
+        self.write_file_atomically(save_path=save_path, write_file=lambda file: np.save(file, array))
+
+
+    def get_session_checkpoint_path(self, step_name: str, session_id: str, normalization: str = None) -> str:
+        """
+        Returns the path of the completion marker of a session (and normalization) of a pipeline step, e.g. "features" or "GLM_training".
+        """
+        norm_folder = f"/norm_{normalization}" if normalization is not None else ""
+
+        return f"data_files/{self.lock_event}/session_checkpoints/subject_{self.subject_id}/{step_name}{norm_folder}/session_{session_id}.json"
+
+
+    def calculate_session_input_hash(self, config: dict, split_paths: list = [], file_paths: list = []) -> str:
+        """
+        Hash of the settings of a session step and of the versions (modification times) of its input splits and files.
+        """
+        hash_input = {"config": config,
+                      "split_versions": {split_path: self.get_split_data_modification_time(split_path=split_path) for split_path in split_paths},
+                      "file_versions": {file_path: os.path.getmtime(file_path) for file_path in file_paths}}
+        hash_input_json = json.dumps(hash_input, sort_keys=True, default=lambda value: value.tolist() if isinstance(value, (np.ndarray, np.generic)) else str(value))
+
+        return hashlib.sha256(hash_input_json.encode("utf-8")).hexdigest()
+
+
+    def is_session_completed(self, step_name: str, session_id: str, input_hash: str, normalization: str = None) -> bool:
+        """
+        True if the session was completed with the same inputs and settings (its completion marker matches input_hash).
+        """
+        checkpoint_path = self.get_session_checkpoint_path(step_name=step_name, session_id=session_id, normalization=normalization)
+        if not os.path.exists(checkpoint_path):
+            return False
+        with open(checkpoint_path, 'r') as file:
+            return json.load(file)["input_hash"] == input_hash
+
+
+    def mark_session_completed(self, step_name: str, session_id: str, input_hash: str, normalization: str = None) -> None:
+        """
+        Writes the completion marker of a session once all its outputs are stored, so a restarted step skips it.
+        """
+        checkpoint_path = self.get_session_checkpoint_path(step_name=step_name, session_id=session_id, normalization=normalization)
+        os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+        self.write_file_atomically(save_path=checkpoint_path, write_file=lambda file: json.dump({"input_hash": input_hash, "completed": time.strftime("%Y-%m-%d %H:%M:%S")}, file), mode='w')
+        logger.custom_debug(f"[Session {session_id}]: Marked {step_name} as completed")
+
+
     def save_plot_as_file(self, plt, plot_folder: str, plot_file: str, plot_type: str = None):
         """
         Helper function to save a plot as file.
@@ -440,11 +899,41 @@ class BasicOperationsHelper:
         os.makedirs(plot_folder, exist_ok=True)
         plot_path = os.path.join(plot_folder, plot_file)
         plt.savefig(plot_path)
+        StageMetrics.add_bytes_written(os.path.getsize(plot_path))
+        StageMetrics.count_items("plots")
         # Mne plots cannot be closed
         #if plot_type not in ["mne", "figure"]:
         #    plt.close()
 
 
+    def read_hdf5_dataset(self, dataset: h5py.Dataset, mmap_mode: str = None) -> np.ndarray:
+        """
+        Helper function to read a h5py dataset. Contiguous, uncompressed datasets are memory-mapped directly from the file if mmap_mode is set, all others are read completely.
+        """
+        dataset_offset = dataset.id.get_offset()
+        if mmap_mode is not None and dataset.chunks is None and dataset_offset is not None and dataset.size > 0:
+            return np.memmap(dataset.file.filename, dtype=dataset.dtype, mode=mmap_mode, offset=dataset_offset, shape=dataset.shape)
+
+        return dataset[()]
+
+
+    def calculate_fit_measures_by_sensor_timepoint(self, Y_true: np.ndarray, Y_pred: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Vectorized variance explained (r2_score) and pearson r over epochs for every sensor and timepoint.
+        Expects arrays of shape (epochs, sensors, timepoints), returns two arrays of shape (sensors, timepoints).
+        """
+        Y_true_centered = Y_true - Y_true.mean(axis=0)
+        Y_pred_centered = Y_pred - Y_pred.mean(axis=0)
+
+        sum_squares_total = np.sum(Y_true_centered**2, axis=0)
+        sum_squares_residual = np.sum((Y_true - Y_pred)**2, axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            var_explained = 1 - sum_squares_residual / sum_squares_total
+            r_pearson = np.sum(Y_true_centered * Y_pred_centered, axis=0) / np.sqrt(sum_squares_total * np.sum(Y_pred_centered**2, axis=0))
+
+        return var_explained, r_pearson
+
+
     def normalize_array(self, data: np.ndarray, normalization:str, n_channels:int = None, session_id:str = None):
         """
         Helper function to normalize meg
@@ -541,6 +1030,7 @@ class MetadataHelper(BasicOperationsHelper):
         self.crop_metadata_path = f"/share/klab/psulewski/psulewski/active-visual-semantics/input/fixation_crops/avs_meg_fixation_crops_scene_{crop_size}/metadata/as{self.subject_id}_crops_metadata.csv"
         self.meg_metadata_folder = f"/share/klab/datasets/avs/population_codes/as{self.subject_id}/sensor/erf/filter_0.2_200/ica"  # f"/share/klab/datasets/avs/population_codes/as{self.subject_id}/sensor/filter_0.2_200"
     
+    @StageMetrics.measure
     def create_combined_metadata_dict(self, investigate_missing_metadata=False) -> None:
         """
         Creates the combined metadata dict with timepoints that can be found in both meg and crop metadata for the respective session and trial.
@@ -606,6 +1096,7 @@ class MetadataHelper(BasicOperationsHelper):
         self.save_dict_as_json(type_of_content="combined_metadata", dict_to_store=combined_metadata_dict)
 
 
+    @StageMetrics.measure
     def create_meg_metadata_dict(self) -> None:
         """
         Creates the meg metadata dict for the participant and stores it.
@@ -653,6 +1144,7 @@ class MetadataHelper(BasicOperationsHelper):
         self.save_dict_as_json(type_of_content="meg_metadata", dict_to_store=data_dict)
 
 
+    @StageMetrics.measure
     def create_crop_metadata_dict(self) -> None:
         """
         Creates the crop metadata dict for the participant and stores it.
@@ -736,6 +1228,7 @@ class DatasetHelper(MetadataHelper):
         self.timepoint_min = timepoint_min
         self.timepoint_max = timepoint_max
 
+    @StageMetrics.measure
     def create_crop_dataset(self, debugging=False) -> None:
         """
         Creates the crop dataset with all crops in the combined_metadata (crops for which meg data exists)
@@ -807,9 +1300,12 @@ class DatasetHelper(MetadataHelper):
                 logger.custom_debug(f"Session {session_id} Total Datapoints: {n_datapoints_session}")           
 
 
-    def create_meg_dataset(self, use_ica_cleaned_data=True, interpolate_outliers=False, clip_outliers=True) -> None:
+    @StageMetrics.measure
+    def create_meg_dataset(self, use_ica_cleaned_data=True, interpolate_outliers=False, clip_outliers=True, resume=True, normalize_across_sessions=True) -> None:
         """
         Creates the crop dataset with all crops in the combined_metadata (crops for which meg data exists)
+        If resume is True, the per-session step is skipped for sessions and normalizations that were completed with the same inputs and settings (the normalization across sessions is always recomputed).
+        If normalize_across_sessions is False, only the per-session step runs (e.g. for a single session in a work queue task) and normalize_meg_dataset_across_sessions has to be called once all sessions are created.
         """
         if interpolate_outliers and clip_outliers:
             raise ValueError("create_meg_dataset called with invalid parameter configuration. Can either clip or interpolate eithers, not both.")
@@ -832,9 +1328,19 @@ class DatasetHelper(MetadataHelper):
 
         for session_id_char in self.session_ids_char:
             session_id_num = self.map_session_letter_id_to_num(session_id_char)
+            meg_data_file = f"as{self.subject_id}{session_id_char}_population_codes_{self.lock_event}_500hz_masked_False.h5"
+            session_input_paths = {"split_paths": [self.get_split_data_path(session_id_num=session_id_num, type_of_content="trial_splits", split=split) for split in ["train", "test"]],
+                                   "file_paths": [os.path.join(meg_data_folder, meg_data_file)] + [f"data_files/{self.lock_event}/metadata/{type_of_content}/subject_{self.subject_id}/{type_of_content}_dict.json" for type_of_content in ["combined_metadata", "meg_metadata"]]}
+            session_input_hashes = {normalization: self.calculate_session_input_hash(config={"normalization": normalization, "chosen_channels": [str(channel) for channel in self.chosen_channels], "timepoint_min": self.timepoint_min, "timepoint_max": self.timepoint_max, 
+                                                                                         "use_ica_cleaned_data": use_ica_cleaned_data, "interpolate_outliers": interpolate_outliers, "clip_outliers": clip_outliers}, **session_input_paths)
+                                    for normalization in self.normalizations}
+            normalizations_to_create = [normalization for normalization in self.normalizations 
+                                        if not (resume and self.is_session_completed(step_name="meg_dataset", session_id=session_id_num, input_hash=session_input_hashes[normalization], normalization=normalization))]
+            if not normalizations_to_create:
+                logger.custom_info(f"[Session {session_id_num}]: MEG dataset was completed before, skipping session.")
+                continue
             logger.custom_debug(f"Creating meg dataset for session {session_id_num}")
             # Load session MEG data from .h5
-            meg_data_file = f"as{self.subject_id}{session_id_char}_population_codes_{self.lock_event}_500hz_masked_False.h5"
             with h5py.File(os.path.join(meg_data_folder, meg_data_file), "r") as f:
                 meg_data = {}
                 meg_data["grad"] = f['grad']['onset']  # shape participant 2, session a saccade: (2945, 204, 601), fixation: (2874, 204, 401) 
@@ -865,7 +1371,7 @@ class DatasetHelper(MetadataHelper):
                         raise ValueError("Neither mag or grad channels selected.")
 
                 # Create datasets based on specified normalizations
-                for normalization in self.normalizations:
+                for normalization in normalizations_to_create:
                     normalization_stage = normalization if normalization != "mean_centered_ch_then_global_robust_scaling" else "mean_centered_ch"
                     # Debugging
                     if session_id_num == "1":
@@ -952,10 +1458,21 @@ class DatasetHelper(MetadataHelper):
                                                 type_of_content="meg_data",
                                                 array_dict=meg_split,
                                                 type_of_norm=normalization_stage)
+                    self.mark_session_completed(step_name="meg_dataset", session_id=session_id_num, input_hash=session_input_hashes[normalization], normalization=normalization)
 
         logger.custom_debug(f"meg_timepoints_in_dataset after per-session normalization: {n_epochs_two_step_norm}")
         logger.custom_debug(f"combined train+test: {n_epochs_two_step_norm['train'] + n_epochs_two_step_norm['test']}")
 
+        if normalize_across_sessions:
+            self.normalize_meg_dataset_across_sessions(interpolate_outliers=interpolate_outliers, clip_outliers=clip_outliers)
+
+
+    @StageMetrics.measure
+    def normalize_meg_dataset_across_sessions(self, interpolate_outliers=False, clip_outliers=True) -> None:
+        """
+        Second step of the two step normalization mean_centered_ch_then_global_robust_scaling: z-scores the mean centered data of all sessions combined and splits it into sessions again.
+        Does nothing for other normalizations.
+        """
         if "mean_centered_ch_then_global_robust_scaling" in self.normalizations:
             #n_grad = len(selected_channel_indices["grad"])  # Needed when seperating sensor types
             #n_mag = len(selected_channel_indices["mag"])  # Needed when seperating sensor types
@@ -1091,9 +1608,11 @@ class DatasetHelper(MetadataHelper):
         
 
 
-    def create_train_test_split(self, debugging=False):
+    @StageMetrics.measure
+    def create_train_test_split(self, debugging=False, random_seed:int = 0):
         """
         Creates train/test split of trials based on scene_ids.
+        The scene order of each session is shuffled with a generator seeded by random_seed and the session id, so that re-creating the split is reproducible.
         """
         # Read combined metadata from json
         combined_metadata = self.read_dict_from_json(type_of_content="combined_metadata")
@@ -1147,7 +1666,7 @@ class DatasetHelper(MetadataHelper):
             index = 0        
             # Shuffle the scenes in the session, so that the test split does not always contain the latest scenes (I iterated by trials and timepoints above)
             session_scene_ids = list(scene_ids[session_id].keys())
-            random.shuffle(session_scene_ids)
+            random.Random(f"{random_seed}_{session_id}").shuffle(session_scene_ids)
             for scene_id in session_scene_ids:
                 for trial_id in scene_ids[session_id][scene_id]["trials"]:
                     # Each unique combination is one point in the dataset
@@ -1177,18 +1696,19 @@ class DatasetHelper(MetadataHelper):
                                         array_dict=split_dict)
 
 
+    @StageMetrics.measure
     def create_pytorch_dataset(self, debugging=False):
         """
         Creates pytorch datasets from numpy image datasets.
         """
         
         for session_id in self.session_ids_num:
-            # Load numpy datasets for session
-            crop_ds = self.load_split_data_from_file(session_id_num=session_id, type_of_content="crop_data")
+            # Memory-map numpy datasets for session (copy-on-write, so that torch does not complain about read-only memory)
+            crop_ds = self.load_split_data_from_file(session_id_num=session_id, type_of_content="crop_data", mmap_mode="c")
 
-            # Convert arrays to PyTorch tensors and create Dataset
-            train_tensors = torch.tensor(crop_ds['train'], dtype=torch.float32)
-            test_tensors = torch.tensor(crop_ds['test'], dtype=torch.float32)
+            # Wrap arrays as (uint8) PyTorch tensors without an additional float copy. Conversion to float is done per batch during extraction
+            train_tensors = torch.from_numpy(crop_ds['train'])
+            test_tensors = torch.from_numpy(crop_ds['test'])
             tensor_dict = {"train": train_tensors, "test": test_tensors}
 
             if debugging:
@@ -1250,10 +1770,49 @@ class ExtractionHelper(BasicOperationsHelper):
         self.pca_components = pca_components
 
     
-    def extract_features(self):
+    class CropBatchDataset(Dataset):
+        """
+        Inner class that serves whole batches of crops from a memory-mapped uint8 crop array.
+        Conversion to float32 and the permutation to (channels, height, width) are done per batch (inside the DataLoader workers), so that a session is never held in memory as a float copy.
+        """
+        def __init__(self, crop_path:str, batch_size:int, row_indices:np.ndarray = None):
+            self.crop_path = crop_path
+            self.batch_size = batch_size
+            self.crops = None  # Opened lazily in each worker, a pickled memmap would be copied to the worker completely
+            if row_indices is None:
+                row_indices = np.arange(len(np.load(crop_path, mmap_mode="r")))
+            self.row_indices = np.asarray(row_indices)
+
+        def __len__(self):
+            return int(np.ceil(len(self.row_indices) / self.batch_size))
+
+        def __getitem__(self, batch_idx):
+            if self.crops is None:
+                self.crops = np.load(self.crop_path, mmap_mode="r")
+            batch_rows = self.row_indices[batch_idx*self.batch_size:(batch_idx+1)*self.batch_size]
+            # Only the rows of this batch are read from disk
+            batch = torch.from_numpy(np.ascontiguousarray(self.crops[batch_rows]))
+
+            return batch.permute(0, 3, 1, 2).float()
+
+
+    @StageMetrics.measure
+    def extract_features(self, num_workers:int = 4, prefetch_factor:int = 2, use_feature_cache:bool = True, resume:bool = True):
         """
         Extracts features from crop datasets over all sessions for a subject.
+        Crops are streamed batch-wise from memory-mapped arrays and features are written incrementally into memory-mapped output arrays, so peak memory is bounded by a few batches instead of the session size.
+        If use_feature_cache is True, activations are only computed for crops that are not yet in the content-addressed feature cache of the model/module, all other rows are copied from the cache.
+        If resume is True, sessions that were completed with the same crops and model/module are skipped.
         """
+        session_input_hashes = {session_id: self.calculate_session_input_hash(config={"ann_model": self.ann_model, "module_name": self.module_name}, 
+                                                                              split_paths=[self.get_split_data_path(session_id_num=session_id, type_of_content="crop_data", split=split) for split in ["train", "test"]])
+                                for session_id in self.session_ids_num}
+        sessions_to_extract = [session_id for session_id in self.session_ids_num if not (resume and self.is_session_completed(step_name="features", session_id=session_id, input_hash=session_input_hashes[session_id]))]
+        if len(sessions_to_extract) < len(self.session_ids_num):
+            logger.custom_info(f"Resuming feature extraction, skipping completed sessions {[session_id for session_id in self.session_ids_num if session_id not in sessions_to_extract]}")
+        if not sessions_to_extract:
+            return
+
         # Load model
         model_name = f'{self.ann_model}_ecoset'
         source = 'custom'
@@ -1266,189 +1825,609 @@ class ExtractionHelper(BasicOperationsHelper):
             pretrained=True
         )
 
-        for session_id in self.session_ids_num:
-            # Load torch datasets for session
-            #torch_crop_ds = self.load_split_data_from_file(session_id_num=session_id, type_of_content="torch_dataset")
+        for session_id in sessions_to_extract:
+            n_features = None
+            empty_splits = []
+            for split in ["train", "test"]:
+                crop_path = self.get_split_data_path(session_id_num=session_id, type_of_content="crop_data", split=split)
+                if len(np.load(crop_path, mmap_mode="r")) == 0:
+                    empty_splits.append(split)
+                    continue
 
-            # Load numpy datasets for session
-            crop_ds = self.load_split_data_from_file(session_id_num=session_id, type_of_content="crop_data")
+                if use_feature_cache:
+                    features_split = self.extract_features_with_cache(extractor=extractor, crop_path=crop_path, session_id=session_id, split=split, num_workers=num_workers, prefetch_factor=prefetch_factor)
+                else:
+                    crop_dataset = ExtractionHelper.CropBatchDataset(crop_path=crop_path, batch_size=self.batch_size)
+                    n_crops = len(crop_dataset.row_indices)
+                    open_output = lambda n_rows, n_features: self.open_split_memmap_for_writing(session_id=session_id, type_of_content="ann_features", split=split, shape=(n_rows, n_features), ann_model=self.ann_model, module=self.module_name)
+                    features_split = self.extract_features_streamed(extractor=extractor, crop_dataset=crop_dataset, n_rows=n_crops, open_output=open_output, num_workers=num_workers, prefetch_factor=prefetch_factor)
+
+                self.finalize_split_memmap(split_memmap=features_split)
+                StageMetrics.count_items("crops", len(features_split))
+                n_features = features_split.shape[1]
+                # Debugging
+                logger.custom_debug(f"Session {session_id}: {split}_features.shape: {features_split.shape}")
+                del features_split
 
-            # Convert arrays to PyTorch tensors and create Dataset
-            train_tensors = torch.tensor(crop_ds['train'], dtype=torch.float32)
-            test_tensors = torch.tensor(crop_ds['test'], dtype=torch.float32)
+            # Splits without crops get an empty feature array (with the feature dimensionality of the other split, if known), so the session can be completed
+            for split in empty_splits:
+                logger.warning(f"[Session {session_id}][{split} split]: No crops, storing empty features.")
+                empty_features = self.open_split_memmap_for_writing(session_id=session_id, type_of_content="ann_features", split=split, shape=(0, n_features or 0), ann_model=self.ann_model, module=self.module_name)
+                self.finalize_split_memmap(split_memmap=empty_features)
 
-            # Transpose dimensions to match (channels, height, width) (instead of height,width,channels as before)
-            train_tensors = train_tensors.permute(0, 3, 1, 2)
-            test_tensors = test_tensors.permute(0, 3, 1, 2)
+            self.mark_session_completed(step_name="features", session_id=session_id, input_hash=session_input_hashes[session_id])
 
-            # Create a DataLoader to handle batching
-            model_input = {}
-            model_input["train"] =  DataLoader(train_tensors, batch_size=self.batch_size, shuffle=False)
-            model_input["test"] = DataLoader(test_tensors, batch_size=self.batch_size, shuffle=False)
-    
-            features_split = {}
-            for split in ["train", "test"]:
-                # Extract features
-                features_split[split] = extractor.extract_features(
-                    batches=model_input[split],
-                    module_name=self.module_name,
-                    flatten_acts=True  # flatten 2D feature maps from convolutional layer
-                )
 
-                # Debugging
-                logger.custom_debug(f"Session {session_id}: {split}_features.shape: {features_split[split].shape}")
+    def extract_features_streamed(self, extractor, crop_dataset:Dataset, n_rows:int, open_output, num_workers:int, prefetch_factor:int) -> np.memmap:
+        """
+        Runs the extractor over all batches of crop_dataset and writes the flattened activations into the memory-mapped array returned by open_output(n_rows, n_features).
+        """
+        # batch_size=None: the dataset already yields complete batches
+        loader_kwargs = {"num_workers": num_workers, "prefetch_factor": prefetch_factor, "persistent_workers": False} if num_workers > 0 else {}
+        model_input = DataLoader(crop_dataset, batch_size=None, shuffle=False, pin_memory=torch.cuda.is_available(), **loader_kwargs)
+
+        features = None
+        row_start = 0
+        for batch in model_input:
+            batch_features = extractor.extract_batch(
+                batch=batch,
+                module_name=self.module_name,
+                flatten_acts=True,  # flatten 2D feature maps from convolutional layer
+                output_type="ndarray"
+            )
+            # The feature dimensionality is only known after the first batch
+            if features is None:
+                features = open_output(n_rows, batch_features.shape[1])
+            features[row_start:row_start+len(batch_features)] = batch_features
+            row_start += len(batch_features)
+
+        if features is None:
+            raise ValueError(f"No crops found to extract features from in {crop_dataset.crop_path}.")
+        features.flush()
+
+        return features
+
+
+    def get_feature_cache_folder(self) -> str:
+        """
+        Returns the folder of the content-addressed feature cache. The cache is shared over subjects, lock events, crop sizes and splits, only model and module define it.
+        """
+        return f"data_files/feature_cache/{self.ann_model}/{self.module_name}"
 
-            # Export numpy array to .npz
-            self.export_split_data_as_file(session_id=session_id, type_of_content="ann_features", array_dict=features_split, ann_model=self.ann_model, module=self.module_name)
 
-    def reduce_feature_dimensionality(self, z_score_features_before_pca:bool = True, all_sessions_combined:bool = False):
+    def hash_crops(self, crop_path:str, hash_batch_size:int = 1024) -> np.ndarray:
         """
-        Reduces dimensionality of extracted features using PCA. This seems to be necessary to avoid overfit in the ridge Regression.
+        Computes a content hash for every crop (row) of a memory-mapped crop array. Shape and dtype are part of the hash, so that crops of different sizes never collide.
         """
-        def apply_pca_to_features(ann_features):
-            """
-            Fits pca on train and test features  combined. Use fix amount of components to allow cross-session predictions
-            """
-            ann_features_combined = np.concatenate((ann_features["train"], ann_features["test"]))
-            if z_score_features_before_pca:
-                ann_features_combined = self.normalize_array(data=ann_features_combined, normalization="z_score")
-                n_train = len(ann_features["train"])
-                ann_features["train"] = ann_features_combined[:n_train,:]
-                ann_features["test"] = ann_features_combined[n_train:,:]
-
-            pca = PCA(n_components=self.pca_components)
-            pca.fit(ann_features_combined)
-            explained_var_per_component = pca.explained_variance_ratio_
-            explained_var = 0
-            for explained_var_component in explained_var_per_component:
-                explained_var += explained_var_component
-
-            # Transform splits
-            for split in ann_features:
-                ann_features[split] = pca.transform(ann_features[split])
+        crops = np.load(crop_path, mmap_mode="r")
+        crop_description = f"{crops.shape[1:]}_{crops.dtype}".encode()
+        crop_hashes = []
+        for batch_start in range(0, len(crops), hash_batch_size):
+            crop_batch = np.ascontiguousarray(crops[batch_start:batch_start+hash_batch_size])
+            for crop in crop_batch:
+                crop_hashes.append(hashlib.blake2b(crop_description + crop.tobytes(), digest_size=16).hexdigest())
+
+        return np.array(crop_hashes, dtype="S32")
+
+
+    def load_feature_cache_index(self) -> Tuple[dict, dict]:
+        """
+        Reads the index of the feature cache. Returns a dict crop_hash -> (chunk_name, row) and a dict chunk_name -> path of the chunk features.
+        Chunks are only considered complete (and indexed) once their hash file exists, it is written after the features.
+        """
+        cache_folder = self.get_feature_cache_folder()
+        cache_index = {}
+        chunk_feature_paths = {}
+        if not os.path.isdir(cache_folder):
+            return cache_index, chunk_feature_paths
+
+        for file_name in sorted(os.listdir(cache_folder)):
+            if not file_name.endswith("_hashes.npy"):
+                continue
+            chunk_name = file_name[:-len("_hashes.npy")]
+            chunk_hashes = np.load(os.path.join(cache_folder, file_name))
+            chunk_feature_paths[chunk_name] = os.path.join(cache_folder, f"{chunk_name}_features.npy")
+            for row, crop_hash in enumerate(chunk_hashes):
+                cache_index.setdefault(bytes(crop_hash), (chunk_name, row))
+
+        return cache_index, chunk_feature_paths
+
+
+    def extract_features_with_cache(self, extractor, crop_path:str, session_id:str, split:str, num_workers:int, prefetch_factor:int, copy_batch_size:int = 1024) -> np.memmap:
+        """
+        Extracts features only for crops whose content hash is not yet in the feature cache, stores them as a new cache chunk
+        and assembles the ann_features array of the split from the cache (as memmap opened with open_split_memmap_for_writing, to be finalized by the caller).
+        """
+        crop_hashes = self.hash_crops(crop_path)
+        cache_index, chunk_feature_paths = self.load_feature_cache_index()
+
+        # Find unseen crops, each unique crop is only extracted once (the first row it occurs in)
+        unseen_rows = {}
+        for row, crop_hash in enumerate(crop_hashes):
+            crop_hash = bytes(crop_hash)
+            if crop_hash not in cache_index and crop_hash not in unseen_rows:
+                unseen_rows[crop_hash] = row
+        logger.custom_info(f"[Session {session_id}][{split} split]: {len(crop_hashes)} crops, {len(set(crop_hashes.tolist()))} unique, {len(unseen_rows)} not in feature cache.")
+
+        if unseen_rows:
+            cache_folder = self.get_feature_cache_folder()
+            os.makedirs(cache_folder, exist_ok=True)
+            # Unique chunk names, so that concurrent extractions never write to the same chunk
+            chunk_name = f"chunk_{time.strftime('%Y%m%d-%H%M%S')}_{uuid.uuid4().hex[:8]}"
+            chunk_feature_path = os.path.join(cache_folder, f"{chunk_name}_features.npy")
+
+            crop_dataset = ExtractionHelper.CropBatchDataset(crop_path=crop_path, batch_size=self.batch_size, row_indices=np.array(list(unseen_rows.values())))
+            open_output = lambda n_rows, n_features: np.lib.format.open_memmap(chunk_feature_path, mode="w+", dtype=np.float32, shape=(n_rows, n_features))
+            chunk_features = self.extract_features_streamed(extractor=extractor, crop_dataset=crop_dataset, n_rows=len(unseen_rows), open_output=open_output, num_workers=num_workers, prefetch_factor=prefetch_factor)
+            del chunk_features
+
+            # Writing the hashes marks the chunk as complete
+            chunk_hashes = np.array(list(unseen_rows.keys()), dtype="S32")
+            self.save_array_atomically(save_path=os.path.join(cache_folder, f"{chunk_name}_hashes.npy"), array=chunk_hashes)
+            for row, crop_hash in enumerate(unseen_rows):
+                cache_index[crop_hash] = (chunk_name, row)
+            chunk_feature_paths[chunk_name] = chunk_feature_path
+
+        # Assemble features of the split from the cache, chunk by chunk
+        cache_rows_by_chunk = defaultdict(lambda: ([], []))
+        for row, crop_hash in enumerate(crop_hashes):
+            chunk_name, chunk_row = cache_index[bytes(crop_hash)]
+            cache_rows_by_chunk[chunk_name][0].append(row)
+            cache_rows_by_chunk[chunk_name][1].append(chunk_row)
+
+        features_split = None
+        for chunk_name, (split_rows, chunk_rows) in cache_rows_by_chunk.items():
+            chunk_features = np.load(chunk_feature_paths[chunk_name], mmap_mode="r")
+            if features_split is None:
+                features_split = self.open_split_memmap_for_writing(session_id=session_id, type_of_content="ann_features", split=split, shape=(len(crop_hashes), chunk_features.shape[1]), ann_model=self.ann_model, module=self.module_name)
+            split_rows = np.array(split_rows)
+            chunk_rows = np.array(chunk_rows)
+            for batch_start in range(0, len(split_rows), copy_batch_size):
+                batch_slice = slice(batch_start, batch_start+copy_batch_size)
+                features_split[split_rows[batch_slice]] = chunk_features[chunk_rows[batch_slice]]
+            del chunk_features
+
+        if features_split is None:
+            raise ValueError(f"[Session {session_id}][{split} split]: No crops found to extract features from.")
+        features_split.flush()
+
+        return features_split
+
+
+    @StageMetrics.measure
+    def reduce_feature_dimensionality(self, z_score_features_before_pca:bool = True, all_sessions_combined:bool = False, pca_solver:str = "full", pca_batch_size:int = 2048):
+        """
+        Reduces dimensionality of extracted features using PCA. This seems to be necessary to avoid overfit in the ridge Regression.
 
-            return ann_features, explained_var
+        pca_solver options: "full" (sklearn PCA as before), "randomized" (randomized SVD, cheap for a small number of components),
+                            "incremental" (IncrementalPCA fit on chunks of pca_batch_size epochs, sessions are never concatenated)
+        """
+        if pca_solver not in ["full", "randomized", "incremental"]:
+            raise ValueError(f"reduce_feature_dimensionality called with unrecognized pca_solver {pca_solver}.")
 
         if not all_sessions_combined:
             for session_id in self.session_ids_num:
-                pca_features = {"train": None, "test": None}
                 # Get ANN features for session
-                ann_features = self.load_split_data_from_file(session_id_num=session_id, type_of_content="ann_features", ann_model=self.ann_model, module=self.module_name)
+                ann_features = self.load_split_data_from_file(session_id_num=session_id, type_of_content="ann_features", ann_model=self.ann_model, module=self.module_name, mmap_mode="r")
                 logger.custom_debug(f"[Session {session_id}]: ann_features['train'].shape: {ann_features['train'].shape}")
 
-                ann_features_pca, explained_var = apply_pca_to_features(ann_features)
+                # Fit pca on train and test features combined
+                (train_features_pca, test_features_pca), explained_var, pca, z_score_params = self.apply_pca_to_features(feature_arrays=[ann_features["train"], ann_features["test"]], z_score_features_before_pca=z_score_features_before_pca, pca_solver=pca_solver, pca_batch_size=pca_batch_size)
+                ann_features_pca = {"train": train_features_pca, "test": test_features_pca}
+                self.save_pca_transform(pca=pca, z_score_params=z_score_params, pca_basis="per_session", basis_session_id=session_id)
 
                 logger.custom_info(f"[Session {session_id}]: Explained Variance: {explained_var}")
-                logger.custom_debug(f"[Session {session_id}]: ann_features_pca['train'].shape: {ann_features_pca['train'].shape}")
 
                 for split in ann_features_pca:
                     logger.custom_debug(f"Session {session_id}: {split}_features.shape: {ann_features_pca[split].shape}")
 
                 self.export_split_data_as_file(session_id=session_id, type_of_content="ann_features_pca", array_dict=ann_features_pca, ann_model=self.ann_model, module=self.module_name)
         else:
-            # Concat features over all sessions, only then apply pca
-            pca_features = {"train": None, "test": None}
+            # Fit pca over the features of all sessions. Features are only memory-mapped, the solvers consume them without building a concatenated input array
+            feature_arrays_by_split = {"train": [], "test": []}
             for session_id in self.session_ids_num:
                 # Get ANN features for session
-                ann_features = self.load_split_data_from_file(session_id_num=session_id, type_of_content="ann_features", ann_model=self.ann_model, module=self.module_name)
-                for split in pca_features:
-                    if pca_features[split] is None:
-                        pca_features[split] = ann_features[split]
-                    else:
-                        pca_features[split] = np.concatenate((pca_features[split], ann_features[split]))
-            ann_features_pca, explained_var = apply_pca_to_features(pca_features)
+                ann_features = self.load_split_data_from_file(session_id_num=session_id, type_of_content="ann_features", ann_model=self.ann_model, module=self.module_name, mmap_mode="r")
+                for split in feature_arrays_by_split:
+                    feature_arrays_by_split[split].append(ann_features[split])
+
+            n_train_arrays = len(feature_arrays_by_split["train"])
+            features_pca, explained_var, pca, z_score_params = self.apply_pca_to_features(feature_arrays=feature_arrays_by_split["train"] + feature_arrays_by_split["test"], z_score_features_before_pca=z_score_features_before_pca, pca_solver=pca_solver, pca_batch_size=pca_batch_size)
+            self.save_pca_transform(pca=pca, z_score_params=z_score_params, pca_basis="all_sessions_combined")
             logger.custom_debug(f"Explained Variance: {explained_var}")
 
+            # Only the (small) reduced arrays are concatenated over sessions
+            ann_features_pca = {"train": np.concatenate(features_pca[:n_train_arrays]), "test": np.concatenate(features_pca[n_train_arrays:])}
             for split in ann_features_pca:
-                logger.custom_debug(f"Session {session_id}: {split}_features.shape: {ann_features_pca[split].shape}")
+                logger.custom_debug(f"All sessions: {split}_features.shape: {ann_features_pca[split].shape}")
 
             self.export_split_data_as_file(session_id=None, type_of_content="ann_features_pca_all_sessions_combined", array_dict=ann_features_pca, ann_model=self.ann_model, module=self.module_name)
 
 
+    @StageMetrics.measure
+    def reduce_feature_dimensionality_random_projection(self, n_components:int, density = "auto", chunk_size:int = 2048, random_state:int = 0):
+        """
+        Reduces dimensionality of extracted features with a sparse random projection. Needs no fitting on the data (only the feature dimensionality),
+        so sessions are streamed chunk-wise. The same random_state gives the same projection for all sessions. Stored as ann_features_random_projection.
+        """
+        random_projection = None
+        for session_id in self.session_ids_num:
+            ann_features = self.load_split_data_from_file(session_id_num=session_id, type_of_content="ann_features", ann_model=self.ann_model, module=self.module_name, mmap_mode="r")
+            if random_projection is None:
+                # Fitting only draws the random matrix based on the number of features
+                random_projection = SparseRandomProjection(n_components=n_components, density=density, random_state=random_state)
+                random_projection.fit(np.zeros((1, ann_features["train"].shape[1]), dtype=np.float32))
 
-class GLMHelper(DatasetHelper, ExtractionHelper):
-    def __init__(self, fractional_grid:list, alphas:list, pca_features:bool, fractional_ridge:bool = True, **kwargs):
-        super().__init__(**kwargs)
+            ann_features_projected = {}
+            for split in ann_features:
+                projected_chunks = [random_projection.transform(feature_chunk) for feature_chunk in self.iterate_feature_chunks(feature_arrays=[ann_features[split]], chunk_size=chunk_size)]
+                ann_features_projected[split] = np.concatenate(projected_chunks) if projected_chunks else np.empty((0, n_components), dtype=np.float32)
+            logger.custom_debug(f"[Session {session_id}]: Random projection train shape: {ann_features_projected['train'].shape}")
 
-        self.fractional_ridge = fractional_ridge
-        self.fractional_grid = fractional_grid
-        self.alphas = alphas
-        self.ann_features_type = "ann_features_pca" if pca_features else "ann_features"
+            self.export_split_data_as_file(session_id=session_id, type_of_content="ann_features_random_projection", array_dict=ann_features_projected, ann_model=self.ann_model, module=self.module_name)
 
 
-    def train_mapping(self, all_sessions_combined:bool=False, shuffle_train_labels:bool=False, downscale_features:bool=False):
+    @StageMetrics.measure
+    def reduce_feature_dimensionality_spatial_pooling(self, feature_map_shape:tuple, pooled_size = 1, pooling_type:str = "average", chunk_size:int = 2048):
         """
-        Trains a mapping from ANN features to MEG data over all sessions.
+        Reduces dimensionality of flattened convolutional feature maps by spatial average or max pooling (per channel) to pooled_size (int or (height, width)).
+        feature_map_shape is the (channels, height, width) shape of the module output, e.g. (256, 6, 6) for Alexnet features.12. Stored as ann_features_pooled.
         """
-        def train_model(X_train:np.ndarray, Y_train: np.ndarray, normalization:str, all_sessions_combined:bool, session_id_num:str=None):
-            # Initialize Helper class
-            ridge_model = GLMHelper.MultiDimensionalRegression(self) 
+        if pooling_type not in ["average", "max"]:
+            raise ValueError(f"reduce_feature_dimensionality_spatial_pooling called with unrecognized pooling_type {pooling_type}.")
+        pooling_function = torch.nn.functional.adaptive_avg_pool2d if pooling_type == "average" else torch.nn.functional.adaptive_max_pool2d
 
-            if downscale_features:
-                X_train = self.normalize_array(data=X_train, normalization="range_-1_to_1")
+        for session_id in self.session_ids_num:
+            ann_features = self.load_split_data_from_file(session_id_num=session_id, type_of_content="ann_features", ann_model=self.ann_model, module=self.module_name, mmap_mode="r")
+            if ann_features["train"].shape[1] != np.prod(feature_map_shape):
+                raise ValueError(f"Feature dimensionality {ann_features['train'].shape[1]} does not match feature_map_shape {feature_map_shape}.")
 
-            # Fit model on train data
-            ridge_model.fit(X_train, Y_train)
+            ann_features_pooled = {}
+            for split in ann_features:
+                pooled_chunks = []
+                for feature_chunk in self.iterate_feature_chunks(feature_arrays=[ann_features[split]], chunk_size=chunk_size):
+                    # Features were flattened channel-first (channels, height, width)
+                    feature_maps = torch.from_numpy(feature_chunk).reshape(-1, *feature_map_shape)
+                    pooled_chunks.append(pooling_function(feature_maps, pooled_size).flatten(start_dim=1).numpy())
+                ann_features_pooled[split] = np.concatenate(pooled_chunks)
+            logger.custom_debug(f"[Session {session_id}]: Spatially pooled ({pooling_type}) train shape: {ann_features_pooled['train'].shape}")
 
-            # Get alphas selected in RidgeCV
-            selected_alphas = ridge_model.selected_alphas
+            self.export_split_data_as_file(session_id=session_id, type_of_content="ann_features_pooled", array_dict=ann_features_pooled, ann_model=self.ann_model, module=self.module_name)
 
-            all_session_folder = f"/all_sessions_combined" if all_sessions_combined else ""
-            session_addition = f"/session_{session_id_num}" if not all_sessions_combined else ""
 
-            # Store trained models as pickle
-            save_folder = f"data_files/{self.lock_event}/GLM_models/{self.ann_model}/{self.module_name}/subject_{self.subject_id}{all_session_folder}/norm_{normalization}{session_addition}"  
-            save_file = "GLM_models.pkl"
-            os.makedirs(save_folder, exist_ok=True)
-            save_path = os.path.join(save_folder, save_file)
+    @StageMetrics.measure
+    def create_shared_basis_pca_features(self, pca_basis:str, reference_session_id:str = "1", z_score_features_before_pca:bool = True, pca_solver:str = "full", pca_batch_size:int = 2048, refit_basis:bool = True):
+        """
+        Fits a single pca basis (and z-score parameters) and projects the features of all sessions with it, so that pca features of different sessions are comparable.
+        Stored as ann_features_pca_shared.
 
-            with open(save_path, 'wb') as file:
-                pickle.dump(ridge_model.models, file)
-            
-            return selected_alphas
+        pca_basis options: "reference_session" (fit on train and test features of reference_session_id), "pooled_train" (fit on the train features of all sessions)
+        If refit_basis is False, the previously stored basis is loaded and only the projection is performed (e.g. for new sessions).
+        """
+        if pca_basis not in ["reference_session", "pooled_train"]:
+            raise ValueError(f"create_shared_basis_pca_features called with unrecognized pca_basis {pca_basis}.")
+        basis_session_id = reference_session_id if pca_basis == "reference_session" else None
+
+        if refit_basis:
+            if pca_basis == "reference_session":
+                ann_features = self.load_split_data_from_file(session_id_num=reference_session_id, type_of_content="ann_features", ann_model=self.ann_model, module=self.module_name, mmap_mode="r")
+                basis_feature_arrays = [ann_features["train"], ann_features["test"]]
+            else:
+                basis_feature_arrays = [self.load_split_data_from_file(session_id_num=session_id, type_of_content="ann_features", ann_model=self.ann_model, module=self.module_name, mmap_mode="r")["train"] for session_id in self.session_ids_num]
 
-        if not all_sessions_combined:
-            for normalization in self.normalizations:
-                logger.custom_info(f"Training mapping for normalization {normalization}")
-                session_alphas = {}
-                for session_id_num in self.session_ids_num:
-                    logger.custom_debug(f"Training mapping for Session {session_id_num}")
-                    logger.custom_debug(f"[Session {session_id_num}] Before relevant load_split_data_from_file")
-                    # Get ANN features for session
-                    ann_features = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content=self.ann_features_type, ann_model=self.ann_model, module=self.module_name)
-                    # Get MEG data for sesssion
-                    meg_data = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content="meg_data", type_of_norm=normalization)
+            # Only fit here, all sessions are projected below
+            pca, z_score_params, explained_var = self.fit_pca_basis(feature_arrays=basis_feature_arrays, z_score_features_before_pca=z_score_features_before_pca, pca_solver=pca_solver, pca_batch_size=pca_batch_size)
+            logger.custom_info(f"Shared pca basis ({pca_basis}): Explained Variance: {explained_var}")
+            self.save_pca_transform(pca=pca, z_score_params=z_score_params, pca_basis=pca_basis, basis_session_id=basis_session_id)
 
-                    X_train, Y_train = ann_features['train'], meg_data['train']
+        pca_transform = self.load_pca_transform(pca_basis=pca_basis, basis_session_id=basis_session_id)
 
-                    if shuffle_train_labels:
-                        np.random.shuffle(Y_train)
+        for session_id in self.session_ids_num:
+            ann_features = self.load_split_data_from_file(session_id_num=session_id, type_of_content="ann_features", ann_model=self.ann_model, module=self.module_name, mmap_mode="r")
+            ann_features_pca = {split: self.project_features_with_pca_transform(feature_array=ann_features[split], pca_transform=pca_transform, chunk_size=pca_batch_size) for split in ann_features}
+            logger.custom_debug(f"[Session {session_id}]: Projected features into shared basis, train shape: {ann_features_pca['train'].shape}")
 
-                    logger.custom_debug(f"[Session {session_id_num}] X_train.shape: {X_train.shape}, Y_train.shape: {Y_train.shape}")
-                    selected_alphas = train_model(X_train=X_train, Y_train=Y_train, normalization=normalization, all_sessions_combined=all_sessions_combined, session_id_num=session_id_num)
-                    session_alphas[session_id_num] = selected_alphas
-                #self.save_dict_as_json(type_of_content="selected_alphas_by_session", dict_to_store=session_alphas, type_of_norm=normalization, predict_train_data=predict_train_data)
-        # all sessions combined
-        else:
-            for normalization in self.normalizations:
-                meg_data_train_combined = None
-                # Collect ANN features and MEG data over sessions
-                for session_id_num in self.session_ids_num:
-                    meg_data_train = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content="meg_data", type_of_norm=normalization)['train']
+            self.export_split_data_as_file(session_id=session_id, type_of_content="ann_features_pca_shared", array_dict=ann_features_pca, ann_model=self.ann_model, module=self.module_name)
 
-                    if session_id_num == "1":
-                        meg_data_train_combined = meg_data_train
-                    else:
-                        meg_data_train_combined = np.concatenate([meg_data_train_combined, meg_data_train], axis=0)
 
-                ann_features_train_combined = self.load_split_data_from_file(session_id_num=None, type_of_content=self.ann_features_type+"_all_sessions_combined" , ann_model=self.ann_model, module=self.module_name)['train']
+    def get_pca_transform_path(self, pca_basis:str, basis_session_id:str = None) -> str:
+        """
+        Returns the path of a stored pca transform.
+        """
+        basis_folder = f"{pca_basis}/session_{basis_session_id}" if basis_session_id is not None else pca_basis
 
-                X_train, Y_train = ann_features_train_combined, meg_data_train_combined
+        return f"data_files/{self.lock_event}/pca_transforms/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/{basis_folder}/pca_transform.npz"
 
-                assert X_train.shape[0] == Y_train.shape[0], "Different number of samples for features and meg data."
 
-                if shuffle_train_labels:
-                    np.random.shuffle(Y_train)
+    def save_pca_transform(self, pca, z_score_params:tuple, pca_basis:str, basis_session_id:str = None) -> None:
+        """
+        Stores the parameters of a fitted pca (and of the z-scoring before it) as compact arrays, so that features can be projected later without refitting.
+        """
+        storage_path = self.get_pca_transform_path(pca_basis=pca_basis, basis_session_id=basis_session_id)
+        os.makedirs(os.path.dirname(storage_path), exist_ok=True)
+
+        z_score_mean, z_score_std = z_score_params if z_score_params is not None else (np.nan, np.nan)
+        self.write_file_atomically(save_path=storage_path, write_file=lambda file: np.savez(file,
+                                                                                           mean=pca.mean_,
+                                                                                           components=pca.components_,
+                                                                                           explained_variance=pca.explained_variance_,
+                                                                                           explained_variance_ratio=pca.explained_variance_ratio_,
+                                                                                           z_score_mean=z_score_mean,
+                                                                                           z_score_std=z_score_std,
+                                                                                           pca_basis=pca_basis,
+                                                                                           basis_session_id=str(basis_session_id)))
+        logger.custom_debug(f"Storing pca transform to {storage_path}")
+
+
+    def load_pca_transform(self, pca_basis:str, basis_session_id:str = None) -> dict:
+        """
+        Loads a stored pca transform as dict of arrays.
+        """
+        storage_path = self.get_pca_transform_path(pca_basis=pca_basis, basis_session_id=basis_session_id)
+        try:
+            with np.load(storage_path) as pca_transform_file:
+                pca_transform = {key: pca_transform_file[key] for key in pca_transform_file.files}
+        except FileNotFoundError:
+            raise FileNotFoundError(f"In Function load_pca_transform: The file {storage_path} does not exist. Fit the pca basis first.")
+
+        return pca_transform
+
+
+    def project_features_with_pca_transform(self, feature_array:np.ndarray, pca_transform:dict, chunk_size:int = 2048) -> np.ndarray:
+        """
+        Projects features (e.g. of a new session or new crops) with a stored pca transform. Equivalent to z-scoring followed by PCA.transform.
+        """
+        z_score_params = None if np.isnan(pca_transform["z_score_mean"]) else (float(pca_transform["z_score_mean"]), float(pca_transform["z_score_std"]))
+        projected_chunks = [(feature_chunk - pca_transform["mean"]) @ pca_transform["components"].T for feature_chunk in self.iterate_feature_chunks(feature_arrays=[feature_array], chunk_size=chunk_size, z_score_params=z_score_params)]
+
+        return np.concatenate(projected_chunks) if projected_chunks else np.empty((0, len(pca_transform["components"])))
+
+
+    @StageMetrics.measure
+    def create_pca_sweep_features(self, max_components:int, z_score_features_before_pca:bool = True, pca_solver:str = "full", pca_batch_size:int = 2048):
+        """
+        Fits pca once per session with max_components and stores the complete projection as ann_features_pca_sweep.
+        PCA solutions are nested, so the features for any smaller number of components k are the first k columns of this projection.
+        """
+        for session_id in self.session_ids_num:
+            ann_features = self.load_split_data_from_file(session_id_num=session_id, type_of_content="ann_features", ann_model=self.ann_model, module=self.module_name, mmap_mode="r")
+            n_components = min(max_components, ann_features["train"].shape[0] + ann_features["test"].shape[0], ann_features["train"].shape[1])
+            if n_components < max_components:
+                logger.warning(f"[Session {session_id}]: Only {n_components} instead of {max_components} components possible for pca sweep.")
+
+            (train_features_pca, test_features_pca), explained_var, _, _ = self.apply_pca_to_features(feature_arrays=[ann_features["train"], ann_features["test"]], z_score_features_before_pca=z_score_features_before_pca, pca_solver=pca_solver, pca_batch_size=pca_batch_size, n_components=n_components)
+            logger.custom_info(f"[Session {session_id}]: Explained Variance with {n_components} components: {explained_var}")
+
+            self.export_split_data_as_file(session_id=session_id, type_of_content="ann_features_pca_sweep", array_dict={"train": train_features_pca, "test": test_features_pca}, ann_model=self.ann_model, module=self.module_name)
+
+
+    def apply_pca_to_features(self, feature_arrays:list, z_score_features_before_pca:bool, pca_solver:str = "full", pca_batch_size:int = 2048, n_components:int = None):
+        """
+        Fits pca on all given feature arrays combined and transforms each of them. Use fix amount of components to allow cross-session predictions.
+        Returns the transformed arrays, the explained variance, the fitted pca and the z-score parameters (mean, std) or None.
+        """
+        pca, z_score_params, explained_var = self.fit_pca_basis(feature_arrays=feature_arrays, z_score_features_before_pca=z_score_features_before_pca, pca_solver=pca_solver, pca_batch_size=pca_batch_size, n_components=n_components)
+
+        # Transform arrays chunk-wise
+        features_pca = []
+        for feature_array in feature_arrays:
+            transformed_chunks = [pca.transform(feature_chunk) for feature_chunk in self.iterate_feature_chunks(feature_arrays=[feature_array], chunk_size=pca_batch_size, z_score_params=z_score_params)]
+            features_pca.append(np.concatenate(transformed_chunks) if transformed_chunks else np.empty((0, pca.n_components_)))
+
+        return features_pca, explained_var, pca, z_score_params
+
+
+    def fit_pca_basis(self, feature_arrays:list, z_score_features_before_pca:bool, pca_solver:str = "full", pca_batch_size:int = 2048, n_components:int = None):
+        """
+        Fits pca (and the global z-score before it) on all given feature arrays combined. Returns the fitted pca, the z-score parameters (mean, std) or None and the explained variance.
+        """
+        n_components = n_components if n_components is not None else self.pca_components
+
+        if z_score_features_before_pca:
+            z_score_params = self.calculate_streaming_z_score_params(feature_arrays=feature_arrays, chunk_size=pca_batch_size)
+        else:
+            z_score_params = None
+
+        if pca_solver == "incremental":
+            pca = IncrementalPCA(n_components=n_components)
+            for feature_chunk in self.iterate_feature_chunks(feature_arrays=feature_arrays, chunk_size=pca_batch_size, z_score_params=z_score_params, min_chunk_size=n_components):
+                pca.partial_fit(feature_chunk)
+        else:
+            if pca_solver == "randomized":
+                pca = PCA(n_components=n_components, svd_solver="randomized", random_state=0)
+            else:
+                pca = PCA(n_components=n_components)
+            # Fill a single preallocated float32 input instead of concatenating (and z-scoring) copies
+            n_epochs = sum(len(feature_array) for feature_array in feature_arrays)
+            features_combined = np.empty((n_epochs, feature_arrays[0].shape[1]), dtype=np.float32)
+            epoch_start = 0
+            for feature_chunk in self.iterate_feature_chunks(feature_arrays=feature_arrays, chunk_size=pca_batch_size, z_score_params=z_score_params):
+                features_combined[epoch_start:epoch_start+len(feature_chunk)] = feature_chunk
+                epoch_start += len(feature_chunk)
+            pca.fit(features_combined)
+            del features_combined
+
+        explained_var = float(np.sum(pca.explained_variance_ratio_))
+
+        return pca, z_score_params, explained_var
+
+
+    def calculate_streaming_z_score_params(self, feature_arrays:list, chunk_size:int = 2048) -> Tuple[float, float]:
+        """
+        Calculates the global mean and standard deviation (as in normalize_array "z_score") over all given arrays in a single pass over chunks.
+        Chunk statistics are merged with Chan's parallel algorithm, so no array has to be held in memory completely.
+        """
+        n_total = 0
+        mean_total = 0.0
+        m2_total = 0.0
+        for feature_array in feature_arrays:
+            for chunk_start in range(0, len(feature_array), chunk_size):
+                feature_chunk = np.asarray(feature_array[chunk_start:chunk_start+chunk_size], dtype=np.float64)
+                n_chunk = feature_chunk.size
+                mean_chunk = feature_chunk.mean()
+                m2_chunk = np.sum((feature_chunk - mean_chunk)**2)
+
+                delta = mean_chunk - mean_total
+                n_combined = n_total + n_chunk
+                mean_total += delta * n_chunk / n_combined
+                m2_total += m2_chunk + delta**2 * n_total * n_chunk / n_combined
+                n_total = n_combined
+
+        # Use an epsilon to prevent division by zero
+        epsilon = 1e-100
+        std_total = np.sqrt(m2_total / n_total) + epsilon
+
+        return mean_total, std_total
+
+
+    def iterate_feature_chunks(self, feature_arrays:list, chunk_size:int, z_score_params:tuple = None, min_chunk_size:int = 1):
+        """
+        Yields float32 chunks of chunk_size epochs over all given arrays (in order), z-scored if z_score_params (mean, std) are given.
+        A last chunk smaller than min_chunk_size is merged into the previous one (IncrementalPCA requires at least n_components samples per chunk).
+        """
+        def read_chunks():
+            for feature_array in feature_arrays:
+                for chunk_start in range(0, len(feature_array), chunk_size):
+                    feature_chunk = np.array(feature_array[chunk_start:chunk_start+chunk_size], dtype=np.float32)
+                    if z_score_params is not None:
+                        feature_chunk -= z_score_params[0]
+                        feature_chunk /= z_score_params[1]
+                    yield feature_chunk
+
+        pending_chunk = None
+        for feature_chunk in read_chunks():
+            if pending_chunk is not None:
+                if len(feature_chunk) < min_chunk_size or len(pending_chunk) < min_chunk_size:
+                    feature_chunk = np.concatenate((pending_chunk, feature_chunk))
+                else:
+                    yield pending_chunk
+            pending_chunk = feature_chunk
+        if pending_chunk is not None:
+            yield pending_chunk
+
+
+
+class GLMHelper(DatasetHelper, ExtractionHelper):
+    # Version of the array-based GLM model files (GLM_models.h5)
+    GLM_model_format_version = 1
+
+    def __init__(self, fractional_grid:list, alphas:list, pca_features:bool, fractional_ridge:bool = True, pca_basis:str = "per_session", feature_reducer:str = "pca", ridge_solver:str = "per_timepoint", batched_fractional_ridge:bool = False, ridge_form:str = "auto", **kwargs):
+        super().__init__(**kwargs)
+
+        if ridge_solver not in ["per_timepoint", "sufficient_statistics"]:
+            raise ValueError(f"GLMHelper initialized with unrecognized ridge_solver {ridge_solver}.")
+        if ridge_form not in ["auto", "primal", "dual"]:
+            raise ValueError(f"GLMHelper initialized with unrecognized ridge_form {ridge_form}.")
+
+        self.fractional_ridge = fractional_ridge
+        self.fractional_grid = fractional_grid
+        self.alphas = alphas
+        self.pca_basis = pca_basis
+        # ridge_solver "sufficient_statistics": models for pooled sessions are solved from per-session XᵀX, XᵀY, sums and counts instead of concatenated data
+        self.ridge_solver = ridge_solver
+        # batched_fractional_ridge: one fractional ridge path over all sensors and timepoints with a best fraction per target, instead of one FracRidgeRegressorCV per timepoint
+        self.batched_fractional_ridge = batched_fractional_ridge
+        # ridge_form "auto": (non-fractional) ridge is solved in sample space (dual) whenever there are more features than samples
+        self.ridge_form = ridge_form
+        # pca_features: use dimensionality reduced features, the reducer is chosen with feature_reducer ("pca", "random_projection", "spatial_pooling")
+        if not pca_features:
+            self.ann_features_type = "ann_features"
+        elif feature_reducer == "pca":
+            # A shared basis (reference session or pooled train data) makes pca features comparable across sessions
+            self.ann_features_type = "ann_features_pca" if pca_basis == "per_session" else "ann_features_pca_shared"
+        elif feature_reducer == "random_projection":
+            self.ann_features_type = "ann_features_random_projection"
+        elif feature_reducer == "spatial_pooling":
+            self.ann_features_type = "ann_features_pooled"
+        else:
+            raise ValueError(f"GLMHelper initialized with unrecognized feature_reducer {feature_reducer}.")
+
+
+    @StageMetrics.measure
+    def train_mapping(self, all_sessions_combined:bool=False, shuffle_train_labels:bool=False, downscale_features:bool=False, incremental:bool=False, resume:bool=True):
+        """
+        Trains a mapping from ANN features to MEG data over all sessions.
+        If incremental is True, only sessions without a model or with input data newer than their model are trained (see get_sessions_requiring_update).
+        If resume is True, sessions that were trained with the same train data and ridge settings are skipped (not for all sessions combined).
+        """
+        def train_model(X_train:np.ndarray, Y_train: np.ndarray, normalization:str, all_sessions_combined:bool, session_id_num:str=None):
+            # Initialize Helper class
+            ridge_model = GLMHelper.MultiDimensionalRegression(self) 
+
+            if downscale_features:
+                X_train = self.normalize_array(data=X_train, normalization="range_-1_to_1")
+
+            # Fit model on train data
+            ridge_model.fit(X_train, Y_train)
+
+            # Get alphas selected in RidgeCV
+            selected_alphas = ridge_model.selected_alphas
+
+            # Store trained models as stacked arrays
+            save_folder = self.get_GLM_model_folder(normalization=normalization, all_sessions_combined=all_sessions_combined, session_id_num=session_id_num)
+            self.save_GLM_models(ridge_model=ridge_model, save_folder=save_folder, normalization=normalization)
+
+            return selected_alphas
+
+        if not all_sessions_combined:
+            # Settings that define the models of a session, besides its train data
+            training_config = {"ann_features_type": self.ann_features_type, "alphas": self.alphas, "fractional_ridge": self.fractional_ridge, "fractional_grid": self.fractional_grid, 
+                               "batched_fractional_ridge": self.batched_fractional_ridge, "ridge_form": self.ridge_form, "shuffle_train_labels": shuffle_train_labels, "downscale_features": downscale_features}
+            for normalization in self.normalizations:
+                logger.custom_info(f"Training mapping for normalization {normalization}")
+                session_alphas = {}
+                sessions_to_train = self.get_sessions_requiring_update(normalization=normalization) if incremental else self.session_ids_num
+                if incremental:
+                    logger.custom_info(f"Incremental training, new or changed sessions: {sessions_to_train}")
+                session_input_hashes = {session_id_num: self.calculate_session_input_hash(config=training_config, split_paths=[self.get_split_data_path(session_id_num=session_id_num, type_of_content=self.ann_features_type, split="train", ann_model=self.ann_model, module=self.module_name),
+                                                                                                                              self.get_split_data_path(session_id_num=session_id_num, type_of_content="meg_data", split="train", type_of_norm=normalization)])
+                                        for session_id_num in sessions_to_train}
+                completed_sessions = [session_id_num for session_id_num in sessions_to_train 
+                                      if resume and self.get_GLM_model_path(normalization=normalization, session_id_num=session_id_num) is not None and self.is_session_completed(step_name="GLM_training", session_id=session_id_num, input_hash=session_input_hashes[session_id_num], normalization=normalization)]
+                if completed_sessions:
+                    logger.custom_info(f"Resuming training, skipping completed sessions {completed_sessions}")
+                for session_id_num in [session_id_num for session_id_num in sessions_to_train if session_id_num not in completed_sessions]:
+                    logger.custom_debug(f"Training mapping for Session {session_id_num}")
+                    logger.custom_debug(f"[Session {session_id_num}] Before relevant load_split_data_from_file")
+                    # Get ANN features for session
+                    ann_features = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content=self.ann_features_type, ann_model=self.ann_model, module=self.module_name)
+                    # Get MEG data for sesssion
+                    meg_data = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content="meg_data", type_of_norm=normalization)
+
+                    X_train, Y_train = ann_features['train'], meg_data['train']
+
+                    if shuffle_train_labels:
+                        Y_train = np.random.permutation(Y_train)
+
+                    logger.custom_debug(f"[Session {session_id_num}] X_train.shape: {X_train.shape}, Y_train.shape: {Y_train.shape}")
+                    selected_alphas = train_model(X_train=X_train, Y_train=Y_train, normalization=normalization, all_sessions_combined=all_sessions_combined, session_id_num=session_id_num)
+                    session_alphas[session_id_num] = selected_alphas
+                    self.mark_session_completed(step_name="GLM_training", session_id=session_id_num, input_hash=session_input_hashes[session_id_num], normalization=normalization)
+                #self.save_dict_as_json(type_of_content="selected_alphas_by_session", dict_to_store=session_alphas, type_of_norm=normalization, predict_train_data=predict_train_data)
+        # all sessions combined, solved from per-session sufficient statistics (also yields the leave-one-session-out models)
+        elif self.ridge_solver == "sufficient_statistics":
+            self.train_mapping_from_sufficient_statistics(shuffle_train_labels=shuffle_train_labels, downscale_features=downscale_features)
+        # all sessions combined
+        else:
+            for normalization in self.normalizations:
+                meg_data_train_combined = None
+                # Collect ANN features and MEG data over sessions
+                for session_id_num in self.session_ids_num:
+                    meg_data_train = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content="meg_data", type_of_norm=normalization)['train']
+
+                    if meg_data_train_combined is None:
+                        meg_data_train_combined = meg_data_train
+                    else:
+                        meg_data_train_combined = np.concatenate([meg_data_train_combined, meg_data_train], axis=0)
+
+                ann_features_train_combined = self.load_all_sessions_combined_features(split="train")
+
+                X_train, Y_train = ann_features_train_combined, meg_data_train_combined
+
+                assert X_train.shape[0] == Y_train.shape[0], "Different number of samples for features and meg data."
+
+                if shuffle_train_labels:
+                    Y_train = np.random.permutation(Y_train)
 
                 logger.custom_debug(f"Train_mapping: X_train.shape: {X_train.shape}")
                 logger.custom_debug(f"Train_mapping: Y_train.shape: {Y_train.shape}")
@@ -1470,10 +2449,15 @@ class GLMHelper(DatasetHelper, ExtractionHelper):
 
 
         
-    def predict_from_mapping(self, fit_measure_storage_distinction:str="session_level", predict_train_data:bool=False, all_sessions_combined:bool=False, shuffle_test_labels:bool=False, downscale_features:bool=False):
+    @StageMetrics.measure
+    def predict_from_mapping(self, fit_measure_storage_distinction:str="session_level", predict_train_data:bool=False, all_sessions_combined:bool=False, shuffle_test_labels:bool=False, downscale_features:bool=False, incremental:bool=False, n_workers:int=1, blas_threads_per_worker:int=None, published_fit_measures:dict=None):
         """
         Based on the trained mapping for each session, predicts MEG data over all sessions from their respective test features.
         If predict_train_data is True, predicts the train data of each session as a sanity check of the complete pipeline. Expect strong overfit.
+        If incremental is True, stored results are kept and only the row (model -> all sessions) and column (all models -> session) of new or changed sessions are computed.
+        With n_workers > 1, the (model, pred) session pairs are evaluated by a pool of worker processes (see evaluate_session_pairs).
+        published_fit_measures: fit measures of the session pairs computed elsewhere (by work queue workers, see evaluate_model_session) as {normalization: {(session_id_model, session_id_pred): fit_measures}}.
+        They are stored instead of evaluating the pairs.
         """
         assert fit_measure_storage_distinction in ["session_level", "timepoint_level", "timepoint_sensor_level"], "[predict_from_mapping] Invalid argument for parameter fit_measure_storage_distinction"
 
@@ -1483,101 +2467,51 @@ class GLMHelper(DatasetHelper, ExtractionHelper):
                 variance_explained_dict = self.recursive_defaultdict()
                 correlation_dict = self.recursive_defaultdict()
                 mse_session_losses = {"session_mapping": {}}
-                for session_id_model in self.session_ids_num:
-                    mse_session_losses["session_mapping"][session_id_model] = {"session_pred": {}}
-                    # Get trained ridge regression model for this session
-                    # Load ridge model
-                    storage_folder = f"data_files/{self.lock_event}/GLM_models/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}/session_{session_id_model}"  
-                    storage_file = "GLM_models.pkl"
-                    storage_path = os.path.join(storage_folder, storage_file)
-                    with open(storage_path, 'rb') as file:
-                        ridge_models = pickle.load(file)
-
-                    # Initialize MultiDim GLM class with stored models
-                    ridge_model = GLMHelper.MultiDimensionalRegression(self, models=ridge_models)
-
-                    # Generate predictions for test features over all sessions and evaluate them 
-                    for session_id_pred in self.session_ids_num:
-                        # Get ANN features and MEG data for session where predictions are to be evaluated
-                        ann_features = self.load_split_data_from_file(session_id_num=session_id_pred, type_of_content=self.ann_features_type, ann_model=self.ann_model, module=self.module_name)
-                        meg_data = self.load_split_data_from_file(session_id_num=session_id_pred, type_of_content="meg_data", type_of_norm=normalization)
-                        
-                        if predict_train_data:
-                            X_test, Y_test = ann_features['train'], meg_data['train']
-                        else:
-                            X_test, Y_test = ann_features['test'], meg_data['test']
-
-                        #logger.custom_debug(f"Predict_from_mapping: X_test.shape: {X_test.shape}")
-                        #logger.custom_debug(f"Predict_from_mapping: Y_test.shape: {Y_test.shape}")
-
-                        if shuffle_test_labels:
-                            np.random.shuffle(Y_test)
-
-                        # Generate predictions
-                        predictions = ridge_model.predict(X_test, downscale_features=downscale_features)
-
-                        if fit_measure_storage_distinction == "timepoint_level":
-                            # Store fit measures seperately for each timepoint/model
-                            n_timepoints = predictions.shape[2]
-                            n_sensors = predictions.shape[1]
-                            for t in range(n_timepoints):
-                                var_explained_timepoint_sum = 0
-                                r_pearson_timepoint_sum = 0  
-                                for s in range(n_sensors):
-                                    var_explained_timepoint_sum += r2_score(Y_test[:,s,t], predictions[:,s,t])
-                                    r_pearson_timepoint_sensor, _ = pearsonr(Y_test[:,s,t], predictions[:,s,t])
-                                    r_pearson_timepoint_sum += r_pearson_timepoint_sensor
-
-                                var_explained_timepoint = var_explained_timepoint_sum / n_sensors
-                                r_pearson_timepoint = r_pearson_timepoint_sum / n_sensors
-                                    
-                                # Save fit measures
-                                variance_explained_dict["session_mapping"][session_id_model]["session_pred"][session_id_pred]["timepoint"][str(t)] = var_explained_timepoint
-                                correlation_dict["session_mapping"][session_id_model]["session_pred"][session_id_pred]["timepoint"][str(t)] = r_pearson_timepoint
-
-                        elif fit_measure_storage_distinction == "timepoint_sensor_level":
-                            # Calculate fit measure seperately for each sensor and timepoint
-                            # prediction shape example: (502, 5, 101) (epochs, sensors, timepoints)
-                            n_sensors = predictions.shape[1]
-                            n_timepoints = predictions.shape[2]
-                            for sensor_idx in range(n_sensors):
-                                for timepoint_idx in range(n_timepoints):
-                                    var_explained_sensor_timepoint = r2_score(Y_test[:,sensor_idx,timepoint_idx], predictions[:,sensor_idx,timepoint_idx])  # .reshape(-1)
-                                
-                                    # Save fit measure for selected sensor and timepoint
-                                    variance_explained_dict["sensor"][str(sensor_idx)]["session_mapping"][session_id_model]["session_pred"][session_id_pred]["timepoint"][str(timepoint_idx)] = var_explained_sensor_timepoint
+                sessions_to_update = self.session_ids_num
+                if incremental:
+                    sessions_to_update, stored_fit_measure_dicts = self.load_fit_measures_for_incremental_update(fit_measure_storage_distinction=fit_measure_storage_distinction, normalization=normalization, predict_train_data=predict_train_data)
+                    logger.custom_info(f"Incremental prediction, new or changed sessions: {sessions_to_update}")
+                    if stored_fit_measure_dicts is not None:
+                        if fit_measure_storage_distinction == "session_level":
+                            mse_session_losses = stored_fit_measure_dicts["mse_losses"]
+                            variance_explained_dict = self.convert_to_recursive_defaultdict(stored_fit_measure_dicts["var_explained"])
+                        elif fit_measure_storage_distinction == "timepoint_level":
+                            variance_explained_dict = self.convert_to_recursive_defaultdict(stored_fit_measure_dicts["var_explained_timepoints"])
+                            correlation_dict = self.convert_to_recursive_defaultdict(stored_fit_measure_dicts["pearson_r_timepoints"])
                         else:
-                            # Calculate the mean squared error across all flattened features and timepoints
-                            mse = mean_squared_error(Y_test.reshape(-1), predictions.reshape(-1))
-
-                            # Calculate variance explained 
-                            var_explained = r2_score(Y_test.reshape(-1), predictions.reshape(-1))  # .reshape(-1)
-                            """
-                            TODO: Investigate effects of flattening; consider alternatives
-                            logger.custom_info(f"Y_test.shape: {Y_test.shape}")
-                            Y_test_reshaped = Y_test.reshape(-1, 102)
-                            logger.custom_info(f"Y_test_reshaped.shape: {Y_test_reshaped.shape}")
-                            first_sensor_pre_reshape = Y_test[:, 0, :].reshape(-1)
-                            first_sensor_post_reshape = Y_test_reshaped[:,0]
-                            print("shape first_sensor_pre_reshape", first_sensor_pre_reshape.shape)
-                            print("shape first_sensor_post_reshape:", first_sensor_post_reshape.shape)
-                            print("Sum first sensor pre reshape:", np.sum(first_sensor_pre_reshape))
-                            print("Sum first sensor post reshape:", np.sum(first_sensor_post_reshape))
-                            """
-
-                            # Calculate the Pearson correlation coefficient
-                            r_pearson, _ = pearsonr(Y_test.reshape(-1), predictions.reshape(-1))
-
-                            # Control values
-                            #if var_explained < 0:
-                            #    raise ValueError("Contains negative values for Variance Explained.")
-                            #elif var_explained > 1:
-                            #    raise ValueError("Contains values larger 1 for Variance Explained.")
-
-                            # Save loss and variance explained
-                            mse_session_losses["session_mapping"][session_id_model]["session_pred"][session_id_pred] = mse
-                            correlation_dict["session_mapping"][session_id_model]["session_pred"][session_id_pred] = r_pearson
-                            variance_explained_dict["session_mapping"][session_id_model]["session_pred"][session_id_pred] = var_explained
+                            variance_explained_dict = self.convert_to_recursive_defaultdict(stored_fit_measure_dicts["var_explained_sensors_timepoints"])
+
+                # Only the row (model -> all sessions) and column (all models -> session) of new or changed sessions (all pairs if not incremental)
+                session_pairs = [(session_id_model, session_id_pred) for session_id_model in self.session_ids_num for session_id_pred in self.session_ids_num 
+                                    if session_id_model in sessions_to_update or session_id_pred in sessions_to_update]
+
+                if published_fit_measures is not None:
+                    missing_session_pairs = [session_pair for session_pair in session_pairs if session_pair not in published_fit_measures[normalization]]
+                    if missing_session_pairs:
+                        raise ValueError(f"[predict_from_mapping] No published fit measures for session pairs {missing_session_pairs} of normalization {normalization}.")
+                    session_pair_fit_measures = [(session_id_model, session_id_pred, published_fit_measures[normalization][(session_id_model, session_id_pred)]) for session_id_model, session_id_pred in session_pairs]
+                else:
+                    session_pair_fit_measures = self.evaluate_session_pairs(session_pairs=session_pairs, normalization=normalization, fit_measure_storage_distinction=fit_measure_storage_distinction, predict_train_data=predict_train_data, 
+                                                                            shuffle_test_labels=shuffle_test_labels, downscale_features=downscale_features, n_workers=n_workers, blas_threads_per_worker=blas_threads_per_worker)
+
+                for session_id_model, session_id_pred, fit_measures in session_pair_fit_measures:
+                    if fit_measure_storage_distinction == "timepoint_level":
+                        # Store fit measures seperately for each timepoint/model, averaged over sensors
+                        for t, (var_explained_timepoint, r_pearson_timepoint) in enumerate(zip(fit_measures["var_explained"], fit_measures["r_pearson"])):
+                            variance_explained_dict["session_mapping"][session_id_model]["session_pred"][session_id_pred]["timepoint"][str(t)] = float(var_explained_timepoint)
+                            correlation_dict["session_mapping"][session_id_model]["session_pred"][session_id_pred]["timepoint"][str(t)] = float(r_pearson_timepoint)
+
+                    elif fit_measure_storage_distinction == "timepoint_sensor_level":
+                        # Save fit measure for each sensor and timepoint
+                        for sensor_idx, var_explained_sensor in enumerate(fit_measures["var_explained"]):
+                            for timepoint_idx, var_explained_sensor_timepoint in enumerate(var_explained_sensor):
+                                variance_explained_dict["sensor"][str(sensor_idx)]["session_mapping"][session_id_model]["session_pred"][session_id_pred]["timepoint"][str(timepoint_idx)] = float(var_explained_sensor_timepoint)
+                    else:
+                        # Save loss and variance explained
+                        mse_session_losses["session_mapping"].setdefault(session_id_model, {"session_pred": {}})
+                        mse_session_losses["session_mapping"][session_id_model]["session_pred"][session_id_pred] = fit_measures["mse"]
+                        correlation_dict["session_mapping"][session_id_model]["session_pred"][session_id_pred] = fit_measures["r_pearson"]
+                        variance_explained_dict["session_mapping"][session_id_model]["session_pred"][session_id_pred] = fit_measures["var_explained"]
 
                 # Store loss dict
                 if fit_measure_storage_distinction == "session_level":
@@ -1592,7 +2526,7 @@ class GLMHelper(DatasetHelper, ExtractionHelper):
                         raise ValueError("Invalid value for fit_measure_storage_distinction.")
 
                     for main_folder, fit_measure_dict in storage_dicts_by_folders.items():
-                        storage_folder = f"data_files/{self.lock_event}/{main_folder}/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}/"
+                        storage_folder = f"{self.get_fit_measure_subject_folder(main_folder)}/norm_{normalization}/"
                         os.makedirs(storage_folder, exist_ok=True)
                         json_storage_file = f"{main_folder}_dict.json"
                         json_storage_path = os.path.join(storage_folder, json_storage_file)
@@ -1618,14 +2552,8 @@ class GLMHelper(DatasetHelper, ExtractionHelper):
                 var_explained_dict = {}
                 correlation_dict = {}
                 # Get trained ridge regression models 
-                storage_folder = f"data_files/{self.lock_event}/GLM_models/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/all_sessions_combined/norm_{normalization}"  
-                storage_file = "GLM_models.pkl"
-                storage_path = os.path.join(storage_folder, storage_file)
-                with open(storage_path, 'rb') as file:
-                    ridge_models = pickle.load(file)
-
-                # Initialize MultiDim GLM class with stored models
-                ridge_model = GLMHelper.MultiDimensionalRegression(self, models=ridge_models)
+                storage_folder = self.get_GLM_model_folder(normalization=normalization, all_sessions_combined=True)
+                ridge_model = self.load_GLM_models(storage_folder=storage_folder)
 
                 # Generate predictions for test features evaluate them (or for train features to evaluate overfit)
                 # Collect ANN features and MEG data over sessions
@@ -1634,12 +2562,12 @@ class GLMHelper(DatasetHelper, ExtractionHelper):
                 for session_id_num in self.session_ids_num:
                     meg_data_pred = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content="meg_data", type_of_norm=normalization)[pred_type]
 
-                    if session_id_num == "1":
+                    if meg_data_pred_combined is None:
                         meg_data_pred_combined = meg_data_pred
                     else:
                         meg_data_pred_combined = np.concatenate([meg_data_pred_combined, meg_data_pred], axis=0)
 
-                ann_features_pred_combined = self.load_split_data_from_file(session_id_num=None, type_of_content=self.ann_features_type+"_all_sessions_combined" , ann_model=self.ann_model, module=self.module_name)[pred_type]
+                ann_features_pred_combined = self.load_all_sessions_combined_features(split=pred_type)
 
                 X_test, Y_test = ann_features_pred_combined, meg_data_pred_combined
 
@@ -1647,7 +2575,7 @@ class GLMHelper(DatasetHelper, ExtractionHelper):
                 logger.custom_debug(f"Predict_from_mapping: Y_test.shape: {Y_test.shape}")
 
                 if shuffle_test_labels:
-                    np.random.shuffle(Y_test)
+                    Y_test = np.random.permutation(Y_test)
 
                 # Generate predictions
                 predictions = ridge_model.predict(X_test, downscale_features=downscale_features)
@@ -1677,16 +2605,1092 @@ class GLMHelper(DatasetHelper, ExtractionHelper):
                         json.dump(dict_to_store, file, indent=4)
 
 
+    @StageMetrics.measure
+    def evaluate_model_session(self, session_id_model:str, fit_measure_storage_distinctions:list, predict_train_data:bool=False, shuffle_test_labels:bool=False, downscale_features:bool=False) -> dict:
+        """
+        Evaluates the models of one session on all sessions (one row of the cross-session results), e.g. as a work queue task.
+        Returns json serializable fit measures {normalization: {fit_measure_storage_distinction: {session_id_pred: fit_measures}}}, which are stored with predict_from_mapping(published_fit_measures=...).
+        """
+        session_row_fit_measures = {}
+        for normalization in self.normalizations:
+            session_row_fit_measures[normalization] = {}
+            for fit_measure_storage_distinction in fit_measure_storage_distinctions:
+                session_pairs = [(session_id_model, session_id_pred) for session_id_pred in self.session_ids_num]
+                session_row_fit_measures[normalization][fit_measure_storage_distinction] = {session_id_pred: {fit_measure: np.asarray(values).tolist() for fit_measure, values in fit_measures.items()}
+                                                                                            for _, session_id_pred, fit_measures in self.evaluate_session_pairs(session_pairs=session_pairs, normalization=normalization, fit_measure_storage_distinction=fit_measure_storage_distinction, 
+                                                                                                                                                                 predict_train_data=predict_train_data, shuffle_test_labels=shuffle_test_labels, downscale_features=downscale_features)}
+
+        return session_row_fit_measures
+
+
+    # State of a prediction worker process (set by init_prediction_worker after the fork)
+    prediction_worker_state = None
+
+    def evaluate_session_pairs(self, session_pairs:list, normalization:str, fit_measure_storage_distinction:str, predict_train_data:bool=False, shuffle_test_labels:bool=False, downscale_features:bool=False, n_workers:int=1, blas_threads_per_worker:int=None):
+        """
+        Evaluates the model of the first session of each (model, pred) pair on the features and MEG data of the second session.
+        Features, MEG data and stacked model coefficients are loaded once per session. With n_workers > 1 they are copied into shared memory and
+        the pairs are fanned out to a pool of forked worker processes with blas_threads_per_worker BLAS threads each (default: cpu count / n_workers).
+        Yields (session_id_model, session_id_pred, fit_measures) in order of completion.
+        """
+        if not session_pairs:
+            return
+        StageMetrics.count_items("session_pairs", len(session_pairs))
+
+        pred_type = "train" if predict_train_data else "test"
+        session_arrays = {}
+        for session_id_pred in sorted({session_id_pred for _, session_id_pred in session_pairs}):
+            X_pred = self.load_split_data_from_file(session_id_num=session_id_pred, type_of_content=self.ann_features_type, ann_model=self.ann_model, module=self.module_name)[pred_type]
+            if downscale_features:
+                X_pred = self.normalize_array(data=X_pred, normalization="range_-1_to_1")
+            session_arrays[("X", session_id_pred)] = X_pred
+            session_arrays[("Y", session_id_pred)] = self.load_split_data_from_file(session_id_num=session_id_pred, type_of_content="meg_data", type_of_norm=normalization)[pred_type]
+        for session_id_model in sorted({session_id_model for session_id_model, _ in session_pairs}):
+            storage_folder = self.get_GLM_model_folder(normalization=normalization, all_sessions_combined=False, session_id_num=session_id_model)
+            ridge_model = self.load_GLM_models(storage_folder=storage_folder)
+            session_arrays[("coef", session_id_model)] = ridge_model.coef_
+            session_arrays[("intercept", session_id_model)] = ridge_model.intercept_
+
+        n_workers = min(n_workers, len(session_pairs))
+        if n_workers <= 1:
+            for session_id_model, session_id_pred in session_pairs:
+                fit_measures = self.calculate_session_pair_fit_measures(session_arrays=session_arrays, session_id_model=session_id_model, session_id_pred=session_id_pred, 
+                                                                        fit_measure_storage_distinction=fit_measure_storage_distinction, shuffle_test_labels=shuffle_test_labels)
+                yield session_id_model, session_id_pred, fit_measures
+            return
+
+        if blas_threads_per_worker is None:
+            blas_threads_per_worker = max(1, os.cpu_count() // n_workers)
+        logger.custom_info(f"Evaluating {len(session_pairs)} session pairs with {n_workers} workers and {blas_threads_per_worker} BLAS threads per worker")
+
+        shared_array_specs = {}
+        shared_memory_blocks = []
+        try:
+            for array_key, array in session_arrays.items():
+                array = np.ascontiguousarray(array)
+                shared_memory_block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                shared_memory_blocks.append(shared_memory_block)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=shared_memory_block.buf)[...] = array
+                shared_array_specs[array_key] = (shared_memory_block.name, array.shape, array.dtype.str)
+            del session_arrays
+
+            # Fork instead of spawn: main.py runs the pipeline at import time and would be re-executed by spawned workers
+            tasks = [(session_id_model, session_id_pred, fit_measure_storage_distinction, shuffle_test_labels) for session_id_model, session_id_pred in session_pairs]
+            with multiprocessing.get_context("fork").Pool(processes=n_workers, initializer=self.init_prediction_worker, initargs=(shared_array_specs, blas_threads_per_worker)) as pool:
+                for session_id_model, session_id_pred, fit_measures in pool.imap_unordered(GLMHelper.evaluate_session_pair_in_worker, tasks):
+                    yield session_id_model, session_id_pred, fit_measures
+        finally:
+            for shared_memory_block in shared_memory_blocks:
+                shared_memory_block.close()
+                shared_memory_block.unlink()
+
+
+    def init_prediction_worker(self, shared_array_specs:dict, blas_threads:int) -> None:
+        """
+        Initializer of the prediction worker processes: limits the BLAS threads and attaches the shared session arrays once per process.
+        """
+        threadpool_limits(limits=blas_threads)
+        # Forked workers inherit the random state of the parent, reseed for independent label shuffles
+        np.random.seed()
+
+        shared_memory_blocks = []
+        session_arrays = {}
+        for array_key, (shared_memory_name, shape, dtype) in shared_array_specs.items():
+            shared_memory_block = shared_memory.SharedMemory(name=shared_memory_name)
+            shared_memory_blocks.append(shared_memory_block)
+            session_arrays[array_key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shared_memory_block.buf)
+            session_arrays[array_key].flags.writeable = False
+        GLMHelper.prediction_worker_state = {"helper": self, "session_arrays": session_arrays, "shared_memory_blocks": shared_memory_blocks}
+
+
+    @staticmethod
+    def evaluate_session_pair_in_worker(task:tuple) -> tuple:
+        """
+        Evaluates a single (model, pred) session pair in a prediction worker process.
+        """
+        session_id_model, session_id_pred, fit_measure_storage_distinction, shuffle_test_labels = task
+        worker_state = GLMHelper.prediction_worker_state
+        fit_measures = worker_state["helper"].calculate_session_pair_fit_measures(session_arrays=worker_state["session_arrays"], session_id_model=session_id_model, session_id_pred=session_id_pred, 
+                                                                                  fit_measure_storage_distinction=fit_measure_storage_distinction, shuffle_test_labels=shuffle_test_labels)
+
+        return session_id_model, session_id_pred, fit_measures
+
+
+    def calculate_session_pair_fit_measures(self, session_arrays:dict, session_id_model:str, session_id_pred:str, fit_measure_storage_distinction:str, shuffle_test_labels:bool=False) -> dict:
+        """
+        Predicts the MEG data of session_id_pred with the stacked timepoint models of session_id_model and calculates the fit measures of the chosen storage distinction.
+        session_level: mse, var_explained and r_pearson over all flattened values, timepoint_level: var_explained and r_pearson per timepoint (averaged over sensors), timepoint_sensor_level: var_explained per sensor and timepoint.
+        """
+        X_test = session_arrays[("X", session_id_pred)]
+        Y_test = session_arrays[("Y", session_id_pred)]
+        if shuffle_test_labels:
+            Y_test = Y_test[np.random.permutation(Y_test.shape[0])]
+
+        # (samples, features) x (timepoints, sensors, features) -> (samples, sensors, timepoints)
+        predictions = np.tensordot(X_test, session_arrays[("coef", session_id_model)], axes=([1], [2])).transpose(0, 2, 1) + session_arrays[("intercept", session_id_model)].T[np.newaxis]
+
+        if fit_measure_storage_distinction == "session_level":
+            r_pearson, _ = pearsonr(Y_test.reshape(-1), predictions.reshape(-1))
+            return {"mse": float(mean_squared_error(Y_test.reshape(-1), predictions.reshape(-1))), 
+                    "var_explained": float(r2_score(Y_test.reshape(-1), predictions.reshape(-1))), 
+                    "r_pearson": float(r_pearson)}
+
+        var_explained, r_pearson = self.calculate_fit_measures_by_sensor_timepoint(Y_true=Y_test, Y_pred=predictions)
+        if fit_measure_storage_distinction == "timepoint_level":
+            return {"var_explained": var_explained.mean(axis=0), "r_pearson": r_pearson.mean(axis=0)}
+
+        return {"var_explained": var_explained}
+
+
+    def get_GLM_model_path(self, normalization:str, session_id_num:str) -> str:
+        """
+        Returns the path of the stored session GLM models (GLM_models.h5, or the legacy GLM_models.pkl), None if no models are stored.
+        """
+        storage_folder = self.get_GLM_model_folder(normalization=normalization, all_sessions_combined=False, session_id_num=session_id_num)
+        for model_file in ["GLM_models.h5", "GLM_models.pkl"]:
+            model_path = os.path.join(storage_folder, model_file)
+            if os.path.exists(model_path):
+                return model_path
+
+        return None
+
+
+    def get_session_input_modification_time(self, session_id_num:str, normalization:str, splits:list = ["train", "test"]) -> float:
+        """
+        Returns the latest modification time of the ANN features and MEG data files of a session.
+        """
+        input_paths = [self.get_split_data_path(session_id_num=session_id_num, type_of_content=self.ann_features_type, split=split, ann_model=self.ann_model, module=self.module_name) for split in splits]
+        input_paths += [self.get_split_data_path(session_id_num=session_id_num, type_of_content="meg_data", split=split, type_of_norm=normalization) for split in splits]
+
+        return max(self.get_split_data_modification_time(split_path=input_path) for input_path in input_paths)
+
+
+    def get_sessions_requiring_update(self, normalization:str) -> list:
+        """
+        Returns the sessions without stored GLM models or whose train data (features or MEG) is newer than their models.
+        """
+        sessions_requiring_update = []
+        for session_id_num in self.session_ids_num:
+            model_path = self.get_GLM_model_path(normalization=normalization, session_id_num=session_id_num)
+            if model_path is None or self.get_session_input_modification_time(session_id_num=session_id_num, normalization=normalization, splits=["train"]) > os.path.getmtime(model_path):
+                sessions_requiring_update.append(session_id_num)
+
+        return sessions_requiring_update
+
+
+    def get_fit_measure_result_paths(self, fit_measure_storage_distinction:str, normalization:str, predict_train_data:bool) -> dict:
+        """
+        Returns the paths of the result files written by predict_from_mapping (not all sessions combined) for a fit_measure_storage_distinction.
+        """
+        if fit_measure_storage_distinction == "session_level":
+            return {"mse_losses": f"{self.get_fit_measure_subject_folder('mse_losses')}/norm_{normalization}/mse_losses_{normalization}_dict.json",
+                    "var_explained": f"{self.get_fit_measure_subject_folder('var_explained')}/norm_{normalization}/predict_train_data_{predict_train_data}/var_explained_{normalization}_dict.json"}
+        elif fit_measure_storage_distinction == "timepoint_level":
+            main_folders = ["var_explained_timepoints", "pearson_r_timepoints"]
+        else:
+            main_folders = ["var_explained_sensors_timepoints"]
+
+        return {main_folder: f"{self.get_fit_measure_subject_folder(main_folder)}/norm_{normalization}/{main_folder}_dict.json" for main_folder in main_folders}
+
+
+    def load_fit_measures_for_incremental_update(self, fit_measure_storage_distinction:str, normalization:str, predict_train_data:bool) -> Tuple[list, dict]:
+        """
+        Loads stored cross-session results and determines the sessions whose row and column need to be recomputed: sessions missing from the results
+        and sessions whose model or test data is newer than the results. Returns all sessions and None if results are missing.
+        """
+        result_paths = self.get_fit_measure_result_paths(fit_measure_storage_distinction=fit_measure_storage_distinction, normalization=normalization, predict_train_data=predict_train_data)
+        if not all(os.path.exists(result_path) for result_path in result_paths.values()):
+            return self.session_ids_num, None
+
+        stored_fit_measure_dicts = {}
+        for fit_measure, result_path in result_paths.items():
+            with open(result_path, 'r') as file:
+                stored_fit_measure_dicts[fit_measure] = json.load(file)
+        results_modification_time = min(os.path.getmtime(result_path) for result_path in result_paths.values())
+
+        # Sessions with a stored row in all result files
+        stored_session_ids = set(self.session_ids_num)
+        for fit_measure_dict in stored_fit_measure_dicts.values():
+            session_level_dict = next(iter(fit_measure_dict["sensor"].values())) if "sensor" in fit_measure_dict else fit_measure_dict
+            stored_session_ids &= set(session_level_dict.get("session_mapping", {}).keys())
+
+        sessions_to_update = []
+        for session_id_num in self.session_ids_num:
+            model_path = self.get_GLM_model_path(normalization=normalization, session_id_num=session_id_num)
+            if (session_id_num not in stored_session_ids or model_path is None or os.path.getmtime(model_path) > results_modification_time
+                    or self.get_session_input_modification_time(session_id_num=session_id_num, normalization=normalization) > results_modification_time):
+                sessions_to_update.append(session_id_num)
+
+        return sessions_to_update, stored_fit_measure_dicts
+
+
+    def get_GLM_model_folder(self, normalization:str, all_sessions_combined:bool = False, session_id_num:str = None, leave_out_session_id:str = None) -> str:
+        """
+        Returns the folder of the trained GLM models for a normalization and either a session, all sessions combined or all sessions except leave_out_session_id.
+        """
+        if leave_out_session_id is not None:
+            return f"data_files/{self.lock_event}/GLM_models/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/leave_one_session_out/norm_{normalization}/session_{leave_out_session_id}"
+
+        all_session_folder = f"/all_sessions_combined" if all_sessions_combined else ""
+        session_addition = f"/session_{session_id_num}" if not all_sessions_combined else ""
+
+        return f"data_files/{self.lock_event}/GLM_models/{self.ann_model}/{self.module_name}/subject_{self.subject_id}{all_session_folder}/norm_{normalization}{session_addition}"
+
+
+    def save_GLM_models(self, ridge_model, save_folder:str, normalization:str) -> None:
+        """
+        Stores the per-timepoint models of a MultiDimensionalRegression as one versioned HDF5 file with stacked arrays:
+        coef (timepoints, sensors, features), intercept (timepoints, sensors), the selected alphas/fractions and the configuration used.
+        Datasets are contiguous and uncompressed, so that they can be memory-mapped when loading.
+        """
+        os.makedirs(save_folder, exist_ok=True)
+        save_path = os.path.join(save_folder, "GLM_models.h5")
+
+        config = {"ann_model": self.ann_model,
+                  "module_name": self.module_name,
+                  "ann_features_type": self.ann_features_type,
+                  "normalization": normalization,
+                  "timepoint_min": self.timepoint_min,
+                  "timepoint_max": self.timepoint_max,
+                  "chosen_channels": [str(channel) for channel in self.chosen_channels],
+                  "fractional_ridge": self.fractional_ridge,
+                  "alphas": [float(alpha) for alpha in self.alphas],
+                  "fractional_grid": [float(fraction) for fraction in self.fractional_grid],
+                  "random_weights": ridge_model.random_weights}
+
+        # Written to a temporary file first, so an interrupted write never leaves a truncated model file
+        temporary_path = self.get_temporary_path(save_path)
+        with h5py.File(temporary_path, "w") as f:
+            f.attrs["format_version"] = GLMHelper.GLM_model_format_version
+            f.attrs["regularization_type"] = "fractions" if self.fractional_ridge else "alphas"
+            f.attrs["config"] = json.dumps(config)
+            f.create_dataset("coef", data=ridge_model.coef_)
+            f.create_dataset("intercept", data=ridge_model.intercept_)
+            if ridge_model.regularization_ is not None:
+                f.create_dataset("regularization", data=ridge_model.regularization_)
+        os.replace(temporary_path, save_path)
+        StageMetrics.add_bytes_written(os.path.getsize(save_path))
+        StageMetrics.count_items("timepoint_models", len(ridge_model.coef_))
+        logger.custom_debug(f"Storing GLM models to {save_path}")
+
+
+    def load_GLM_models(self, storage_folder:str, mmap_mode:str = "r"):
+        """
+        Loads trained GLM models as MultiDimensionalRegression with stacked coefficient arrays (memory-mapped by default).
+        Falls back to previously pickled lists of sklearn/fracridge models (GLM_models.pkl).
+        """
+        storage_path = os.path.join(storage_folder, "GLM_models.h5")
+        if os.path.exists(storage_path):
+            with h5py.File(storage_path, "r") as f:
+                format_version = int(f.attrs["format_version"])
+                if format_version > GLMHelper.GLM_model_format_version:
+                    raise ValueError(f"GLM model file {storage_path} has format version {format_version}, only versions up to {GLMHelper.GLM_model_format_version} are supported.")
+                coef = self.read_hdf5_dataset(f["coef"], mmap_mode=mmap_mode)
+                intercept = self.read_hdf5_dataset(f["intercept"], mmap_mode=mmap_mode)
+                regularization = f["regularization"][()] if "regularization" in f else None
+                config = json.loads(f.attrs["config"])
+            StageMetrics.add_bytes_read(coef.nbytes + intercept.nbytes, memory_mapped=isinstance(coef, np.memmap))
+            ridge_model = GLMHelper.MultiDimensionalRegression(self, coef=coef, intercept=intercept, regularization=regularization, random_weights=config["random_weights"])
+        else:
+            legacy_storage_path = os.path.join(storage_folder, "GLM_models.pkl")
+            with open(legacy_storage_path, 'rb') as file:
+                ridge_models = pickle.load(file)
+            StageMetrics.add_bytes_read(os.path.getsize(legacy_storage_path))
+            ridge_model = GLMHelper.MultiDimensionalRegression(self, models=ridge_models)
+            ridge_model.stack_models()
+        logger.custom_debug(f"Loaded GLM models from {storage_folder}")
+
+        return ridge_model
+
+
+    def load_all_sessions_combined_features(self, split:str) -> np.ndarray:
+        """
+        Returns the features of a split over all sessions, in the order of self.session_ids_num (like the combined meg data). Per-session pca features live in
+        different bases, for them the pca fitted on all sessions combined is used; all other feature types (e.g. shared basis pca) share their feature space and are concatenated.
+        """
+        if self.ann_features_type == "ann_features_pca":
+            return self.load_split_data_from_file(session_id_num=None, type_of_content="ann_features_pca_all_sessions_combined", ann_model=self.ann_model, module=self.module_name)[split]
+
+        return np.concatenate([self.load_split_data_from_file(session_id_num=session_id_num, type_of_content=self.ann_features_type, ann_model=self.ann_model, module=self.module_name, mmap_mode="r")[split] 
+                               for session_id_num in self.session_ids_num])
+
+
+    def load_common_space_session_features(self) -> dict:
+        """
+        Returns the train/test ANN features of every session in a feature space shared by all sessions, as dict session_id -> {"train", "test"}.
+        Per-session pca features live in different bases, for them the slices of the all_sessions_combined pca features are used
+        (concatenated in the order of self.session_ids_num, so the per-session sizes are taken from the meg data).
+        """
+        session_features = {}
+        if self.ann_features_type != "ann_features_pca":
+            for session_id_num in self.session_ids_num:
+                session_features[session_id_num] = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content=self.ann_features_type, ann_model=self.ann_model, module=self.module_name, mmap_mode="r")
+            return session_features
+
+        ann_features_combined = self.load_split_data_from_file(session_id_num=None, type_of_content="ann_features_pca_all_sessions_combined", ann_model=self.ann_model, module=self.module_name, mmap_mode="r")
+        split_offsets = {"train": 0, "test": 0}
+        for session_id_num in self.session_ids_num:
+            meg_data = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content="meg_data", type_of_norm=self.normalizations[0], mmap_mode="r")
+            session_features[session_id_num] = {}
+            for split in split_offsets:
+                n_epochs = len(meg_data[split])
+                session_features[session_id_num][split] = ann_features_combined[split][split_offsets[split]:split_offsets[split] + n_epochs]
+                split_offsets[split] += n_epochs
+        for split in split_offsets:
+            assert split_offsets[split] == len(ann_features_combined[split]), f"Combined {split} features do not match the number of {split} epochs over sessions."
+
+        return session_features
+
+
+    def calculate_sufficient_statistics(self, X:np.ndarray, Y:np.ndarray, chunk_size:int = 2048) -> dict:
+        """
+        Accumulates the sufficient statistics of a ridge regression from X (epochs, features) to Y (epochs, sensors, timepoints) chunk-wise:
+        number of epochs, feature and target sums, XᵀX, XᵀY and the target sums of squares. Targets are flattened over sensors and timepoints.
+        """
+        n_features = X.shape[1]
+        target_shape = Y.shape[1:]
+        n_targets = int(np.prod(target_shape))
+        statistics = {"n": 0,
+                      "sum_x": np.zeros(n_features),
+                      "sum_y": np.zeros(n_targets),
+                      "xtx": np.zeros((n_features, n_features)),
+                      "xty": np.zeros((n_features, n_targets)),
+                      "yty": np.zeros(n_targets),
+                      "target_shape": target_shape}
+
+        for start_idx in range(0, len(X), chunk_size):
+            X_chunk = np.asarray(X[start_idx:start_idx+chunk_size], dtype=np.float64)
+            Y_chunk = np.asarray(Y[start_idx:start_idx+chunk_size], dtype=np.float64).reshape(len(X_chunk), n_targets)
+            statistics["n"] += len(X_chunk)
+            statistics["sum_x"] += X_chunk.sum(axis=0)
+            statistics["sum_y"] += Y_chunk.sum(axis=0)
+            statistics["xtx"] += X_chunk.T @ X_chunk
+            statistics["xty"] += X_chunk.T @ Y_chunk
+            statistics["yty"] += np.sum(Y_chunk**2, axis=0)
+
+        return statistics
+
+
+    def combine_sufficient_statistics(self, statistics_list:list) -> dict:
+        """
+        Sums the sufficient statistics of several sessions, giving the statistics of their concatenated data.
+        """
+        combined_statistics = {key: sum(statistics[key] for statistics in statistics_list) for key in ["n", "sum_x", "sum_y", "xtx", "xty", "yty"]}
+        combined_statistics["target_shape"] = statistics_list[0]["target_shape"]
+
+        return combined_statistics
+
+
+    def solve_ridge_from_sufficient_statistics(self, statistics:dict):
+        """
+        Solves ridge regressions with intercept for all sensors and timepoints from sufficient statistics.
+        One eigendecomposition of the centered XᵀX serves all alphas and targets. As in the per-timepoint RidgeCV, one alpha is selected per timepoint,
+        here by generalized cross-validation (GCV, the rotation-invariant form of efficient leave-one-out), which only requires the statistics.
+        Returns a MultiDimensionalRegression with stacked coef_ (timepoints, sensors, features) and intercept_ (timepoints, sensors).
+        """
+        n = statistics["n"]
+        n_sensors, n_timepoints = statistics["target_shape"]
+        mean_x = statistics["sum_x"] / n
+        mean_y = statistics["sum_y"] / n
+
+        # Center statistics (equivalent to fitting an intercept)
+        xtx_centered = statistics["xtx"] - n * np.outer(mean_x, mean_x)
+        xty_centered = statistics["xty"] - n * np.outer(mean_x, mean_y)
+        yty_centered = statistics["yty"] - n * mean_y**2
+
+        eigenvalues, eigenvectors = np.linalg.eigh(xtx_centered)
+        eigenvalues = np.clip(eigenvalues, 0, None)
+        xty_rotated = eigenvectors.T @ xty_centered  # (features, targets)
+
+        # GCV score for every alpha and target
+        alphas = np.asarray(self.alphas, dtype=np.float64)
+        gcv_scores = np.zeros((len(alphas), xty_rotated.shape[1]))
+        for alpha_idx, alpha in enumerate(alphas):
+            shrinkage = 1 / (eigenvalues + alpha)
+            residual_sum_squares = yty_centered - np.sum(xty_rotated**2 * ((eigenvalues + 2*alpha) * shrinkage**2)[:, np.newaxis], axis=0)
+            degrees_of_freedom = np.sum(eigenvalues * shrinkage)
+            gcv_scores[alpha_idx] = residual_sum_squares / (n - degrees_of_freedom)**2
+
+        # Select one alpha per timepoint (summed over sensors)
+        gcv_scores_by_timepoint = gcv_scores.reshape(len(alphas), n_sensors, n_timepoints).sum(axis=1)
+        selected_alphas = alphas[np.argmin(gcv_scores_by_timepoint, axis=0)]
+        selected_alphas_by_target = np.broadcast_to(selected_alphas, (n_sensors, n_timepoints)).reshape(-1)
+
+        coef = eigenvectors @ (xty_rotated / (eigenvalues[:, np.newaxis] + selected_alphas_by_target[np.newaxis]))  # (features, targets)
+        intercept = mean_y - mean_x @ coef
+
+        counts_selected_alphas = Counter(selected_alphas.tolist())
+        logger.custom_debug(f"selected alphas: {sorted(counts_selected_alphas.items(), key=lambda x: x[1], reverse=True)}")
+
+        ridge_model = GLMHelper.MultiDimensionalRegression(self, coef=coef.reshape(-1, n_sensors, n_timepoints).transpose(2, 1, 0),
+                                                           intercept=intercept.reshape(n_sensors, n_timepoints).T,
+                                                           regularization=selected_alphas)
+        ridge_model.selected_alphas = selected_alphas.tolist()
+
+        return ridge_model
+
+
+    def calculate_fractional_ridge_path(self, X:np.ndarray, Y:np.ndarray, fractions:np.ndarray, tol:float = 1e-10) -> dict:
+        """
+        Vectorized version of fracridge.fracridge for all targets (columns of Y) at once. Rotates the data with one decomposition of X
+        and interpolates, for every target, the alphas at which the coefficient length reaches the requested fractions of the OLS length.
+        Returns the rotation (features, components), squared singular values, OLS coefficients in the rotated space (components, targets) and alphas (fractions, targets).
+        """
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y, dtype=np.float64)
+        n_samples, n_features = X.shape
+
+        if n_samples > n_features:
+            eigenvalues, eigenvectors = np.linalg.eigh(X.T @ X)
+            # Descending order as in the svd
+            singular_values = np.sqrt(np.clip(eigenvalues[::-1], 0, None))
+            rotation = eigenvectors[:, ::-1]
+            rotated_targets = rotation.T @ (X.T @ Y)
+            valid_components = singular_values >= tol
+            rotated_targets[valid_components] /= singular_values[valid_components, np.newaxis]
+        else:
+            left_singular_vectors, singular_values, rotation_t = np.linalg.svd(X, full_matrices=False)
+            rotation = rotation_t.T
+            rotated_targets = left_singular_vectors.T @ Y
+            valid_components = singular_values >= tol
+        if not np.all(valid_components):
+            logger.custom_debug(f"Fractional ridge: {np.sum(~valid_components)} singular values are treated as 0.")
+
+        ols_rotated = np.zeros_like(rotated_targets)
+        ols_rotated[valid_components] = rotated_targets[valid_components] / singular_values[valid_components, np.newaxis]
+        singular_values_squared = singular_values**2
+        alphas = self.calculate_fractional_ridge_alphas(singular_values_squared=singular_values_squared, ols_rotated=ols_rotated, fractions=fractions, valid_components=valid_components)
+
+        return {"rotation": rotation, "singular_values_squared": singular_values_squared, "ols_rotated": ols_rotated, "alphas": alphas}
+
+
+    def calculate_fractional_ridge_alphas(self, singular_values_squared:np.ndarray, ols_rotated:np.ndarray, fractions:np.ndarray, valid_components:np.ndarray) -> np.ndarray:
+        """
+        Interpolates, for every target, the alphas at which the coefficient length reaches the requested fractions of the OLS length (as in fracridge).
+        Expects the squared singular values and the OLS coefficients (components, targets) in the rotated space, returns alphas (fractions, targets).
+        """
+        # Grid of candidate alphas used for interpolation (as in fracridge)
+        largest_alpha = 10e3 * singular_values_squared[valid_components].max()
+        smallest_alpha = 10e-3 * singular_values_squared[valid_components].min()
+        alpha_grid = np.concatenate([[0], 10 ** np.arange(np.floor(np.log10(smallest_alpha)), np.ceil(np.log10(largest_alpha)), 0.2)])
+        log_alpha_grid = np.log1p(alpha_grid)
+
+        # Coefficient length relative to OLS for every candidate alpha and target (decreasing with alpha)
+        scaling = singular_values_squared / (singular_values_squared + alpha_grid[:, np.newaxis])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            relative_lengths = np.sqrt(scaling**2 @ ols_rotated**2)
+            relative_lengths = np.nan_to_num(relative_lengths / relative_lengths[0])
+
+        # Linear interpolation of log(1 + alpha) at the requested fractions, clamped at the ends of the grid like np.interp
+        fractions = np.asarray(fractions, dtype=np.float64)
+        n_grid_points_above = np.sum(relative_lengths[np.newaxis] >= fractions[:, np.newaxis, np.newaxis], axis=1)
+        lower_idx = np.clip(n_grid_points_above - 1, 0, len(alpha_grid) - 2)
+        lengths_lower = np.take_along_axis(relative_lengths, lower_idx, axis=0)
+        lengths_upper = np.take_along_axis(relative_lengths, lower_idx + 1, axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            interpolation_weights = np.nan_to_num(np.clip((lengths_lower - fractions[:, np.newaxis]) / (lengths_lower - lengths_upper), 0, 1))
+        log_alphas = log_alpha_grid[lower_idx] + interpolation_weights * (log_alpha_grid[lower_idx + 1] - log_alpha_grid[lower_idx])
+
+        return np.expm1(log_alphas)
+
+
+    def fit_batched_fractional_ridge(self, X:np.ndarray, Y:np.ndarray, fractions:np.ndarray, n_splits:int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Fractional ridge for all targets (columns of Y) with a best fraction selected per target by K-fold cross-validation (R², contiguous folds as in
+        the GridSearchCV of FracRidgeRegressorCV). Each fold and the final fit need a single decomposition of X for all fractions and targets.
+        Like FracRidgeRegressorCV no intercept is fit. Returns coefficients (features, targets) and the selected fractions (targets).
+        """
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y, dtype=np.float64)
+        n_targets = Y.shape[1]
+
+        cv_scores = np.zeros((len(fractions), n_targets))
+        for train_idx, val_idx in KFold(n_splits=n_splits).split(X):
+            fractional_ridge_path = self.calculate_fractional_ridge_path(X[train_idx], Y[train_idx], fractions)
+            X_val_rotated = X[val_idx] @ fractional_ridge_path["rotation"]
+            Y_val = Y[val_idx]
+            sum_squares_total = np.sum((Y_val - Y_val.mean(axis=0))**2, axis=0)
+            for fraction_idx, fraction_alphas in enumerate(fractional_ridge_path["alphas"]):
+                scaling = fractional_ridge_path["singular_values_squared"][:, np.newaxis] / (fractional_ridge_path["singular_values_squared"][:, np.newaxis] + fraction_alphas)
+                predictions = X_val_rotated @ (scaling * fractional_ridge_path["ols_rotated"])
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    cv_scores[fraction_idx] += np.nan_to_num(1 - np.sum((Y_val - predictions)**2, axis=0) / sum_squares_total) / n_splits
+
+        best_fraction_idx = np.argmax(cv_scores, axis=0)
+
+        fractional_ridge_path = self.calculate_fractional_ridge_path(X, Y, fractions)
+        selected_alphas = fractional_ridge_path["alphas"][best_fraction_idx, np.arange(n_targets)]
+        scaling = fractional_ridge_path["singular_values_squared"][:, np.newaxis] / (fractional_ridge_path["singular_values_squared"][:, np.newaxis] + selected_alphas)
+        coef = fractional_ridge_path["rotation"] @ (scaling * fractional_ridge_path["ols_rotated"])
+
+        return coef, np.asarray(fractions)[best_fraction_idx]
+
+
+    def fit_dual_ridge(self, X:np.ndarray, Y:np.ndarray, n_timepoints:int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Ridge regression with intercept in sample space for all targets (columns of Y, ordered sensors x timepoints) at once.
+        The (samples x samples) Gram matrix is eigendecomposed once for all alphas and targets. One alpha is selected per timepoint by
+        exact leave-one-out errors averaged over sensors, as in RidgeCV (intercept handled as an unpenalized direction like sklearn's gram mode).
+        Returns coefficients (features, targets), intercepts (targets) and the selected alphas (timepoints).
+        """
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y, dtype=np.float64)
+        n_samples = X.shape[0]
+        n_sensors = Y.shape[1] // n_timepoints
+
+        X_mean = X.mean(axis=0)
+        Y_mean = Y.mean(axis=0)
+        X_centered = X - X_mean
+        Y_centered = Y - Y_mean
+
+        # The constant added to the Gram matrix represents the intercept
+        gram = X_centered @ X_centered.T + 1
+        eigenvalues, eigenvectors = np.linalg.eigh(gram)
+        intercept_dim = np.argmax(np.abs(eigenvectors.T @ np.full(n_samples, 1 / np.sqrt(n_samples))))
+        rotated_targets = eigenvectors.T @ Y_centered
+
+        def shrinkage_weights(alpha):
+            weights = 1 / (eigenvalues + alpha)
+            weights[intercept_dim] = 0  # cancel regularization of the intercept
+            return weights
+
+        alphas = np.asarray(self.alphas, dtype=np.float64)
+        loo_errors = np.zeros((len(alphas), n_timepoints))
+        for alpha_idx, alpha in enumerate(alphas):
+            weights = shrinkage_weights(alpha)
+            dual_coef = eigenvectors @ (weights[:, np.newaxis] * rotated_targets)
+            gram_inverse_diag = (eigenvectors**2) @ weights
+            squared_loo_residuals = (dual_coef / gram_inverse_diag[:, np.newaxis])**2
+            loo_errors[alpha_idx] = squared_loo_residuals.reshape(n_samples, n_sensors, n_timepoints).mean(axis=(0, 1))
+
+        selected_alphas = alphas[np.argmin(loo_errors, axis=0)]
+
+        # Dual coefficients with the alpha selected for the timepoint of each target
+        dual_coef = np.zeros_like(Y_centered)
+        target_timepoints = np.tile(np.arange(n_timepoints), n_sensors)
+        for alpha in np.unique(selected_alphas):
+            target_idx = np.flatnonzero(selected_alphas[target_timepoints] == alpha)
+            dual_coef[:, target_idx] = eigenvectors @ (shrinkage_weights(alpha)[:, np.newaxis] * rotated_targets[:, target_idx])
+        coef = X_centered.T @ dual_coef
+        intercept = Y_mean - X_mean @ coef
+
+        return coef, intercept, selected_alphas
+
+
+    @StageMetrics.measure
+    def train_mapping_from_sufficient_statistics(self, shuffle_train_labels:bool=False, downscale_features:bool=False):
+        """
+        Computes the sufficient statistics of every session once and solves the all-sessions-combined model as well as
+        one leave-one-session-out model per session from their sums, without concatenating data over sessions.
+        """
+        if self.fractional_ridge:
+            logger.warning("ridge_solver sufficient_statistics selects alphas from self.alphas, fractional_ridge is not applied.")
+
+        session_features = self.load_common_space_session_features()
+        for normalization in self.normalizations:
+            logger.custom_info(f"Training mappings from sufficient statistics for normalization {normalization}")
+            session_statistics = {}
+            for session_id_num in self.session_ids_num:
+                X_train = session_features[session_id_num]["train"]
+                Y_train = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content="meg_data", type_of_norm=normalization, mmap_mode="r")["train"]
+                assert X_train.shape[0] == Y_train.shape[0], "Different number of samples for features and meg data."
+
+                if shuffle_train_labels:
+                    Y_train = np.random.permutation(Y_train)
+                if downscale_features:
+                    X_train = self.normalize_array(data=np.asarray(X_train), normalization="range_-1_to_1")
+
+                session_statistics[session_id_num] = self.calculate_sufficient_statistics(X=X_train, Y=Y_train)
+                logger.custom_debug(f"[Session {session_id_num}] Sufficient statistics computed from {session_statistics[session_id_num]['n']} epochs.")
+
+            # All sessions combined
+            ridge_model = self.solve_ridge_from_sufficient_statistics(self.combine_sufficient_statistics(list(session_statistics.values())))
+            save_folder = self.get_GLM_model_folder(normalization=normalization, all_sessions_combined=True)
+            self.save_GLM_models(ridge_model=ridge_model, save_folder=save_folder, normalization=normalization)
+
+            # Leave one session out
+            if len(session_statistics) < 2:
+                logger.warning("Leave-one-session-out models require at least two sessions, skipping them.")
+                continue
+            for leave_out_session_id in self.session_ids_num:
+                remaining_statistics = [statistics for session_id_num, statistics in session_statistics.items() if session_id_num != leave_out_session_id]
+                ridge_model = self.solve_ridge_from_sufficient_statistics(self.combine_sufficient_statistics(remaining_statistics))
+                save_folder = self.get_GLM_model_folder(normalization=normalization, leave_out_session_id=leave_out_session_id)
+                self.save_GLM_models(ridge_model=ridge_model, save_folder=save_folder, normalization=normalization)
+
+
+    @StageMetrics.measure
+    def predict_from_leave_one_session_out_mapping(self, predict_train_data:bool=False, downscale_features:bool=False):
+        """
+        Evaluates each leave-one-session-out model on the session it was not trained on.
+        Stores mse, variance explained and pearson r (flattened over sensors and timepoints) per held-out session.
+        """
+        session_features = self.load_common_space_session_features()
+        pred_type = "train" if predict_train_data else "test"
+        for normalization in self.normalizations:
+            logger.custom_info(f"Predicting from leave-one-session-out mappings for normalization {normalization}")
+            fit_measure_dicts = {"var_explained": {"session_pred": {}}, "mse_losses": {"session_pred": {}}, "correlation": {"session_pred": {}}}
+            for leave_out_session_id in self.session_ids_num:
+                storage_folder = self.get_GLM_model_folder(normalization=normalization, leave_out_session_id=leave_out_session_id)
+                ridge_model = self.load_GLM_models(storage_folder=storage_folder)
+
+                X_test = np.asarray(session_features[leave_out_session_id][pred_type])
+                Y_test = self.load_split_data_from_file(session_id_num=leave_out_session_id, type_of_content="meg_data", type_of_norm=normalization)[pred_type]
+                predictions = ridge_model.predict(X_test, downscale_features=downscale_features)
+
+                fit_measure_dicts["mse_losses"]["session_pred"][leave_out_session_id] = mean_squared_error(Y_test.reshape(-1), predictions.reshape(-1))
+                fit_measure_dicts["var_explained"]["session_pred"][leave_out_session_id] = r2_score(Y_test.reshape(-1), predictions.reshape(-1))
+                fit_measure_dicts["correlation"]["session_pred"][leave_out_session_id], _ = pearsonr(Y_test.reshape(-1), predictions.reshape(-1))
+
+            logger.custom_info(f"Leave-one-session-out variance explained: {fit_measure_dicts['var_explained']['session_pred']}")
+
+            for fit_measure, dict_to_store in fit_measure_dicts.items():
+                storage_folder = f"data_files/{self.lock_event}/{fit_measure}/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/leave_one_session_out/norm_{normalization}/predict_train_data_{predict_train_data}"
+                os.makedirs(storage_folder, exist_ok=True)
+                json_storage_path = os.path.join(storage_folder, f"{fit_measure}_leave_one_session_out_dict.json")
+                with open(json_storage_path, 'w') as file:
+                    logger.custom_debug(f"Storing dict {fit_measure} to {json_storage_path}")
+                    json.dump(dict_to_store, file, indent=4)
+
+
+    def get_stored_GLM_alphas(self, normalization:str, session_id_num:str, n_timepoints:int) -> np.ndarray:
+        """
+        Returns the alphas per timepoint selected by the stored (non-fractional) GLM models of a session, None if there are no such models.
+        """
+        model_path = self.get_GLM_model_path(normalization=normalization, session_id_num=session_id_num)
+        if model_path is None or not model_path.endswith(".h5"):
+            return None
+        with h5py.File(model_path, "r") as f:
+            if f.attrs["regularization_type"] != "alphas" or "regularization" not in f:
+                return None
+            stored_alphas = f["regularization"][()]
+
+        return stored_alphas if stored_alphas.shape == (n_timepoints,) else None
+
+
+    @StageMetrics.measure
+    def run_permutation_test(self, n_permutations:int = 1000, permutation_batch_size:int = 8, random_seed:int = 0, tol:float = 1e-10, null_quantile_levels:tuple = (0.5, 0.95, 0.99)):
+        """
+        Permutation tests of self-prediction (variance explained and pearson r, per sensor and timepoint) and of the drift slope
+        (variance explained of cross-session predictions regressed on the distance in days between sessions).
+        Self-prediction: train labels of each session are permuted n_permutations times. Ridge predictions are linear in the labels, so every refit
+        reuses one svd of the centered train features of the session.
+        Drift slope: the cross-session fit measures of the unpermuted models are kept and the session dates are permuted instead (all orderings if
+        there are at most n_permutations), since models trained on permuted labels have no encoding left to drift.
+        Alphas per timepoint are those of the stored GLM models of the session; without them (or with fractional ridge) they are selected by GCV
+        over self.alphas, which may differ from the RidgeCV/fracridge selection of GLM_training (see alpha_source in the stored results).
+        Only observed values, p-values and quantiles of the null distributions are stored.
+        """
+        rng = np.random.default_rng(random_seed)
+        session_day_differences = self.get_session_date_differences()
+        n_sessions = len(self.session_ids_num)
+        session_pairs = [(model_idx, pred_idx) for model_idx in range(n_sessions) for pred_idx in range(n_sessions) if model_idx != pred_idx]
+        day_differences = np.array([[session_day_differences[session_id_model][session_id_pred] if session_id_model != session_id_pred else 0 for session_id_pred in self.session_ids_num] for session_id_model in self.session_ids_num], dtype=np.float64)
+
+        # Session date orderings of the drift null; row 0 is the observed ordering
+        if math.factorial(n_sessions) <= n_permutations + 1:
+            date_permutations = np.array(list(itertools.permutations(range(n_sessions))))
+        else:
+            date_permutations = np.vstack([np.arange(n_sessions)] + [rng.permutation(n_sessions) for _ in range(n_permutations)])
+        pair_model_idx, pair_pred_idx = np.array(session_pairs).T
+        # Drift slope = sum((d - mean(d)) * fit_measure) / sum((d - mean(d))**2) over pairs, as weights per date ordering (orderings, pairs)
+        pair_distances = day_differences[date_permutations[:, pair_model_idx], date_permutations[:, pair_pred_idx]]
+        pair_distances_centered = pair_distances - pair_distances.mean(axis=1, keepdims=True)
+        drift_slope_weights = pair_distances_centered / np.sum(pair_distances_centered**2, axis=1, keepdims=True)
+
+        for normalization in self.normalizations:
+            logger.custom_info(f"Permutation test with {n_permutations} permutations for normalization {normalization}")
+            ann_features = {session_id_num: self.load_split_data_from_file(session_id_num=session_id_num, type_of_content=self.ann_features_type, ann_model=self.ann_model, module=self.module_name) for session_id_num in self.session_ids_num}
+            meg_data = {session_id_num: self.load_split_data_from_file(session_id_num=session_id_num, type_of_content="meg_data", type_of_norm=normalization) for session_id_num in self.session_ids_num}
+            n_sensors, n_timepoints = meg_data[self.session_ids_num[0]]["test"].shape[1:]
+            target_timepoints = np.tile(np.arange(n_timepoints), n_sensors)
+            Y_test = {session_id_num: meg_data[session_id_num]["test"].reshape(len(meg_data[session_id_num]["test"]), -1).astype(np.float64) for session_id_num in self.session_ids_num}
+
+            observed_var_explained = np.zeros((n_sessions, n_sensors * n_timepoints))
+            observed_pearson_r = np.zeros((n_sessions, n_sensors * n_timepoints))
+            p_values_var_explained = np.zeros((n_sessions, n_sensors * n_timepoints))
+            p_values_pearson_r = np.zeros((n_sessions, n_sensors * n_timepoints))
+            null_quantiles_var_explained = np.zeros((n_sessions, len(null_quantile_levels), n_sensors * n_timepoints), dtype=np.float32)
+            null_quantiles_pearson_r = np.zeros((n_sessions, len(null_quantile_levels), n_sensors * n_timepoints), dtype=np.float32)
+            pair_var_explained = np.zeros((len(session_pairs), n_sensors * n_timepoints))
+            selected_alphas_by_session = np.zeros((n_sessions, n_timepoints))
+            alpha_sources = []
+
+            for model_idx, session_id_model in enumerate(self.session_ids_num):
+                X_train = np.asarray(ann_features[session_id_model]["train"], dtype=np.float64)
+                Y_train = meg_data[session_id_model]["train"].reshape(len(X_train), -1).astype(np.float64)
+                X_mean, Y_mean = X_train.mean(axis=0), Y_train.mean(axis=0)
+                Y_train_centered = Y_train - Y_mean
+
+                left_singular_vectors, singular_values, rotation_t = np.linalg.svd(X_train - X_mean, full_matrices=False)
+                valid_components = singular_values > tol
+                left_singular_vectors, singular_values, rotation_t = left_singular_vectors[:, valid_components], singular_values[valid_components], rotation_t[valid_components]
+                singular_values_squared = singular_values**2
+
+                selected_alphas = None if self.fractional_ridge else self.get_stored_GLM_alphas(normalization=normalization, session_id_num=session_id_model, n_timepoints=n_timepoints)
+                if selected_alphas is not None:
+                    alpha_sources.append("GLM_models")
+                else:
+                    # GCV alpha selection per timepoint on the unpermuted labels
+                    alpha_sources.append("gcv")
+                    rotated_targets = left_singular_vectors.T @ Y_train_centered
+                    sum_squares_train = np.sum(Y_train_centered**2, axis=0)
+                    gcv_scores = np.zeros((len(self.alphas), n_timepoints))
+                    for alpha_idx, alpha in enumerate(self.alphas):
+                        hat_eigenvalues = singular_values_squared / (singular_values_squared + alpha)
+                        residual_sum_squares = sum_squares_train - np.sum(rotated_targets**2 * (2*hat_eigenvalues - hat_eigenvalues**2)[:, np.newaxis], axis=0)
+                        gcv_scores[alpha_idx] = (residual_sum_squares / (len(X_train) - np.sum(hat_eigenvalues))**2).reshape(n_sensors, n_timepoints).sum(axis=0)
+                    selected_alphas = np.asarray(self.alphas, dtype=np.float64)[np.argmin(gcv_scores, axis=0)]
+                selected_alphas_by_session[model_idx] = selected_alphas
+                # Coefficients in the rotated basis are scaling * (U.T @ Y_centered)
+                scaling = singular_values[:, np.newaxis] / (singular_values_squared[:, np.newaxis] + selected_alphas[target_timepoints])
+
+                # Observed fit measures of the unpermuted model on all sessions
+                rotated_coef = scaling * (left_singular_vectors.T @ Y_train_centered)
+                for pred_idx, session_id_pred in enumerate(self.session_ids_num):
+                    predictions = ((np.asarray(ann_features[session_id_pred]["test"], dtype=np.float64) - X_mean) @ rotation_t.T) @ rotated_coef + Y_mean
+                    var_explained, r_pearson = self.calculate_fit_measures_by_sensor_timepoint(Y_true=Y_test[session_id_pred][:, np.newaxis], Y_pred=predictions[:, np.newaxis])
+                    if pred_idx == model_idx:
+                        observed_var_explained[model_idx], observed_pearson_r[model_idx] = var_explained[0], r_pearson[0]
+                    else:
+                        pair_var_explained[session_pairs.index((model_idx, pred_idx))] = var_explained[0]
+
+                # Self-prediction null of this session, only kept until its p-values and quantiles are computed
+                X_test_rotated = (np.asarray(ann_features[session_id_model]["test"], dtype=np.float64) - X_mean) @ rotation_t.T
+                null_var_explained = np.zeros((n_permutations, n_sensors * n_timepoints), dtype=np.float32)
+                null_pearson_r = np.zeros((n_permutations, n_sensors * n_timepoints), dtype=np.float32)
+                for batch_start in range(0, n_permutations, permutation_batch_size):
+                    batch_permutations = [rng.permutation(len(X_train)) for _ in range(min(permutation_batch_size, n_permutations - batch_start))]
+                    rotated_coef = np.stack([scaling * (left_singular_vectors.T @ Y_train_centered[permutation]) for permutation in batch_permutations], axis=1)  # (components, batch, targets)
+                    predictions = np.einsum("nc,cbt->nbt", X_test_rotated, rotated_coef) + Y_mean
+                    var_explained, r_pearson = self.calculate_fit_measures_by_sensor_timepoint(Y_true=Y_test[session_id_model][:, np.newaxis], Y_pred=predictions)
+                    null_var_explained[batch_start:batch_start+len(batch_permutations)] = var_explained
+                    null_pearson_r[batch_start:batch_start+len(batch_permutations)] = r_pearson
+
+                # One-sided p-values (larger than chance)
+                p_values_var_explained[model_idx] = (1 + np.sum(null_var_explained >= observed_var_explained[model_idx], axis=0)) / (1 + n_permutations)
+                p_values_pearson_r[model_idx] = (1 + np.sum(null_pearson_r >= observed_pearson_r[model_idx], axis=0)) / (1 + n_permutations)
+                null_quantiles_var_explained[model_idx] = np.quantile(null_var_explained, null_quantile_levels, axis=0)
+                null_quantiles_pearson_r[model_idx] = np.quantile(null_pearson_r, null_quantile_levels, axis=0)
+
+                logger.custom_debug(f"[Session {session_id_model}] Permutations done, alphas ({alpha_sources[-1]}): {Counter(selected_alphas.tolist())}")
+
+            # Two-sided p-value of the drift slope over the date orderings (the observed ordering is part of them)
+            drift_slopes = drift_slope_weights @ pair_var_explained
+            observed_drift_slope = drift_slopes[0]
+            p_values_drift_slope = np.mean(np.abs(drift_slopes) >= np.abs(observed_drift_slope), axis=0)
+            null_quantiles_drift_slope = np.quantile(drift_slopes[1:], null_quantile_levels, axis=0)
+            logger.custom_info(f"Drift slope p < 0.05 for {np.sum(p_values_drift_slope < 0.05)} of {p_values_drift_slope.size} sensor/timepoint combinations ({len(date_permutations)} session date orderings).")
+
+            target_shape = (n_sensors, n_timepoints)
+            storage_folder = f"data_files/{self.lock_event}/permutation_test/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}"
+            os.makedirs(storage_folder, exist_ok=True)
+            storage_path = os.path.join(storage_folder, "permutation_test.npz")
+            results = {"session_ids": np.array(self.session_ids_num), "n_permutations": n_permutations, "n_date_orderings": len(date_permutations), "random_seed": random_seed,
+                       "selected_alphas": selected_alphas_by_session, "alpha_source": np.array(alpha_sources), "null_quantile_levels": np.array(null_quantile_levels),
+                       "observed_var_explained": observed_var_explained.reshape(n_sessions, *target_shape), "p_values_var_explained": p_values_var_explained.reshape(n_sessions, *target_shape),
+                       "null_quantiles_var_explained": null_quantiles_var_explained.reshape(n_sessions, len(null_quantile_levels), *target_shape),
+                       "observed_pearson_r": observed_pearson_r.reshape(n_sessions, *target_shape), "p_values_pearson_r": p_values_pearson_r.reshape(n_sessions, *target_shape),
+                       "null_quantiles_pearson_r": null_quantiles_pearson_r.reshape(n_sessions, len(null_quantile_levels), *target_shape),
+                       "observed_drift_slope": observed_drift_slope.reshape(target_shape), "p_values_drift_slope": p_values_drift_slope.reshape(target_shape),
+                       "null_quantiles_drift_slope": null_quantiles_drift_slope.reshape(len(null_quantile_levels), *target_shape)}
+            self.write_file_atomically(save_path=storage_path, write_file=lambda file: np.savez_compressed(file, **results))
+            logger.custom_debug(f"Storing permutation test results to {storage_path}")
+
+
+    def get_epoch_scene_ids(self, session_id_num:str) -> dict:
+        """
+        Returns the sceneID of every epoch in the train and test arrays of a session, in the order used by create_crop_dataset and create_meg_dataset.
+        """
+        combined_metadata = self.read_dict_from_json(type_of_content="combined_metadata")
+        trials_split_dict = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content="trial_splits")
+
+        epoch_scene_ids = {}
+        for split in ["train", "test"]:
+            epoch_scene_ids[split] = np.array([timepoint_metadata["sceneID"] for trial_id in trials_split_dict[split]
+                                                for timepoint_metadata in combined_metadata["sessions"][session_id_num]["trials"][trial_id]["timepoints"].values()])
+
+        return epoch_scene_ids
+
+
+    @StageMetrics.measure
+    def evaluate_cross_validated(self, n_folds:int = 5, random_seed:int = 0, downscale_features:bool = False):
+        """
+        K-fold cross-validated encoding, grouped by sceneID, as alternative to the single train/test split. Train and test epochs of each session are pooled and
+        the scenes are assigned to folds with a generator seeded by random_seed and the session id. Sufficient statistics are computed once per fold; the model of
+        fold k is solved from the sum of the other folds (alpha per timepoint by GCV, see solve_ridge_from_sufficient_statistics) and predicts fold k of every session.
+        Fold-averaged fit measures are stored in the result layout of predict_from_mapping (session, timepoint and timepoint_sensor level) under the fit_measure_variant
+        cv_{n_folds}, apart from the single split results. Visualization helpers created with fit_measure_variant=f"cv_{n_folds}" show them.
+        """
+        if self.fractional_ridge:
+            logger.warning("evaluate_cross_validated selects alphas from self.alphas, fractional_ridge is not applied.")
+
+        # Pool train and test epochs and assign scenes to folds
+        ann_features = {}
+        epoch_folds = {}
+        for session_id_num in self.session_ids_num:
+            session_ann_features = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content=self.ann_features_type, ann_model=self.ann_model, module=self.module_name)
+            ann_features[session_id_num] = np.concatenate([session_ann_features["train"], session_ann_features["test"]])
+            if downscale_features:
+                ann_features[session_id_num] = self.normalize_array(data=ann_features[session_id_num], normalization="range_-1_to_1")
+
+            epoch_scene_ids = self.get_epoch_scene_ids(session_id_num=session_id_num)
+            epoch_scene_ids = np.concatenate([epoch_scene_ids["train"], epoch_scene_ids["test"]])
+            assert len(epoch_scene_ids) == len(ann_features[session_id_num]), f"[Session {session_id_num}] Number of epochs in metadata and features is not identical."
+            unique_scene_ids = np.unique(epoch_scene_ids)
+            if len(unique_scene_ids) < n_folds:
+                raise ValueError(f"[Session {session_id_num}] Only {len(unique_scene_ids)} scenes for {n_folds} folds.")
+            session_rng = np.random.default_rng([random_seed, int(session_id_num)])
+            scene_folds = dict(zip(session_rng.permutation(unique_scene_ids), np.arange(len(unique_scene_ids)) % n_folds))
+            epoch_folds[session_id_num] = np.array([scene_folds[scene_id] for scene_id in epoch_scene_ids])
+
+        for normalization in self.normalizations:
+            logger.custom_info(f"{n_folds}-fold cross-validated encoding for normalization {normalization}")
+            meg_data = {}
+            fold_statistics = {}
+            for session_id_num in self.session_ids_num:
+                session_meg_data = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content="meg_data", type_of_norm=normalization)
+                meg_data[session_id_num] = np.concatenate([session_meg_data["train"], session_meg_data["test"]])
+                fold_statistics[session_id_num] = [self.calculate_sufficient_statistics(X=ann_features[session_id_num][epoch_folds[session_id_num] == fold], Y=meg_data[session_id_num][epoch_folds[session_id_num] == fold]) for fold in range(n_folds)]
+
+            n_sensors, n_timepoints = meg_data[self.session_ids_num[0]].shape[1:]
+            fit_measure_sums = {measure: defaultdict(lambda: defaultdict(float)) for measure in ["mse", "var_explained", "pearson_r"]}
+            fit_measure_sums_by_timepoint = {measure: defaultdict(lambda: defaultdict(lambda: np.zeros((n_sensors, n_timepoints)))) for measure in ["var_explained", "pearson_r"]}
+            for session_id_model in self.session_ids_num:
+                for fold in range(n_folds):
+                    ridge_model = self.solve_ridge_from_sufficient_statistics(self.combine_sufficient_statistics([statistics for statistics_fold, statistics in enumerate(fold_statistics[session_id_model]) if statistics_fold != fold]))
+                    for session_id_pred in self.session_ids_num:
+                        fold_mask = epoch_folds[session_id_pred] == fold
+                        Y_test = meg_data[session_id_pred][fold_mask]
+                        predictions = ridge_model.predict(ann_features[session_id_pred][fold_mask])
+
+                        fit_measure_sums["mse"][session_id_model][session_id_pred] += mean_squared_error(Y_test.reshape(-1), predictions.reshape(-1)) / n_folds
+                        fit_measure_sums["var_explained"][session_id_model][session_id_pred] += r2_score(Y_test.reshape(-1), predictions.reshape(-1)) / n_folds
+                        fit_measure_sums["pearson_r"][session_id_model][session_id_pred] += pearsonr(Y_test.reshape(-1), predictions.reshape(-1))[0] / n_folds
+                        var_explained, r_pearson = self.calculate_fit_measures_by_sensor_timepoint(Y_true=Y_test, Y_pred=predictions)
+                        fit_measure_sums_by_timepoint["var_explained"][session_id_model][session_id_pred] += var_explained / n_folds
+                        fit_measure_sums_by_timepoint["pearson_r"][session_id_model][session_id_pred] += r_pearson / n_folds
+                logger.custom_debug(f"[Session {session_id_model}] Cross-validated self-prediction variance explained: {fit_measure_sums['var_explained'][session_id_model][session_id_model]}")
+
+            # Convert to the dict layouts of predict_from_mapping
+            mse_session_losses = self.recursive_defaultdict()
+            variance_explained_dict = self.recursive_defaultdict()
+            variance_explained_timepoint_dict = self.recursive_defaultdict()
+            correlation_timepoint_dict = self.recursive_defaultdict()
+            variance_explained_sensor_timepoint_dict = self.recursive_defaultdict()
+            for session_id_model in self.session_ids_num:
+                for session_id_pred in self.session_ids_num:
+                    mse_session_losses["session_mapping"][session_id_model]["session_pred"][session_id_pred] = float(fit_measure_sums["mse"][session_id_model][session_id_pred])
+                    variance_explained_dict["session_mapping"][session_id_model]["session_pred"][session_id_pred] = float(fit_measure_sums["var_explained"][session_id_model][session_id_pred])
+                    var_explained = fit_measure_sums_by_timepoint["var_explained"][session_id_model][session_id_pred]
+                    r_pearson = fit_measure_sums_by_timepoint["pearson_r"][session_id_model][session_id_pred]
+                    for t in range(n_timepoints):
+                        variance_explained_timepoint_dict["session_mapping"][session_id_model]["session_pred"][session_id_pred]["timepoint"][str(t)] = float(np.mean(var_explained[:, t]))
+                        correlation_timepoint_dict["session_mapping"][session_id_model]["session_pred"][session_id_pred]["timepoint"][str(t)] = float(np.mean(r_pearson[:, t]))
+                        for sensor_idx in range(n_sensors):
+                            variance_explained_sensor_timepoint_dict["sensor"][str(sensor_idx)]["session_mapping"][session_id_model]["session_pred"][session_id_pred]["timepoint"][str(t)] = float(var_explained[sensor_idx, t])
+
+            fit_measure_variant, self.fit_measure_variant = self.fit_measure_variant, f"cv_{n_folds}"
+            try:
+                self.save_dict_as_json(type_of_content="mse_losses", dict_to_store=mse_session_losses, type_of_norm=normalization)
+                self.save_dict_as_json(type_of_content="var_explained", dict_to_store=variance_explained_dict, type_of_norm=normalization, predict_train_data=False)
+                storage_dicts_by_folders = {"var_explained_timepoints": variance_explained_timepoint_dict, "pearson_r_timepoints": correlation_timepoint_dict, "var_explained_sensors_timepoints": variance_explained_sensor_timepoint_dict}
+                for main_folder, fit_measure_dict in storage_dicts_by_folders.items():
+                    storage_folder = f"{self.get_fit_measure_subject_folder(main_folder)}/norm_{normalization}/"
+                    os.makedirs(storage_folder, exist_ok=True)
+                    json_storage_path = os.path.join(storage_folder, f"{main_folder}_dict.json")
+                    with open(json_storage_path, 'w') as file:
+                        logger.custom_debug(f"Storing cross-validated {main_folder} dict to {json_storage_path}")
+                        json.dump(fit_measure_dict, file, indent=4)
+            finally:
+                self.fit_measure_variant = fit_measure_variant
+
+            self_pred_var_explained = {session_id_num: variance_explained_dict["session_mapping"][session_id_num]["session_pred"][session_id_num] for session_id_num in self.session_ids_num}
+            logger.custom_info(f"Cross-validated self-prediction variance explained: {self_pred_var_explained}")
+
+
+    @StageMetrics.measure
+    def calculate_temporal_generalization(self, downscale_features:bool=False):
+        """
+        Temporal generalization: applies the model of every train timepoint t to every target timepoint t', within and across sessions.
+        Predictions of all timepoint models come from one tensor contraction over the stacked coefficients, fit measures for all (t, t') from
+        epoch-summed cross products. Stores variance explained and pearson r (averaged over sensors) as (session_model, session_pred, t, t') arrays.
+        """
+        for normalization in self.normalizations:
+            logger.custom_info(f"Temporal generalization for normalization {normalization}")
+            ridge_models = {session_id_model: self.load_GLM_models(storage_folder=self.get_GLM_model_folder(normalization=normalization, session_id_num=session_id_model)) for session_id_model in self.session_ids_num}
+
+            n_sessions = len(self.session_ids_num)
+            var_explained_matrices = None
+            pearson_r_matrices = None
+            for pred_idx, session_id_pred in enumerate(self.session_ids_num):
+                X_test = self.load_split_data_from_file(session_id_num=session_id_pred, type_of_content=self.ann_features_type, ann_model=self.ann_model, module=self.module_name)["test"]
+                Y_test = self.load_split_data_from_file(session_id_num=session_id_pred, type_of_content="meg_data", type_of_norm=normalization)["test"].astype(np.float64)
+                if downscale_features:
+                    X_test = self.normalize_array(data=X_test, normalization="range_-1_to_1")
+                n_epochs, n_sensors, n_timepoints = Y_test.shape
+
+                Y_test_centered = Y_test - Y_test.mean(axis=0)
+                sum_squares_total = np.sum(Y_test_centered**2, axis=0)  # (sensors, t')
+
+                if var_explained_matrices is None:
+                    var_explained_matrices = np.zeros((n_sessions, n_sessions, n_timepoints, n_timepoints))
+                    pearson_r_matrices = np.zeros((n_sessions, n_sessions, n_timepoints, n_timepoints))
+
+                for model_idx, session_id_model in enumerate(self.session_ids_num):
+                    ridge_model = ridge_models[session_id_model]
+                    # Predictions of every train timepoint model: (epochs, sensors, t)
+                    predictions = np.einsum("nf,tsf->nst", X_test, ridge_model.coef_) + ridge_model.intercept_.T[np.newaxis]
+                    predictions_centered = predictions - predictions.mean(axis=0)
+
+                    # sum over epochs of (y_t' - prediction_t)^2 = sum y_t'^2 - 2 sum y_t' prediction_t + sum prediction_t^2, for all (t, t')
+                    cross_products = np.einsum("nst,nsu->stu", predictions, Y_test)
+                    sum_squares_residual = np.sum(Y_test**2, axis=0)[:, np.newaxis, :] - 2 * cross_products + np.sum(predictions**2, axis=0)[:, :, np.newaxis]
+                    centered_cross_products = np.einsum("nst,nsu->stu", predictions_centered, Y_test_centered)
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        var_explained = 1 - sum_squares_residual / sum_squares_total[:, np.newaxis, :]
+                        r_pearson = centered_cross_products / np.sqrt(np.sum(predictions_centered**2, axis=0)[:, :, np.newaxis] * sum_squares_total[:, np.newaxis, :])
+
+                    var_explained_matrices[model_idx, pred_idx] = np.mean(var_explained, axis=0)
+                    pearson_r_matrices[model_idx, pred_idx] = np.mean(r_pearson, axis=0)
+
+            storage_folder = f"data_files/{self.lock_event}/temporal_generalization/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}"
+            os.makedirs(storage_folder, exist_ok=True)
+            storage_path = os.path.join(storage_folder, "temporal_generalization.npz")
+            np.savez(storage_path, session_ids=np.array(self.session_ids_num), var_explained=var_explained_matrices, pearson_r=pearson_r_matrices)
+            logger.custom_debug(f"Storing temporal generalization matrices to {storage_path}")
+
+
+    @StageMetrics.measure
+    def evaluate_pca_component_sweep(self, component_counts:list, shuffle_train_labels:bool=False):
+        """
+        Evaluates self-prediction performance for several numbers of pca components without rerunning pca, training and prediction for each value.
+        Uses the nested projection from ExtractionHelper.create_pca_sweep_features: features for k components are the first k columns, so all
+        component counts are fit from one X.T @ X and X.T @ Y (see predict_nested_component_counts), with one alpha (or fraction) selected per timepoint.
+        Stores a components x timepoints table (variance explained and pearson r, averaged over sensors) per session.
+        """
+        component_counts = sorted(component_counts)
+        for normalization in self.normalizations:
+            logger.custom_info(f"PCA component sweep for normalization {normalization}")
+            best_components_by_session = {}
+            for session_id_num in self.session_ids_num:
+                ann_features = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content="ann_features_pca_sweep", ann_model=self.ann_model, module=self.module_name)
+                meg_data = self.load_split_data_from_file(session_id_num=session_id_num, type_of_content="meg_data", type_of_norm=normalization)
+
+                X_train, X_test = ann_features["train"], ann_features["test"]
+                Y_train, Y_test = meg_data["train"], meg_data["test"]
+                if shuffle_train_labels:
+                    Y_train = np.random.permutation(Y_train)
+
+                n_sensors, n_timepoints = Y_train.shape[1:]
+                max_components_available = X_train.shape[1]
+                session_component_counts = [n_components for n_components in component_counts if n_components <= max_components_available]
+                if len(session_component_counts) < len(component_counts):
+                    logger.warning(f"[Session {session_id_num}]: Sweep features only contain {max_components_available} components, skipping larger component counts.")
+
+                var_explained_table = np.zeros((len(session_component_counts), n_timepoints))
+                pearson_r_table = np.zeros((len(session_component_counts), n_timepoints))
+                nested_predictions = self.predict_nested_component_counts(X_train=X_train, Y_train=Y_train.reshape(len(Y_train), -1), X_test=X_test, component_counts=session_component_counts, n_timepoints=n_timepoints)
+                for component_idx, (n_components, predictions, selected_regularization) in enumerate(nested_predictions):
+                    logger.custom_debug(f"[Session {session_id_num}]: {n_components} components, selected {'fractions' if self.fractional_ridge else 'alphas'}: {Counter(selected_regularization.tolist())}")
+                    predictions = predictions.reshape(len(X_test), n_sensors, n_timepoints)
+
+                    var_explained, r_pearson = self.calculate_fit_measures_by_sensor_timepoint(Y_true=Y_test, Y_pred=predictions)
+                    var_explained_table[component_idx] = np.mean(var_explained, axis=0)
+                    pearson_r_table[component_idx] = np.mean(r_pearson, axis=0)
+
+                best_component_idx = int(np.argmax(np.mean(var_explained_table, axis=1)))
+                best_components_by_session[session_id_num] = session_component_counts[best_component_idx]
+                logger.custom_debug(f"[Session {session_id_num}]: Mean variance explained by number of components: {dict(zip(session_component_counts, np.mean(var_explained_table, axis=1)))}")
+
+                storage_folder = f"data_files/{self.lock_event}/pca_component_sweep/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}/session_{session_id_num}"
+                os.makedirs(storage_folder, exist_ok=True)
+                storage_path = os.path.join(storage_folder, "pca_component_sweep.npz")
+                np.savez(storage_path, component_counts=np.array(session_component_counts), timepoints=np.arange(n_timepoints), var_explained=var_explained_table, pearson_r=pearson_r_table)
+                logger.custom_debug(f"Storing pca component sweep table to {storage_path}")
+
+            logger.custom_info(f"Best number of pca components by session (mean variance explained over timepoints): {best_components_by_session}")
+
+
+    def predict_nested_component_counts(self, X_train:np.ndarray, Y_train:np.ndarray, X_test:np.ndarray, component_counts:list, n_timepoints:int, tol:float = 1e-10):
+        """
+        Ridge predictions of X_test for nested feature sets (the first k columns, for every k in component_counts), derived from X.T @ X and X.T @ Y computed once.
+        For uncorrelated train columns (e.g. pca scores of the train data) the solutions of all k and alphas follow from the column norms, otherwise the k x k slice of X.T @ X is eigendecomposed.
+        One alpha per timepoint (with fractional_ridge one fraction of self.fractional_grid, without intercept like FracRidgeRegressorCV) is selected by GCV summed over sensors.
+        Y_train has shape (epochs, sensors x timepoints). Yields (k, predictions (epochs, sensors x timepoints), selected alphas or fractions (timepoints)) per component count.
+        """
+        X_train = np.asarray(X_train, dtype=np.float64)
+        X_test = np.asarray(X_test, dtype=np.float64)
+        Y_train = np.asarray(Y_train, dtype=np.float64)
+        n_targets = Y_train.shape[1]
+        n_sensors = n_targets // n_timepoints
+        target_timepoints = np.tile(np.arange(n_timepoints), n_sensors)
+
+        fit_intercept = not self.fractional_ridge
+        X_mean = X_train.mean(axis=0) if fit_intercept else np.zeros(X_train.shape[1])
+        Y_mean = Y_train.mean(axis=0) if fit_intercept else np.zeros(n_targets)
+        X_train_centered = X_train - X_mean
+        Y_train_centered = Y_train - Y_mean
+        X_test_centered = X_test - X_mean
+
+        gram = X_train_centered.T @ X_train_centered
+        cross_products = X_train_centered.T @ Y_train_centered
+        sum_squares_train = np.sum(Y_train_centered**2, axis=0)
+        column_norms_squared = np.diag(gram).copy()
+        uncorrelated_columns = np.max(np.abs(gram - np.diag(column_norms_squared))) <= 1e-8 * column_norms_squared.max()
+        logger.custom_debug(f"Nested component sweep with {'column norms' if uncorrelated_columns else 'eigendecomposition per component count'} of X.T @ X")
+
+        regularization_candidates = np.asarray(self.fractional_grid if self.fractional_ridge else self.alphas, dtype=np.float64)
+        for n_components in component_counts:
+            if uncorrelated_columns:
+                singular_values_squared = column_norms_squared[:n_components]
+                rotated_cross_products = cross_products[:n_components]
+                X_test_rotated = X_test_centered[:, :n_components]
+            else:
+                eigenvalues, rotation = np.linalg.eigh(gram[:n_components, :n_components])
+                singular_values_squared = np.clip(eigenvalues, 0, None)
+                rotated_cross_products = rotation.T @ cross_products[:n_components]
+                X_test_rotated = X_test_centered[:, :n_components] @ rotation
+            valid_components = singular_values_squared > tol * singular_values_squared.max()
+            singular_values_squared, rotated_cross_products, X_test_rotated = singular_values_squared[valid_components], rotated_cross_products[valid_components], X_test_rotated[:, valid_components]
+            # U.T @ Y_centered of the svd X_centered = U S V.T
+            rotated_targets = rotated_cross_products / np.sqrt(singular_values_squared)[:, np.newaxis]
+
+            # Alphas of every candidate (rows) for every target
+            if self.fractional_ridge:
+                ols_rotated = rotated_targets / np.sqrt(singular_values_squared)[:, np.newaxis]
+                candidate_alphas = self.calculate_fractional_ridge_alphas(singular_values_squared=singular_values_squared, ols_rotated=ols_rotated, fractions=regularization_candidates, valid_components=np.ones(len(singular_values_squared), dtype=bool))
+            else:
+                candidate_alphas = np.repeat(regularization_candidates[:, np.newaxis], n_targets, axis=1)
+
+            gcv_scores = np.zeros((len(candidate_alphas), n_timepoints))
+            for candidate_idx, target_alphas in enumerate(candidate_alphas):
+                hat_eigenvalues = singular_values_squared[:, np.newaxis] / (singular_values_squared[:, np.newaxis] + target_alphas)
+                residual_sum_squares = sum_squares_train - np.sum(rotated_targets**2 * (2*hat_eigenvalues - hat_eigenvalues**2), axis=0)
+                degrees_of_freedom = len(X_train) - fit_intercept - np.sum(hat_eigenvalues, axis=0)
+                gcv_scores[candidate_idx] = (residual_sum_squares / degrees_of_freedom**2).reshape(n_sensors, n_timepoints).sum(axis=0)
+            selected_candidates = np.argmin(gcv_scores, axis=0)
+
+            selected_alphas = candidate_alphas[selected_candidates[target_timepoints], np.arange(n_targets)]
+            predictions = X_test_rotated @ (rotated_cross_products / (singular_values_squared[:, np.newaxis] + selected_alphas)) + Y_mean
+
+            yield n_components, predictions, regularization_candidates[selected_candidates]
+
+
     class MultiDimensionalRegression:
         """
         Inner class to apply (fractional) Ridge Regression over all timepoints. Enables training and prediction, as well as initialization of random weights for baseline comparison.
+        After fitting (or loading), the per-timepoint models are kept as stacked arrays coef_ (timepoints, sensors, features) and intercept_ (timepoints, sensors), which are used for vectorized prediction.
         """
-        def __init__(self, GLM_helper_instance, models:list=[], random_weights:bool=False):
+        def __init__(self, GLM_helper_instance, models:list=[], random_weights:bool=False, coef:np.ndarray=None, intercept:np.ndarray=None, regularization:np.ndarray=None):
             self.GLM_helper_instance = GLM_helper_instance
             self.random_weights = random_weights
             self.models = models  # Standardly initialized as empty list, otherwise with passed, previously trained models
             self.alphas = self.GLM_helper_instance.alphas
             self.selected_alphas = None
+            self.coef_ = coef
+            self.intercept_ = intercept
+            self.regularization_ = regularization  # Selected alpha (or fraction) per timepoint
 
         def fit(self, X=None, Y=None):
             n_features = X.shape[1]
@@ -1699,21 +3703,32 @@ class GLMHelper(DatasetHelper, ExtractionHelper):
                 self.models = [RidgeCV(alphas=self.GLM_helper_instance.alphas) for _ in range(n_timepoints)]
             
             logger.custom_debug(f"Fit model with alphas {self.GLM_helper_instance.alphas}")
+            if self.GLM_helper_instance.fractional_ridge and self.GLM_helper_instance.batched_fractional_ridge and not self.random_weights:
+                self.fit_batched(X, Y)
+                return
+
+            use_dual_form = self.GLM_helper_instance.ridge_form == "dual" or (self.GLM_helper_instance.ridge_form == "auto" and n_features > X.shape[0])
+            if use_dual_form and not self.GLM_helper_instance.fractional_ridge and not self.random_weights:
+                self.fit_dual(X, Y)
+                return
+
             if self.random_weights:
                 # Randomly initialize weights and intercepts
                 # Careful, in the current implementation the random model does not use an alpha
                 for model in self.models:
                     model.coef_ = np.random.rand(n_sensors, n_features) - 0.5  # Random weights centered around 0
                     model.intercept_ = np.random.rand(n_sensors) - 0.5  # Random intercepts centered around 0
-            else:
-                for t in range(n_timepoints):
-                    Y_t = Y[:, :, t]
-                    if self.GLM_helper_instance.fractional_ridge:
-                        self.models[t].fit(X, Y_t, frac_grid=self.GLM_helper_instance.fractional_grid)
-                        if self.models[t].best_frac_ <= 0.000_000_000_000_000_1:  # log if smallest fraction has been chosen
-                            logger.custom_debug(f"\n Timepoint {self.GLM_helper_instance.timepoint_min+t}: frac = {self.models[t].best_frac_}, alpha = {self.models[t].alpha_}") 
-                    else:
-                        self.models[t].fit(X, Y_t)
+                self.stack_models()
+                return
+
+            for t in range(n_timepoints):
+                Y_t = Y[:, :, t]
+                if self.GLM_helper_instance.fractional_ridge:
+                    self.models[t].fit(X, Y_t, frac_grid=self.GLM_helper_instance.fractional_grid)
+                    if self.models[t].best_frac_ <= 0.000_000_000_000_000_1:  # log if smallest fraction has been chosen
+                        logger.custom_debug(f"\n Timepoint {self.GLM_helper_instance.timepoint_min+t}: frac = {self.models[t].best_frac_}, alpha = {self.models[t].alpha_}") 
+                else:
+                    self.models[t].fit(X, Y_t)
 
             # Debugging: For each model (aka for each timepoint) store the alpha/fraction that was selected as best fit in RidgeCV/FracRidgeRegressorCV
             if not self.GLM_helper_instance.fractional_ridge:
@@ -1723,34 +3738,76 @@ class GLMHelper(DatasetHelper, ExtractionHelper):
             else:
                 selected_regularize_param = [timepoint_model.best_frac_ for timepoint_model in self.models]
                 param_type = "fractions"
+            self.regularization_ = np.array(selected_regularize_param, dtype=float)
 
             counts_regularize_params = Counter(selected_regularize_param)
             sorted_counts_regularize_params = sorted(counts_regularize_params.items(), key=lambda x: x[1], reverse=True)
             logger.custom_debug(f"selected {param_type}: {sorted_counts_regularize_params}")
 
+            self.stack_models()
+
+
+        def fit_batched(self, X, Y):
+            """
+            Fits fractional ridge for all sensors and timepoints as targets of one regression, with the best fraction selected per sensor and timepoint.
+            Only the stacked arrays are set (no per-timepoint FracRidgeRegressorCV objects), regularization_ holds the fractions (timepoints, sensors).
+            """
+            n_epochs, n_sensors, n_timepoints = Y.shape
+            coef, selected_fractions = self.GLM_helper_instance.fit_batched_fractional_ridge(X, Y.reshape(n_epochs, -1), fractions=self.GLM_helper_instance.fractional_grid)
+
+            self.models = []
+            self.coef_ = coef.reshape(-1, n_sensors, n_timepoints).transpose(2, 1, 0)
+            self.intercept_ = np.zeros((n_timepoints, n_sensors))
+            self.regularization_ = selected_fractions.reshape(n_sensors, n_timepoints).T
+
+            counts_fractions = Counter(selected_fractions.tolist())
+            logger.custom_debug(f"selected fractions: {sorted(counts_fractions.items(), key=lambda x: x[1], reverse=True)}")
+
+
+        def fit_dual(self, X, Y):
+            """
+            Fits ridge for all timepoints in sample space (see GLMHelper.fit_dual_ridge), which is cheaper than per-timepoint RidgeCV when there are more features than samples.
+            Only the stacked arrays are set, regularization_ holds the alpha selected per timepoint.
+            """
+            n_epochs, n_sensors, n_timepoints = Y.shape
+            logger.custom_debug(f"Fitting ridge in dual form ({X.shape[1]} features, {n_epochs} samples)")
+            coef, intercept, selected_alphas = self.GLM_helper_instance.fit_dual_ridge(X, Y.reshape(n_epochs, -1), n_timepoints=n_timepoints)
+
+            self.models = []
+            self.coef_ = coef.reshape(-1, n_sensors, n_timepoints).transpose(2, 1, 0)
+            self.intercept_ = intercept.reshape(n_sensors, n_timepoints).T
+            self.regularization_ = selected_alphas
+            self.selected_alphas = selected_alphas.tolist()
+
+            counts_alphas = Counter(self.selected_alphas)
+            logger.custom_debug(f"selected alphas: {sorted(counts_alphas.items(), key=lambda x: x[1], reverse=True)}")
+
+
+        def stack_models(self):
+            """
+            Stacks coefficients and intercepts of the per-timepoint models into coef_ (timepoints, sensors, features) and intercept_ (timepoints, sensors).
+            """
+            coefs = []
+            intercepts = []
+            for model in self.models:
+                # FracRidgeRegressorCV stores coefficients as (features, sensors), sklearn as (sensors, features)
+                model_coef = model.coef_.T if (self.GLM_helper_instance.fractional_ridge and not self.random_weights) else model.coef_
+                coefs.append(model_coef)
+                intercepts.append(np.broadcast_to(getattr(model, "intercept_", 0.), (model_coef.shape[0],)))
+            self.coef_ = np.stack(coefs)
+            self.intercept_ = np.stack(intercepts)
 
 
         def predict(self, X, downscale_features:bool=False):
             if downscale_features:
                 X = self.GLM_helper_instance.normalize_array(data=X, normalization="range_-1_to_1")
 
-            n_samples = X.shape[0]
-            n_sensors = self.models[0].coef_.shape[0] if not self.GLM_helper_instance.fractional_ridge else self.models[0].coef_.shape[1]
-            n_timepoints = len(self.models)
-            predictions = np.zeros((n_samples, n_sensors, n_timepoints))
-
-            #logger.custom_info(f"X.shape: {X.shape}")
-            #logger.custom_info(f"n_sensors: {n_sensors}")
-            #logger.custom_info(f"n_timepoints: {n_timepoints}")
-            #logger.custom_info(f"predictions: {predictions.shape}")
-            #logger.custom_info(f"self.models[0].coef_.shape: {self.models[0].coef_.shape}")
-
-            for t, model in enumerate(self.models):
-                if self.random_weights:
-                    # Use the random weights and intercept to predict; we are missing configurations implicitly achieved when calling .fit()
-                    predictions[:, :, t] = X @ model.coef_.T + model.intercept_
-                else:
-                    predictions[:, :, t] = model.predict(X)
+            if self.coef_ is None:
+                self.stack_models()
+
+            # Apply all timepoint models at once: (samples, features) x (timepoints, sensors, features) -> (samples, sensors, timepoints)
+            predictions = np.tensordot(X, self.coef_, axes=([1], [2])).transpose(0, 2, 1) + self.intercept_.T[np.newaxis]
+
             return predictions    
     
 
@@ -1802,9 +3859,138 @@ class VisualizationHelper(GLMHelper):
         return x_values, y_values
 
     
-    def _plot_drift_distance_based(self, fit_measures_by_distances:dict, omitted_sessions:list, self_pred_normalized:bool, losses_averaged_within_distances:bool, all_windows_one_plot:bool, timepoint_window_start_idx:int = None, include_0_distance:bool = False):
+    @StageMetrics.measure
+    def bootstrap_drift_confidence_intervals(self, n_bootstrap:int = 2000, resample:str = "epochs", confidence_level:float = 0.95, omitted_sessions:list = [], subtract_self_pred:bool = False, include_0_distance:bool = False, random_seed:int = 0, bootstrap_batch_size:int = 100):
+        """
+        Bootstrap confidence intervals of the drift slope and drift correlation (variance explained of cross-session predictions over distance in days)
+        for every time window of time_window_n_indices and for all timepoints combined, averaged over sensors and per sensor. The stored GLM models are not refit.
+        resample options: "epochs" (test epochs of each predicted session are resampled, identically for all models predicting it; fit measures are recomputed from weighted sums)
+                          "session_pairs" (train/predicted session pairs are resampled with replacement)
+        With include_0_distance the self-predictions enter the regression at distance 0 (as in calculate_fit_by_distances).
+        Resampled fit measures are computed bootstrap_batch_size resamples at a time and only the regression sums of every resample are accumulated over session pairs.
+        """
+        if resample not in ["epochs", "session_pairs"]:
+            raise ValueError(f"bootstrap_drift_confidence_intervals called with unrecognized resample {resample}.")
+
+        rng = np.random.default_rng(random_seed)
+        session_ids = [session_id_num for session_id_num in self.session_ids_num if session_id_num not in omitted_sessions]
+        session_day_differences = self.get_session_date_differences()
+
+        # Averaging matrix from timepoints to full time windows (as in timepoint_window_drift), the last column averages all timepoints
+        n_timepoints = (self.timepoint_max - self.timepoint_min) + 1
+        window_starts = list(range(0, n_timepoints - self.time_window_n_indices + 1, self.time_window_n_indices))
+        window_weights = np.zeros((n_timepoints, len(window_starts) + 1))
+        for window_idx, window_start in enumerate(window_starts):
+            window_weights[window_start:window_start+self.time_window_n_indices, window_idx] = 1 / self.time_window_n_indices
+        window_weights[:, -1] = 1 / n_timepoints
+
+        session_pairs = [(session_id_model, session_id_pred) for session_id_model in session_ids for session_id_pred in session_ids if include_0_distance or session_id_model != session_id_pred]
+        distances = np.array([session_day_differences[session_id_model][session_id_pred] if session_id_model != session_id_pred else 0 for session_id_model, session_id_pred in session_pairs], dtype=np.float64)
+        n_pairs = len(session_pairs)
+
+        for normalization in self.normalizations:
+            logger.custom_info(f"Bootstrapping drift ({n_bootstrap} resamples of {resample}) for normalization {normalization}")
+            ridge_models = {session_id_model: self.load_GLM_models(storage_folder=self.get_GLM_model_folder(normalization=normalization, session_id_num=session_id_model)) for session_id_model in session_ids}
+
+            # Pair weights of every resample (resample 0 is the observed data)
+            if resample == "epochs":
+                pair_counts = np.ones((n_bootstrap + 1, n_pairs))
+            else:
+                pair_counts = np.vstack([np.ones(n_pairs), rng.multinomial(n_pairs, np.full(n_pairs, 1 / n_pairs), size=n_bootstrap)])
+
+            # Sums of the weighted linear regression of fit measures on distance per resample; sums of fit measures are (resamples, sensors + sensor average, windows)
+            n = pair_counts.sum(axis=1)[:, np.newaxis, np.newaxis]
+            sum_d = (pair_counts @ distances)[:, np.newaxis, np.newaxis]
+            sum_dd = (pair_counts @ distances**2)[:, np.newaxis, np.newaxis]
+            sum_y, sum_yy, sum_dy = None, None, None
+
+            for session_id_pred in session_ids:
+                X_test = self.load_split_data_from_file(session_id_num=session_id_pred, type_of_content=self.ann_features_type, ann_model=self.ann_model, module=self.module_name)["test"]
+                Y_test = self.load_split_data_from_file(session_id_num=session_id_pred, type_of_content="meg_data", type_of_norm=normalization)["test"]
+                n_epochs, n_sensors, _ = Y_test.shape
+                Y_test_flat = Y_test.reshape(n_epochs, -1).astype(np.float64)
+
+                if resample == "epochs":
+                    epoch_counts = np.vstack([np.ones(n_epochs), rng.multinomial(n_epochs, np.full(n_epochs, 1 / n_epochs), size=n_bootstrap)])
+                else:
+                    epoch_counts = np.ones((1, n_epochs))
+
+                def get_window_fit_measures(session_id_model):
+                    """
+                    Window variance explained (resamples, sensors, windows) of the predictions of session_id_model, in batches of resamples.
+                    """
+                    squared_residuals = (Y_test_flat - ridge_models[session_id_model].predict(X_test).reshape(n_epochs, -1))**2
+                    window_fit_measures = np.zeros((len(epoch_counts), n_sensors, len(window_starts) + 1))
+                    for batch_start in range(0, len(epoch_counts), bootstrap_batch_size):
+                        batch_counts = epoch_counts[batch_start:batch_start+bootstrap_batch_size]
+                        sum_squares_total = batch_counts @ Y_test_flat**2 - (batch_counts @ Y_test_flat)**2 / n_epochs
+                        var_explained = 1 - (batch_counts @ squared_residuals) / sum_squares_total
+                        window_fit_measures[batch_start:batch_start+len(batch_counts)] = var_explained.reshape(len(batch_counts), n_sensors, n_timepoints) @ window_weights
+                    return window_fit_measures
+
+                self_fit_measures = get_window_fit_measures(session_id_pred)
+                for pair_idx, (session_id_model, session_id_pair_pred) in enumerate(session_pairs):
+                    if session_id_pair_pred != session_id_pred:
+                        continue
+                    fit_measures = self_fit_measures if session_id_model == session_id_pred else get_window_fit_measures(session_id_model)
+                    if subtract_self_pred:
+                        # Normalize with the self-prediction of the predicted session (as normalize_cross_session_preds_with_self_preds)
+                        fit_measures = fit_measures - self_fit_measures
+                    # Append the sensor average as last sensor index
+                    fit_measures = np.concatenate([fit_measures, fit_measures.mean(axis=1, keepdims=True)], axis=1)
+
+                    pair_weights = pair_counts[:, pair_idx, np.newaxis, np.newaxis]
+                    if sum_y is None:
+                        sum_y, sum_yy, sum_dy = (np.zeros((n_bootstrap + 1,) + fit_measures.shape[1:]) for _ in range(3))
+                    sum_y += pair_weights * fit_measures
+                    sum_yy += pair_weights * fit_measures**2
+                    sum_dy += pair_weights * distances[pair_idx] * fit_measures
+
+            covariance = n * sum_dy - sum_d * sum_y
+            with np.errstate(divide="ignore", invalid="ignore"):
+                slopes = covariance / (n * sum_dd - sum_d**2)
+                intercepts = (sum_y - slopes * sum_d) / n
+                correlations = covariance / np.sqrt((n * sum_dd - sum_d**2) * (n * sum_yy - sum_y**2))
+
+            percentiles = [100 * (1 - confidence_level) / 2, 100 * (1 + confidence_level) / 2]
+            slope_ci = np.nanpercentile(slopes[1:], percentiles, axis=0)
+            correlation_ci = np.nanpercentile(correlations[1:], percentiles, axis=0)
+            logger.custom_info(f"Drift over all timepoints (sensor average): slope {slopes[0, -1, -1]:.5f} {confidence_level:.0%} CI [{slope_ci[0, -1, -1]:.5f}, {slope_ci[1, -1, -1]:.5f}], r {correlations[0, -1, -1]:.3f} CI [{correlation_ci[0, -1, -1]:.3f}, {correlation_ci[1, -1, -1]:.3f}]")
+
+            storage_folder = f"data_files/{self.lock_event}/drift_bootstrap/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}"
+            os.makedirs(storage_folder, exist_ok=True)
+            storage_path = os.path.join(storage_folder, f"drift_bootstrap_{resample}.npz")
+            # Axis 1 of all arrays: sensors (last index = sensor average), axis 2: window starts (999 = all timepoints)
+            np.savez(storage_path, window_starts=np.array(window_starts + [999]), confidence_level=confidence_level, omitted_sessions=np.array(omitted_sessions, dtype=str), subtract_self_pred=subtract_self_pred, include_0_distance=include_0_distance,
+                     observed_slopes=slopes[0], observed_intercepts=intercepts[0], observed_correlations=correlations[0],
+                     bootstrap_slopes=slopes[1:], bootstrap_intercepts=intercepts[1:], bootstrap_correlations=correlations[1:],
+                     slope_ci=slope_ci, correlation_ci=correlation_ci)
+            logger.custom_debug(f"Storing drift bootstrap to {storage_path}")
+
+
+    def load_drift_bootstrap_bands(self, normalization:str, resample:str, sensor_idx:int, omitted_sessions:list, subtract_self_pred:bool, include_0_distance:bool = False) -> dict:
+        """
+        Loads bootstrapped drift regressions for one sensor (-1: sensor average) as dict window_start -> {"slopes", "intercepts", "confidence_level"} for _plot_drift_distance_based.
+        Returns None if no bootstrap with matching omitted sessions, self-prediction normalization and 0-distance pairs exists.
+        """
+        storage_path = f"data_files/{self.lock_event}/drift_bootstrap/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}/drift_bootstrap_{resample}.npz"
+        if not os.path.exists(storage_path):
+            logger.warning(f"No drift bootstrap found at {storage_path}, plotting without confidence bands.")
+            return None
+        drift_bootstrap = np.load(storage_path)
+        bootstrap_include_0_distance = bool(drift_bootstrap["include_0_distance"]) if "include_0_distance" in drift_bootstrap.files else False
+        if sorted(drift_bootstrap["omitted_sessions"].tolist()) != sorted(omitted_sessions) or bool(drift_bootstrap["subtract_self_pred"]) != subtract_self_pred or bootstrap_include_0_distance != include_0_distance:
+            logger.warning(f"Drift bootstrap at {storage_path} was computed for different omitted sessions, self-prediction normalization or 0-distance pairs, plotting without confidence bands.")
+            return None
+
+        return {int(window_start): {"slopes": drift_bootstrap["bootstrap_slopes"][:, sensor_idx, window_idx], "intercepts": drift_bootstrap["bootstrap_intercepts"][:, sensor_idx, window_idx], "confidence_level": float(drift_bootstrap["confidence_level"])}
+                for window_idx, window_start in enumerate(drift_bootstrap["window_starts"])}
+
+
+    def _plot_drift_distance_based(self, fit_measures_by_distances:dict, omitted_sessions:list, self_pred_normalized:bool, losses_averaged_within_distances:bool, all_windows_one_plot:bool, timepoint_window_start_idx:int = None, include_0_distance:bool = False, drift_bootstrap:dict = None):
         """
         Creates drift plot based on fit measures data by distance. Expects keys of distance in days as string number, each key containing keys "fit_measure" and "num_measures"
+        If drift_bootstrap is given (see load_drift_bootstrap_bands), confidence bands of the trend line are drawn for the plotted windows.
         """
         # Plot loss as a function of distance of predicted session from "training" session
         fig, ax1 = plt.subplots(figsize=(12, 8))
@@ -1847,6 +4033,14 @@ class VisualizationHelper(GLMHelper):
             trend_color = color if not isinstance(color,str) else 'green'  # If only a single window is plotted, we want different colors for scatter points and trend. If all windows are plotted this gets too confusing. In this 'color' will be an array
             ax1.plot(filtered_x_values_set, trend_line, color=trend_color, linestyle='-', linewidth=3)
 
+            if drift_bootstrap is not None and timepoint_window_start_idx in drift_bootstrap:
+                window_bootstrap = drift_bootstrap[timepoint_window_start_idx]
+                x_band = np.sort(filtered_x_values_set)
+                bootstrap_trend_lines = window_bootstrap["slopes"][:, np.newaxis] * x_band + window_bootstrap["intercepts"][:, np.newaxis]
+                confidence_level = window_bootstrap["confidence_level"]
+                band_lower, band_upper = np.nanpercentile(bootstrap_trend_lines, [100 * (1 - confidence_level) / 2, 100 * (1 + confidence_level) / 2], axis=0)
+                ax1.fill_between(x_band, band_lower, band_upper, color=trend_color, alpha=0.2, linewidth=0)
+
         # Insert scatter values based on distance into plot
         if not all_windows_one_plot:
             plot_scattered_fit_measures_by_distance_with_trend(fit_measures_by_distances, ax1, color='C0', timepoint_window_start_idx=timepoint_window_start_idx)  # using default blue color
@@ -1887,6 +4081,7 @@ class VisualizationHelper(GLMHelper):
         # plt.show required?
         return fig
 
+    @StageMetrics.measure
     def visualize_self_prediction(self, var_explained:bool=True, pred_splits:list=["train","test"], all_sessions_combined:bool=False, plot_outliers:bool=False):
         if var_explained:
             type_of_fit_measure = "Variance Explained"
@@ -1989,6 +4184,7 @@ class VisualizationHelper(GLMHelper):
                 self.save_plot_as_file(plt=plt, plot_folder=plot_folder, plot_file=plot_file)
                 
 
+    @StageMetrics.measure
     def visualize_GLM_results(self, fit_measure_type:str, by_timepoints:bool = False, only_distance:bool = False, omit_sessions:list = [], separate_plots:bool = False, distance_in_days:bool = True, average_distance_vals:bool = False):
         """
         Visualizes results from GLMHelper.predict_from_mapping
@@ -2268,6 +4464,7 @@ class VisualizationHelper(GLMHelper):
 
                 fit_measures_new[norm] = fit_measure
 
+    @StageMetrics.measure
     def three_dim_timepoint_predictions(self, subtract_self_pred:bool):
         """
         Creates a 3D plot. Every singular position on the third axis is similar to the 'by_timepoints' plot in visualize_GLM_results.
@@ -2350,7 +4547,7 @@ class VisualizationHelper(GLMHelper):
             return fig
 
         for normalization in self.normalizations:
-            storage_folder = f"data_files/{self.lock_event}/var_explained_timepoints/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}/"
+            storage_folder = f"{self.get_fit_measure_subject_folder('var_explained_timepoints')}/norm_{normalization}/"
             json_storage_file = f"var_explained_timepoints_dict.json"
             json_storage_path = os.path.join(storage_folder, json_storage_file)
             with open(json_storage_path, 'r') as file:
@@ -2386,7 +4583,11 @@ class VisualizationHelper(GLMHelper):
                 #    pickle.dump(timepoints_sessions_plot, file)
 
 
-    def timepoint_window_drift(self, omitted_sessions:list, all_windows_one_plot:bool, subtract_self_pred:bool, sensor_level:bool, include_0_distance:bool, debugging=False):
+    @StageMetrics.measure
+    def timepoint_window_drift(self, omitted_sessions:list, all_windows_one_plot:bool, subtract_self_pred:bool, sensor_level:bool, include_0_distance:bool, debugging=False, bootstrap_resample:str = None):
+        """
+        Plots drift for time windows of time_window_n_indices. If bootstrap_resample ("epochs" or "session_pairs") is given, confidence bands from bootstrap_drift_confidence_intervals are drawn.
+        """
 
         def filter_timepoint_dict_for_window(fit_measures_by_session_by_timepoint: dict, timepoint_window_start_idx:int):
             """
@@ -2406,8 +4607,9 @@ class VisualizationHelper(GLMHelper):
             
             return fit_measures_by_session_by_chosen_timepoints
 
-        def plot_timepoint_window_drift_for_timepoint_fit_measures(fit_measures_by_session_by_timepoint:dict, sensor_name:str = None) -> None:
+        def plot_timepoint_window_drift_for_timepoint_fit_measures(fit_measures_by_session_by_timepoint:dict, sensor_name:str = None, sensor_idx:int = -1) -> None:
             sensor_filename_addition = f"sensor_{sensor_name}_" if sensor_name is not None else ""
+            drift_bootstrap = self.load_drift_bootstrap_bands(normalization=normalization, resample=bootstrap_resample, sensor_idx=sensor_idx, omitted_sessions=omitted_sessions, subtract_self_pred=subtract_self_pred, include_0_distance=include_0_distance) if bootstrap_resample is not None else None
 
             if subtract_self_pred:
                 # Normalize with self-predictions
@@ -2436,7 +4638,7 @@ class VisualizationHelper(GLMHelper):
 
                     if not all_windows_one_plot:
                         # Plot drift for current window
-                        drift_plot_window = self._plot_drift_distance_based(fit_measures_by_distances=fit_measures_by_distances_window, self_pred_normalized=subtract_self_pred, omitted_sessions=omitted_sessions, losses_averaged_within_distances=False, all_windows_one_plot=False, timepoint_window_start_idx=timepoint_window_start_idx, include_0_distance=include_0_distance)
+                        drift_plot_window = self._plot_drift_distance_based(fit_measures_by_distances=fit_measures_by_distances_window, self_pred_normalized=subtract_self_pred, omitted_sessions=omitted_sessions, losses_averaged_within_distances=False, all_windows_one_plot=False, timepoint_window_start_idx=timepoint_window_start_idx, include_0_distance=include_0_distance, drift_bootstrap=drift_bootstrap)
 
                         # Store plot for current window
                         window_end = timepoint_window_start_idx + self.time_window_n_indices
@@ -2450,14 +4652,14 @@ class VisualizationHelper(GLMHelper):
 
             # Plot all timewindows in the same plot (with different colors)
             if all_windows_one_plot:
-                drift_plot_all_windows = self._plot_drift_distance_based(fit_measures_by_distances=fit_measures_by_distance_by_time_window, omitted_sessions=omitted_sessions, self_pred_normalized=subtract_self_pred, losses_averaged_within_distances=False, all_windows_one_plot=True, include_0_distance=include_0_distance)
+                drift_plot_all_windows = self._plot_drift_distance_based(fit_measures_by_distances=fit_measures_by_distance_by_time_window, omitted_sessions=omitted_sessions, self_pred_normalized=subtract_self_pred, losses_averaged_within_distances=False, all_windows_one_plot=True, include_0_distance=include_0_distance, drift_bootstrap=drift_bootstrap)
                 storage_filename = f"drift_plot_{sensor_filename_addition}all_windows_comparison"
                 self.save_plot_as_file(plt=drift_plot_all_windows, plot_folder=storage_folder, plot_file=storage_filename, plot_type="figure")
 
             # For control/comparison, plot the drift for the all timepoint values combined/averaged aswell
             logger.custom_debug(f"fit_measures_by_session_by_timepoint: {fit_measures_by_session_by_timepoint}")
             fit_measures_by_distances_all_timepoints = self.calculate_fit_by_distances(fit_measures_by_session=fit_measures_by_session_by_timepoint, timepoint_level_input=True, average_within_distances=False, include_0_distance=include_0_distance)
-            drift_plot_all_timepoints = self._plot_drift_distance_based(fit_measures_by_distances=fit_measures_by_distances_all_timepoints, self_pred_normalized=subtract_self_pred, omitted_sessions=omitted_sessions, losses_averaged_within_distances=False, all_windows_one_plot=False, timepoint_window_start_idx=999, include_0_distance=include_0_distance)  # 999 indicates that we are considering all timepoints
+            drift_plot_all_timepoints = self._plot_drift_distance_based(fit_measures_by_distances=fit_measures_by_distances_all_timepoints, self_pred_normalized=subtract_self_pred, omitted_sessions=omitted_sessions, losses_averaged_within_distances=False, all_windows_one_plot=False, timepoint_window_start_idx=999, include_0_distance=include_0_distance, drift_bootstrap=drift_bootstrap)  # 999 indicates that we are considering all timepoints
 
             storage_filename = f"drift_plot_{sensor_filename_addition}all_timepoints"
             self.save_plot_as_file(plt=drift_plot_all_timepoints, plot_folder=storage_folder, plot_file=storage_filename, plot_type="figure")
@@ -2489,7 +4691,7 @@ class VisualizationHelper(GLMHelper):
         for normalization in self.normalizations:
             if not sensor_level:
                 # Load timepoint-based variance explained
-                storage_folder = f"data_files/{self.lock_event}/var_explained_timepoints/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}/"
+                storage_folder = f"{self.get_fit_measure_subject_folder('var_explained_timepoints')}/norm_{normalization}/"
                 json_storage_file = f"var_explained_timepoints_dict.json"
                 json_storage_path = os.path.join(storage_folder, json_storage_file)
                 with open(json_storage_path, 'r') as file:
@@ -2499,7 +4701,7 @@ class VisualizationHelper(GLMHelper):
                 plot_timepoint_window_drift_for_timepoint_fit_measures(fit_measures_by_session_by_timepoint)
             else:
                 # Load sensor- and timepoint-based variance explained
-                storage_folder = f"data_files/{self.lock_event}/var_explained_sensors_timepoints/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}/"
+                storage_folder = f"{self.get_fit_measure_subject_folder('var_explained_sensors_timepoints')}/norm_{normalization}/"
                 json_storage_file = f"var_explained_sensors_timepoints_dict.json"
                 json_storage_path = os.path.join(storage_folder, json_storage_file)
                 with open(json_storage_path, 'r') as file:
@@ -2514,16 +4716,68 @@ class VisualizationHelper(GLMHelper):
 
                 for sensor_idx, sensor_name in enumerate(sensor_names):
                     sensor_fit_measures_by_session_by_timepoint = fit_measures_by_sensor_by_session_by_timepoint["sensor"][str(sensor_idx)]
-                    plot_timepoint_window_drift_for_timepoint_fit_measures(sensor_fit_measures_by_session_by_timepoint, sensor_name=sensor_name)
+                    plot_timepoint_window_drift_for_timepoint_fit_measures(sensor_fit_measures_by_session_by_timepoint, sensor_name=sensor_name, sensor_idx=sensor_idx)
 
 
+    @StageMetrics.measure
+    def visualize_temporal_generalization(self, fit_measure:str = "var_explained", omitted_sessions:list = []):
+        """
+        Plots the temporal generalization matrices (train timepoint x test timepoint) stored by calculate_temporal_generalization:
+        one grid with all session pairs, and the self-prediction average next to the cross-session average.
+        """
+        if fit_measure not in ["var_explained", "pearson_r"]:
+            raise ValueError(f"visualize_temporal_generalization called with unrecognized fit_measure {fit_measure}.")
+
+        for normalization in self.normalizations:
+            storage_folder = f"data_files/{self.lock_event}/temporal_generalization/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}"
+            temporal_generalization = np.load(os.path.join(storage_folder, "temporal_generalization.npz"))
+            session_ids = temporal_generalization["session_ids"].tolist()
+            selected_idx = [session_idx for session_idx, session_id in enumerate(session_ids) if session_id not in omitted_sessions]
+            matrices = temporal_generalization[fit_measure][np.ix_(selected_idx, selected_idx)]
+            session_ids = [session_ids[session_idx] for session_idx in selected_idx]
+            n_sessions = len(session_ids)
+            n_timepoints = matrices.shape[-1]
+
+            timepoint_extent = [self.map_timepoint_idx_to_ms(0), self.map_timepoint_idx_to_ms(n_timepoints - 1)] * 2
+            color_limit = np.nanpercentile(np.abs(matrices), 99)
+            plot_folder = f"data_files/{self.lock_event}/visualizations/temporal_generalization/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}"
+            measure_label = "Variance Explained" if fit_measure == "var_explained" else "Pearson r"
+
+            # All session pairs
+            fig, axes = plt.subplots(n_sessions, n_sessions, figsize=(2 * n_sessions, 2 * n_sessions), squeeze=False, sharex=True, sharey=True)
+            for model_idx, session_id_model in enumerate(session_ids):
+                for pred_idx, session_id_pred in enumerate(session_ids):
+                    ax = axes[model_idx, pred_idx]
+                    image = ax.imshow(matrices[model_idx, pred_idx], origin="lower", extent=timepoint_extent, cmap="RdBu_r", vmin=-color_limit, vmax=color_limit)
+                    if model_idx == 0:
+                        ax.set_title(f"Pred {session_id_pred}", fontsize=8)
+                    if pred_idx == 0:
+                        ax.set_ylabel(f"Train {session_id_model}", fontsize=8)
+            fig.colorbar(image, ax=axes, shrink=0.6, label=measure_label)
+            fig.suptitle(f"Temporal generalization ({measure_label}), y: train timepoint [ms], x: test timepoint [ms] \n Norm {normalization}, omitted_sessions: {omitted_sessions}, {date.today()}")
+            self.save_plot_as_file(plt=fig, plot_folder=plot_folder, plot_file=f"temporal_generalization_{fit_measure}_all_session_pairs", plot_type="figure")
+
+            # Self-predictions vs cross-session predictions
+            is_self_pred = np.eye(n_sessions, dtype=bool)
+            fig, axes = plt.subplots(1, 2, figsize=(14, 6), sharey=True)
+            for ax, (title, pair_mask) in zip(axes, [("Self-prediction (mean over sessions)", is_self_pred), ("Cross-session prediction (mean over session pairs)", ~is_self_pred)]):
+                image = ax.imshow(np.mean(matrices[pair_mask], axis=0), origin="lower", extent=timepoint_extent, cmap="RdBu_r", vmin=-color_limit, vmax=color_limit)
+                ax.plot(timepoint_extent[:2], timepoint_extent[:2], color="black", linestyle="--", linewidth=1)
+                ax.set_title(title)
+                ax.set_xlabel("Test timepoint [ms]")
+            axes[0].set_ylabel("Train timepoint [ms]")
+            fig.colorbar(image, ax=axes, label=measure_label)
+            self.save_plot_as_file(plt=fig, plot_folder=plot_folder, plot_file=f"temporal_generalization_{fit_measure}_self_vs_cross", plot_type="figure")
+
+
+    @StageMetrics.measure
     def mne_topo_plot_per_sensor(self, data_type:str, omitted_sessions:list, all_timepoints_combined:bool):
         if data_type not in ["self-pred", "drift"]:
             raise ValueError(f"visualize_topo_with_drift_per_sensor called with invalid argument for data_type {data_type}")
 
         for normalization in self.normalizations:
             # Load sensor- and timepoint-based variance explained
-            storage_folder = f"data_files/{self.lock_event}/var_explained_sensors_timepoints/{self.ann_model}/{self.module_name}/subject_{self.subject_id}/norm_{normalization}/"
+            storage_folder = f"{self.get_fit_measure_subject_folder('var_explained_sensors_timepoints')}/norm_{normalization}/"
             json_storage_file = f"var_explained_sensors_timepoints_dict.json"
             json_storage_path = os.path.join(storage_folder, json_storage_file)
             with open(json_storage_path, 'r') as file:
@@ -2649,6 +4903,7 @@ class VisualizationHelper(GLMHelper):
             #self.save_plot_as_file(plt=fig, plot_folder=plot_folder, plot_file=plot_file)
 
 
+    @StageMetrics.measure
     def visualize_meg_epochs_mne(self):
         """
         Visualizes meg data at various processing steps
@@ -2676,6 +4931,7 @@ class VisualizationHelper(GLMHelper):
                 self.save_plot_as_file(plt=epochs_plot, plot_folder=plot_folder, plot_file=plot_file, plot_type="mne")
 
 
+    @StageMetrics.measure
     def visualize_meg_ERP_style(self, plot_norms: list):
         """
         Visualizes meg data in ERP fashion, averaged over sessions and channels.
@@ -2725,6 +4981,7 @@ class VisualizationHelper(GLMHelper):
                 plot_file = f"Session-{session_id_num}_Sensor-{sensor_type}_plot.png"
                 self.save_plot_as_file(plt=plt, plot_folder=plot_folder, plot_file=plot_file)
 
+    @StageMetrics.measure
     def visualize_model_perspective(self, plot_norms: list, seperate_plots=False):
         """
         DEPRECATED. Replaced by new_visualize_model_perspective
@@ -2822,6 +5079,7 @@ class VisualizationHelper(GLMHelper):
                     plot_file = f"Session-{session_id_num}_Sensor-{sensor_type}_timepoint-overview.png"
                     self.save_plot_as_file(plt=plt, plot_folder=plot_folder, plot_file=plot_file)
 
+    @StageMetrics.measure
     def new_visualize_model_perspective(self, plot_norms: list, seperate_plots=False):
         """
         Visualizes meg data from the regression models perspective. This means, we plot the values over the epochs for each timepoint, one line for each selected sensor.
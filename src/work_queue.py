@@ -0,0 +1,353 @@
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import logging
+import argparse
+import threading
+import traceback
+import subprocess
+import numpy as np
+
+from stage_metrics import StageMetrics
+
+# Logging related
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue:
+    """
+    Work queue in a shared folder, without any service: tasks are json descriptors that move between the subfolders pending, claimed, done and failed.
+    Workers on any node claim a pending task by renaming it into claimed (atomic, only one worker succeeds), keep the claim alive by touching it
+    and publish the return value of the task in results before moving it to done. Claims whose heartbeat stopped (e.g. a worker killed at the end
+    of its allocation) are moved back to pending by the coordinator.
+    """
+    queue_states = ["pending", "claimed", "done", "failed", "results"]
+
+    def __init__(self, queue_folder:str, heartbeat_interval:float = 30, heartbeat_timeout:float = 300, worker_settings:dict = {}):
+        self.queue_folder = queue_folder
+        # Class-level settings of the coordinator that workers apply before running a task, e.g. {"BasicOperationsHelper": {"split_storage_backend": "files"}}
+        self.worker_settings = worker_settings
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        # Restarts of the local workers by index in the list of start_local_workers
+        self.worker_restarts = {}
+        # Duration and peak rss increase of the tasks collected by wait_for_tasks, by task id
+        self.task_metrics = {}
+        for queue_state in WorkQueue.queue_states:
+            os.makedirs(os.path.join(queue_folder, queue_state), exist_ok=True)
+
+
+    def get_task_path(self, queue_state:str, task_id:str) -> str:
+        return os.path.join(self.queue_folder, queue_state, f"{task_id}.json")
+
+
+    @staticmethod
+    def encode_value(value):
+        """
+        json default for task arguments: numpy arrays are stored with their dtype and restored by decode_value.
+        """
+        if isinstance(value, np.ndarray):
+            return {"__ndarray__": value.tolist(), "dtype": str(value.dtype)}
+        if isinstance(value, np.generic):
+            return value.item()
+        raise TypeError(f"[WorkQueue] Task argument of type {type(value)} is not json serializable.")
+
+
+    @staticmethod
+    def decode_value(json_dict:dict):
+        if "__ndarray__" in json_dict:
+            return np.array(json_dict["__ndarray__"], dtype=json_dict["dtype"])
+        return json_dict
+
+
+    def write_json_atomically(self, file_path:str, content:dict) -> None:
+        """
+        Writes a json file via a temporary file in the same folder, so readers on other nodes never see partially written files.
+        """
+        temporary_path = f"{file_path}.tmp_{uuid.uuid4().hex}"
+        with open(temporary_path, 'w') as file:
+            json.dump(content, file, indent=4, default=WorkQueue.encode_value)
+        os.replace(temporary_path, file_path)
+
+
+    def read_json(self, file_path:str) -> dict:
+        with open(file_path, 'r') as file:
+            return json.load(file, object_hook=WorkQueue.decode_value)
+
+
+    def submit(self, stage:str, subject_id:str, helper:str, helper_kwargs:dict, method:str, method_kwargs:dict = {}, session_id:str = None, normalization:str = None, restrict_to_session:bool = True) -> str:
+        """
+        Adds a task to the queue and returns its id. A worker runs helper(**helper_kwargs).method(**method_kwargs), with the sessions of the helper restricted
+        to session_id (if restrict_to_session) and its normalizations to normalization (if given).
+        """
+        task_id = f"{stage}_subject_{subject_id}" + (f"_session_{session_id}" if session_id is not None else "") + (f"_norm_{normalization}" if normalization is not None else "") + f"_{uuid.uuid4().hex[:8]}"
+        task = {"task_id": task_id, "stage": stage, "subject_id": subject_id, "session_id": session_id, "normalization": normalization, "restrict_to_session": restrict_to_session,
+                "helper": helper, "helper_kwargs": helper_kwargs, "method": method, "method_kwargs": method_kwargs, "settings": self.worker_settings, "submitted": time.strftime("%Y-%m-%d %H:%M:%S")}
+        self.write_json_atomically(self.get_task_path("pending", task_id), task)
+        logger.custom_debug(f"Submitted task {task_id}")
+
+        return task_id
+
+
+    def claim(self, worker_id:str) -> dict:
+        """
+        Claims the oldest pending task, returns None if no task is pending.
+        """
+        pending_folder = os.path.join(self.queue_folder, "pending")
+        pending_files = sorted((file_name for file_name in os.listdir(pending_folder) if file_name.endswith(".json")), key=lambda file_name: os.path.getmtime(os.path.join(pending_folder, file_name)) if os.path.exists(os.path.join(pending_folder, file_name)) else 0)
+        for file_name in pending_files:
+            task_id = file_name[:-len(".json")]
+            claimed_path = self.get_task_path("claimed", task_id)
+            try:
+                os.rename(self.get_task_path("pending", task_id), claimed_path)
+                # The rename keeps the modification time of the pending task, which would look like a stale claim
+                os.utime(claimed_path)
+                task = self.read_json(claimed_path)
+            except FileNotFoundError:
+                # Claimed by another worker in the meantime
+                continue
+            task.update({"worker_id": worker_id, "claimed": time.strftime("%Y-%m-%d %H:%M:%S")})
+            self.write_json_atomically(claimed_path, task)
+
+            return task
+
+        return None
+
+
+    def publish_result(self, task:dict, result, duration:float, peak_rss_gb:float = None, stage_metrics:list = []) -> None:
+        """
+        Stores the result of a task (with its duration, peak rss increase and the stage method metrics recorded while running it) and marks it as done.
+        """
+        self.write_json_atomically(self.get_task_path("results", task["task_id"]), {"task_id": task["task_id"], "worker_id": task.get("worker_id"), "duration_s": duration, "peak_rss_gb": peak_rss_gb, "result": result,
+                                                                                     "stage_metrics": [{**stage_record, "worker_id": task.get("worker_id")} for stage_record in stage_metrics]})
+        self.move_claimed_task(task=task, queue_state="done")
+
+
+    def publish_failure(self, task:dict, error:str, duration:float) -> None:
+        self.move_claimed_task(task=task, queue_state="failed", error=error, duration_s=duration)
+
+
+    def move_claimed_task(self, task:dict, queue_state:str, **task_updates) -> None:
+        claimed_path = self.get_task_path("claimed", task["task_id"])
+        if not os.path.exists(claimed_path):
+            logger.warning(f"Task {task['task_id']} was requeued while it was running (missing heartbeat), it might be run twice.")
+        task.update({"finished": time.strftime("%Y-%m-%d %H:%M:%S"), **task_updates})
+        self.write_json_atomically(self.get_task_path(queue_state, task["task_id"]), task)
+        if os.path.exists(claimed_path):
+            os.remove(claimed_path)
+
+
+    def start_heartbeat(self, task_id:str) -> threading.Event:
+        """
+        Touches the claim of a task every heartbeat_interval seconds until the returned event is set.
+        """
+        stop_event = threading.Event()
+        def touch_claim():
+            while not stop_event.wait(self.heartbeat_interval):
+                try:
+                    os.utime(self.get_task_path("claimed", task_id))
+                except FileNotFoundError:
+                    return
+        threading.Thread(target=touch_claim, daemon=True).start()
+
+        return stop_event
+
+
+    def requeue_stale_claims(self) -> list:
+        """
+        Moves claimed tasks without heartbeat for heartbeat_timeout seconds back to pending and returns their ids.
+        """
+        claimed_folder = os.path.join(self.queue_folder, "claimed")
+        requeued_task_ids = []
+        for file_name in os.listdir(claimed_folder):
+            if not file_name.endswith(".json"):
+                continue
+            task_id = file_name[:-len(".json")]
+            try:
+                if time.time() - os.path.getmtime(os.path.join(claimed_folder, file_name)) > self.heartbeat_timeout:
+                    os.rename(os.path.join(claimed_folder, file_name), self.get_task_path("pending", task_id))
+                    requeued_task_ids.append(task_id)
+                    logger.warning(f"Requeued task {task_id}, its worker stopped sending heartbeats.")
+            except FileNotFoundError:
+                # Finished in the meantime
+                continue
+
+        return requeued_task_ids
+
+
+    def get_task_state(self, task_id:str) -> str:
+        for queue_state in ["done", "failed", "claimed", "pending"]:
+            if os.path.exists(self.get_task_path(queue_state, task_id)):
+                return queue_state
+
+        return None
+
+
+    def wait_for_tasks(self, task_ids:list, poll_interval:float = 5, local_workers:list = [], timeout:float = None, max_worker_restarts:int = 3) -> dict:
+        """
+        Waits until all tasks are done and returns their results by task id. The stage method metrics of the tasks are added to the StageMetrics of the coordinator,
+        their duration and peak rss increase to task_metrics.
+        Local workers (from start_local_workers) that exited while tasks are unfinished are restarted in place, at most max_worker_restarts times each.
+        Raises a RuntimeError (after all other tasks finished) if tasks failed or if local workers keep exiting, and a TimeoutError if the tasks did not finish within timeout seconds (None: no limit).
+        """
+        wait_start = time.time()
+        last_progress = None
+        while True:
+            self.requeue_stale_claims()
+            task_states = {task_id: self.get_task_state(task_id) for task_id in task_ids}
+            n_finished = sum(task_state in ["done", "failed"] for task_state in task_states.values())
+            if n_finished != last_progress:
+                logger.custom_info(f"Work queue: {n_finished}/{len(task_ids)} tasks finished, {sum(task_state == 'claimed' for task_state in task_states.values())} running.")
+                last_progress = n_finished
+            if n_finished == len(task_ids):
+                break
+            if local_workers:
+                self.restart_exited_workers(local_workers=local_workers, max_worker_restarts=max_worker_restarts)
+            if timeout is not None and time.time() - wait_start > timeout:
+                unfinished_task_ids = [task_id for task_id, task_state in task_states.items() if task_state not in ["done", "failed"]]
+                raise TimeoutError(f"[WorkQueue] Tasks {unfinished_task_ids} did not finish within {timeout} s. Are workers running on queue {self.queue_folder}?")
+            time.sleep(poll_interval)
+
+        failed_task_ids = [task_id for task_id, task_state in task_states.items() if task_state == "failed"]
+        if failed_task_ids:
+            for task_id in failed_task_ids:
+                logger.warning(f"Task {task_id} failed:\n{self.read_json(self.get_task_path('failed', task_id))['error']}")
+            raise RuntimeError(f"[WorkQueue] Tasks {failed_task_ids} failed.")
+
+        task_results = {}
+        for task_id in task_ids:
+            result_file = self.read_json(self.get_task_path("results", task_id))
+            StageMetrics.records.extend(result_file.get("stage_metrics", []))
+            self.task_metrics[task_id] = {"duration_s": result_file["duration_s"], "peak_rss_gb": result_file.get("peak_rss_gb")}
+            task_results[task_id] = result_file["result"]
+
+        return task_results
+
+
+    def request_stop(self) -> None:
+        """
+        Asks all workers to exit once no task is pending.
+        """
+        with open(os.path.join(self.queue_folder, "STOP"), 'w') as file:
+            file.write(time.strftime("%Y-%m-%d %H:%M:%S"))
+
+
+    def clear_stop_request(self) -> None:
+        stop_path = os.path.join(self.queue_folder, "STOP")
+        if os.path.exists(stop_path):
+            os.remove(stop_path)
+
+
+    def stop_requested(self) -> bool:
+        return os.path.exists(os.path.join(self.queue_folder, "STOP"))
+
+
+    def start_local_workers(self, n_workers:int, logger_level:int, idle_timeout:float = None) -> list:
+        """
+        Starts worker processes on this machine (e.g. to use all cpus of an allocation, or to test the queue locally). Workers on other nodes are started with
+        python src/work_queue.py --queue-folder <queue_folder> (from the repository root on the shared file system).
+        By default local workers have no idle timeout: the coordinator runs other stages itself in between and they only exit on request_stop.
+        """
+        worker_script = os.path.abspath(__file__)
+        worker_processes = [subprocess.Popen([sys.executable, worker_script, "--queue-folder", self.queue_folder, "--worker-id", f"{socket.gethostname()}_local_{worker_idx}",
+                                              "--logger-level", str(logger_level), "--idle-timeout", str(idle_timeout if idle_timeout is not None else 0)]) for worker_idx in range(n_workers)]
+        logger.custom_info(f"Started {n_workers} local work queue workers.")
+
+        return worker_processes
+
+
+    def restart_exited_workers(self, local_workers:list, max_worker_restarts:int = 3) -> None:
+        """
+        Restarts local worker processes that exited (crashed or timed out) with their original command, replacing them in local_workers.
+        """
+        if self.stop_requested():
+            return
+        for worker_idx, worker_process in enumerate(local_workers):
+            if worker_process.poll() is None:
+                continue
+            n_restarts = self.worker_restarts.get(worker_idx, 0)
+            if n_restarts >= max_worker_restarts:
+                raise RuntimeError(f"[WorkQueue] Local worker {worker_idx} exited with code {worker_process.returncode} after {n_restarts} restarts, see its log in logs/.")
+            logger.warning(f"Local worker {worker_idx} exited with code {worker_process.returncode} while tasks are unfinished, restarting it.")
+            local_workers[worker_idx] = subprocess.Popen(worker_process.args)
+            self.worker_restarts[worker_idx] = n_restarts + 1
+
+
+
+def execute_task(task:dict):
+    """
+    Runs the helper method of a task and returns its (json serializable) return value. The class-level settings of the coordinator are applied first.
+    """
+    # Only workers need the helpers, the queue itself runs without them
+    import utils
+
+    settings_classes = {"BasicOperationsHelper": utils.BasicOperationsHelper, "StageMetrics": StageMetrics}
+    for class_name, class_settings in task.get("settings", {}).items():
+        for setting_name, value in class_settings.items():
+            setattr(settings_classes[class_name], setting_name, value)
+
+    helper = getattr(utils, task["helper"])(**task["helper_kwargs"])
+    if task["session_id"] is not None and task["restrict_to_session"]:
+        helper.session_ids_char = [session_id_char for session_id_char in helper.session_ids_char if helper.map_session_letter_id_to_num(session_id_char) == task["session_id"]]
+        helper.session_ids_num = [task["session_id"]]
+    if task["normalization"] is not None:
+        helper.normalizations = [task["normalization"]]
+
+    return getattr(helper, task["method"])(**task["method_kwargs"])
+
+
+def run_worker(queue_folder:str, worker_id:str, idle_timeout:float = 600, poll_interval:float = 5) -> int:
+    """
+    Claims and runs tasks until the coordinator requests a stop or no task was pending for idle_timeout seconds (None: only on request). Returns the number of tasks run.
+    """
+    work_queue = WorkQueue(queue_folder=queue_folder)
+    n_tasks = 0
+    idle_since = time.time()
+    logger.custom_info(f"Worker {worker_id} (pid {os.getpid()}) started on queue {queue_folder}.")
+    while True:
+        task = work_queue.claim(worker_id=worker_id)
+        if task is None:
+            if work_queue.stop_requested() or (idle_timeout is not None and time.time() - idle_since > idle_timeout):
+                break
+            time.sleep(poll_interval)
+            continue
+
+        logger.custom_info(f"Worker {worker_id} running task {task['task_id']}.")
+        heartbeat = work_queue.start_heartbeat(task_id=task["task_id"])
+        task_start = time.time()
+        n_previous_records = len(StageMetrics.records)
+        try:
+            with StageMetrics.track_run() as task_usage:
+                result = execute_task(task)
+            work_queue.publish_result(task=task, result=result, duration=task_usage["duration_s"], peak_rss_gb=task_usage["peak_rss_gb"], stage_metrics=StageMetrics.records[n_previous_records:])
+            logger.custom_info(f"Worker {worker_id} completed task {task['task_id']} in {time.time() - task_start:.1f} s.")
+        except Exception:
+            work_queue.publish_failure(task=task, error=traceback.format_exc(), duration=time.time() - task_start)
+            logger.exception(f"Worker {worker_id}: task {task['task_id']} failed.")
+        finally:
+            heartbeat.set()
+        n_tasks += 1
+        idle_since = time.time()
+
+    logger.custom_info(f"Worker {worker_id} exiting after {n_tasks} tasks.")
+
+    return n_tasks
+
+
+if __name__ == "__main__":
+    # Importing setup_logger changes the working directory to the repository root, the queue folder is relative to it
+    from setup_logger import setup_logger
+
+    parser = argparse.ArgumentParser(description="Work queue worker: claims and runs pipeline tasks from a shared queue folder.")
+    parser.add_argument("--queue-folder", required=True)
+    parser.add_argument("--worker-id", default=None)
+    parser.add_argument("--logger-level", type=int, default=25)
+    parser.add_argument("--idle-timeout", type=float, default=600, help="Seconds without pending tasks after which the worker exits (0: only when the coordinator requests a stop).")
+    args = parser.parse_args()
+
+    worker_id = args.worker_id if args.worker_id is not None else f"{socket.gethostname()}_{os.getpid()}"
+    setup_logger(args.logger_level, log_name=f"worker_{worker_id}")
+    run_worker(queue_folder=args.queue_folder, worker_id=worker_id, idle_timeout=args.idle_timeout if args.idle_timeout > 0 else None)
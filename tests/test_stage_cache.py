@@ -0,0 +1,46 @@
+import os
+import sys
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+# Importing setup_logger changes the working directory to the repository root, logs are written to logs/
+from setup_logger import setup_logger
+from pipeline import StageCache
+
+os.makedirs("logs", exist_ok=True)
+setup_logger(logging.WARNING, log_name="test_stage_cache")
+
+stage_dependencies = {"features": [], "feature_reduction": ["features"], "GLM_training": ["feature_reduction"]}
+stage_configs = {"features": {"ann_model": "resnet50"}, "feature_reduction": {"pca_components": 100}, "GLM_training": {"alphas": [1, 10]}}
+
+
+def create_stage_cache(force_stages:list = []) -> StageCache:
+    return StageCache(subject_id="01", lock_event="saccade", stage_configs=stage_configs, requested_stages=["GLM_training"], force_stages=force_stages, stage_dependencies=stage_dependencies)
+
+
+def run_stages(stage_cache:StageCache) -> list:
+    stages_run = []
+    for stage_name in stage_dependencies:
+        if stage_cache.requires_run(stage_name):
+            stage_cache.mark_complete(stage_name)
+            stages_run.append(stage_name)
+
+    return stages_run
+
+
+def test_artifact_ids_are_derived_from_the_configuration(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert run_stages(create_stage_cache()) == list(stage_dependencies)
+    artifact_ids = {stage_name: create_stage_cache().read_stage_record(stage_name)["artifact_id"] for stage_name in stage_dependencies}
+
+    # Recomputing the features with an unchanged configuration keeps the downstream stages up to date only if they are not forced
+    assert run_stages(create_stage_cache(force_stages=["features"])) == list(stage_dependencies)
+    assert {stage_name: create_stage_cache().read_stage_record(stage_name)["artifact_id"] for stage_name in stage_dependencies} == artifact_ids
+    assert run_stages(create_stage_cache()) == []
+
+    stage_configs["feature_reduction"]["pca_components"] = 50
+    try:
+        assert run_stages(create_stage_cache()) == ["feature_reduction", "GLM_training"]
+        assert create_stage_cache().read_stage_record("feature_reduction")["artifact_id"] != artifact_ids["feature_reduction"]
+    finally:
+        stage_configs["feature_reduction"]["pca_components"] = 100
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+from stage_metrics import StageMetrics
+
+
+def test_track_run_measures_the_peak_of_each_run():
+    """
+    The peak rss of a run does not include the peak of an earlier, larger run of the same process.
+    """
+    with StageMetrics.track_run() as large_run:
+        large_array = np.ones(300 * 1024**2 // 8)
+        del large_array
+    with StageMetrics.track_run() as small_run:
+        small_array = np.ones(50 * 1024**2 // 8)
+        del small_array
+
+    assert large_run["peak_rss_gb"] > 0.25
+    assert 0.04 < small_run["peak_rss_gb"] < 0.15
+    assert small_run["duration_s"] >= 0
@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+# Importing setup_logger changes the working directory to the repository root (like the workers do), logs are written to logs/
+from setup_logger import setup_logger
+from work_queue import WorkQueue
+
+os.makedirs("logs", exist_ok=True)
+setup_logger(logging.WARNING, log_name="test_work_queue")
+
+
+def stop_workers(work_queue:WorkQueue, local_workers:list) -> None:
+    work_queue.request_stop()
+    for local_worker in local_workers:
+        try:
+            local_worker.wait(timeout=30)
+        except Exception:
+            local_worker.kill()
+
+
+def test_local_workers_wait_for_stop_request(tmp_path):
+    """
+    Local workers have no idle timeout: they are still running after a local stage of the coordinator and exit on request_stop.
+    """
+    work_queue = WorkQueue(queue_folder=str(tmp_path / "queue"))
+    local_workers = work_queue.start_local_workers(n_workers=1, logger_level=logging.WARNING)
+    try:
+        # Local stage of the coordinator
+        time.sleep(8)
+        assert all(local_worker.poll() is None for local_worker in local_workers)
+    finally:
+        stop_workers(work_queue, local_workers)
+    assert all(local_worker.returncode == 0 for local_worker in local_workers)
+
+
+def test_wait_for_tasks_restarts_exited_workers(tmp_path):
+    """
+    A local stage that runs longer than the idle timeout of the workers does not leave the queue tasks of the next stage unclaimed.
+    """
+    work_queue = WorkQueue(queue_folder=str(tmp_path / "queue"))
+    local_workers = work_queue.start_local_workers(n_workers=1, logger_level=logging.WARNING, idle_timeout=1)
+    try:
+        # Local stage of the coordinator, longer than the idle timeout (and the startup) of the worker
+        time.sleep(10)
+        assert all(local_worker.poll() is not None for local_worker in local_workers)
+
+        # The helper does not exist, the task fails once a worker claimed it
+        task_id = work_queue.submit(stage="test", subject_id="00", helper="MissingHelper", helper_kwargs={}, method="missing_method")
+        with pytest.raises(RuntimeError, match="failed"):
+            work_queue.wait_for_tasks([task_id], poll_interval=0.5, local_workers=local_workers, timeout=120)
+        assert work_queue.get_task_state(task_id) == "failed"
+        assert work_queue.worker_restarts == {0: 1}
+    finally:
+        stop_workers(work_queue, local_workers)
+
+
+def test_wait_for_tasks_times_out_without_workers(tmp_path):
+    work_queue = WorkQueue(queue_folder=str(tmp_path / "queue"))
+    task_id = work_queue.submit(stage="test", subject_id="00", helper="MissingHelper", helper_kwargs={}, method="missing_method")
+    with pytest.raises(TimeoutError):
+        work_queue.wait_for_tasks([task_id], poll_interval=0.1, timeout=0.5)
+    assert work_queue.get_task_state(task_id) == "pending"